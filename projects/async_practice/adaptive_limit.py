@@ -0,0 +1,176 @@
+﻿# 固定の Semaphore の代わりに使える「自動調整される同時実行上限」です。
+# AIMD (Additive Increase / Multiplicative Decrease) で上限を動かします。
+# - 成功して応答も速い   -> 上限を少しずつ増やす (+increase_step / limit)
+# - timeout / エラー / 遅い -> 上限を一気に減らす (× decrease_factor)
+#
+# Semaphore と同じく async with で使えます:
+#     async with limiter:
+#         await asyncio.wait_for(call(), timeout=...)
+# async with の中で例外が出たら「失敗」、正常に抜けたら「成功」として数えます。
+
+import asyncio
+from collections import deque
+
+
+class AdaptiveLimiter:
+    """
+    AIMD で上限が変わる非同期リミッター。
+
+    - limit: 今の上限 (整数)。これを見れば収束の様子が分かる
+    - on_change(old, new): 上限が変わったときに呼ぶ (ログ用, 任意)
+    - decrease_cooldown: 同時に複数件が失敗しても、この秒数内は1回しか減らさない
+    """
+
+    def __init__(
+        self,
+        initial_limit,
+        min_limit=1,
+        max_limit=20,
+        latency_threshold=None,
+        increase_step=1.0,
+        decrease_factor=0.5,
+        decrease_cooldown=None,
+        on_change=None,
+    ):
+        if not min_limit <= initial_limit <= max_limit:
+            raise ValueError("min_limit <= initial_limit <= max_limit にしてください")
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_threshold = latency_threshold
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        # 指定がなければ「遅いとみなす秒数」ぶんは連続で減らさない
+        self.decrease_cooldown = (
+            decrease_cooldown if decrease_cooldown is not None else (latency_threshold or 0.0)
+        )
+        self.on_change = on_change
+
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiters = deque()
+        self._last_decrease_at = None
+        # Task -> 枠を取れた時刻 (async with の出口で応答時間を出すため)
+        self._entered = {}
+
+        # 集計
+        self.successes = 0
+        self.failures = 0
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def snapshot(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "waiting": len(self._waiters),
+            "successes": self.successes,
+            "failures": self.failures,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+    # ---- Semaphore 互換の入口 ----
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.release(ok=True)
+        elif issubclass(exc_type, asyncio.CancelledError):
+            # キャンセルは上流の健康状態と関係ないので、枠を返すだけ
+            self.release(ok=None)
+        else:
+            self.release(ok=False)
+        return False
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+        else:
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # 枠をもらった直後にキャンセルされた -> 返しておく
+                    self._in_flight -= 1
+                    self._wake()
+                raise
+        self._entered[asyncio.current_task()] = loop.time()
+
+    def release(self, ok=True):
+        """
+        枠を返して、結果に応じて上限を調整する。
+        ok=True: 成功 / ok=False: 失敗 / ok=None: 調整しない
+        acquire と同じ Task から呼ぶこと (応答時間を Task 単位で測るため)。
+        """
+        self._in_flight -= 1
+        now = asyncio.get_running_loop().time()
+        started_at = self._entered.pop(asyncio.current_task(), None)
+        latency = None if started_at is None else now - started_at
+
+        if ok is True:
+            self.successes += 1
+            too_slow = (
+                self.latency_threshold is not None
+                and latency is not None
+                and latency > self.latency_threshold
+            )
+            if too_slow:
+                self._decrease(now)
+            else:
+                self._increase()
+        elif ok is False:
+            self.failures += 1
+            self._decrease(now)
+
+        self._wake()
+
+    # ---- 内部処理 ----
+
+    def _increase(self):
+        old = self.limit
+        # 1回の成功で +step/limit -> 上限ぶん成功するとだいたい +step
+        self._limit = min(self.max_limit, self._limit + self.increase_step / self._limit)
+        if self.limit != old:
+            self.increases += 1
+            self._notify(old)
+
+    def _decrease(self, now):
+        if (
+            self._last_decrease_at is not None
+            and now - self._last_decrease_at < self.decrease_cooldown
+        ):
+            return
+        self._last_decrease_at = now
+
+        old = self.limit
+        self._limit = max(float(self.min_limit), self._limit * self.decrease_factor)
+        if self.limit != old:
+            self.decreases += 1
+            self._notify(old)
+
+    def _notify(self, old):
+        if self.on_change is not None:
+            self.on_change(old, self.limit)
+
+    def _wake(self):
+        # 上限に空きがある分だけ、待っている人を先着順に通す
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
@@ -0,0 +1,149 @@
+﻿# イベントループを止めないログ出力です。
+# 学べること:
+# 1) print はターミナル/ファイルへの書き込みを待つので、件数が多いとループ全体が止まる
+# 2) ログは queue に積むだけにして、書き込みは別スレッドがまとめて行う
+# 3) レベルで絞る + うるさいセクション (API の試行ごとのログなど) は間引く (sampling)
+#
+# 出力は1行1レコードの JSON Lines:
+#   {"ts": "2026-01-01T12:00:00.123", "level": "INFO", "section": "API", "message": "..."}
+
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+# close() 用の終了シグナル
+_STOP = object()
+
+
+class AsyncLogger:
+    """
+    ログを queue に積むだけの logger。書き込みはバックグラウンドスレッドが担当する。
+
+    - level: これ未満のレベルは捨てる
+    - sample_rates: {"API": 0.1} なら API セクションの INFO 以下を 10% だけ残す
+      (WARNING 以上は間引かない)
+    - queue_maxsize: 書き込みが追いつかず満杯になったら、待たずに捨てて dropped に数える
+    - path: None なら標準出力に書く
+    """
+
+    def __init__(
+        self,
+        path=None,
+        level="INFO",
+        sample_rates=None,
+        batch_size=256,
+        flush_interval=0.2,
+        queue_maxsize=100_000,
+        rng=None,
+    ):
+        self.levelno = LEVELS[level]
+        self.sample_rates = dict(sample_rates or {})
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rng = rng or random.Random()
+
+        if path is None:
+            self._stream = sys.stdout
+            self._owns_stream = False
+        else:
+            self._stream = open(path, "a", encoding="utf-8")
+            self._owns_stream = True
+
+        self._queue = queue.Queue(maxsize=queue_maxsize)
+        self._thread = threading.Thread(target=self._run, name="async-logger", daemon=True)
+        self._thread.start()
+
+        # 集計 (emitted 等は呼び出し側のスレッド、batches は書き込みスレッドだけが更新する)
+        self.emitted = 0
+        self.filtered = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def log(self, level, section, message, **fields):
+        """待たずに戻る。fields は JSON にそのまま追加される。"""
+        levelno = LEVELS[level]
+        if levelno < self.levelno:
+            self.filtered += 1
+            return
+
+        if levelno < LEVELS["WARNING"]:
+            rate = self.sample_rates.get(section)
+            if rate is not None and self._rng.random() >= rate:
+                self.sampled_out += 1
+                return
+
+        # 文字列化や時刻の整形は書き込みスレッドに任せ、ここでは tuple を積むだけ
+        try:
+            self._queue.put_nowait((time.time(), level, section, message, fields))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.emitted += 1
+
+    def close(self):
+        """残りを書き切ってからスレッドを止める。"""
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._owns_stream:
+            self._stream.close()
+        else:
+            self._stream.flush()
+
+    def snapshot(self):
+        return {
+            "emitted": self.emitted,
+            "filtered": self.filtered,
+            "sampled_out": self.sampled_out,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
+
+    # ---- 書き込みスレッド ----
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = False
+            lines = []
+            for record in batch:
+                if record is _STOP:
+                    stopping = True
+                    continue
+                lines.append(self._format(record))
+
+            if lines:
+                self._stream.write("\n".join(lines) + "\n")
+                self._stream.flush()
+                self.batches += 1
+            if stopping:
+                return
+
+    @staticmethod
+    def _format(record):
+        ts, level, section, message, fields = record
+        data = {
+            "ts": datetime.fromtimestamp(ts).isoformat(timespec="milliseconds"),
+            "level": level,
+            "section": section,
+            "message": message,
+        }
+        data.update(fields)
+        return json.dumps(data, ensure_ascii=False)
@@ -0,0 +1,194 @@
+﻿# 注文結果を SQLite にまとめて書き込む「writer ステージ」です。
+# script_10 から使います。
+# 学べること:
+# 1) 1件ごとの commit ではなく、件数 or 時間で区切ってまとめて commit する
+# 2) submit は queue に入れるだけで、commit されたら完了する Future を返す
+#    (呼び出し側は待たずに次へ進み、「処理済み」の記録はこの Future の完了時に行う)
+# 3) ブロッキングな DB 書き込みは writer の1本だけが to_thread で実行する
+#
+# 流れ:
+# worker -> submit() -> writer 用 queue -> _run() がバッチを組む -> to_thread(write_batch)
+
+import asyncio
+import sqlite3
+import threading
+import time
+
+from tracing import Tracer
+
+# close() 用の終了シグナル。None ではなく専用オブジェクトにして取り違えを防ぐ
+_STOP = object()
+
+
+class SqliteOrderSink:
+    """
+    注文結果を保存するローカル SQLite。
+
+    write_batch はブロッキング処理なので、async 側からは to_thread 経由で呼ぶ。
+    複数スレッドから同時に呼ばれても1トランザクションずつ順番に commit する。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        # to_thread は毎回同じスレッドとは限らないため check_same_thread=False
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS orders ("
+            " order_id TEXT PRIMARY KEY,"
+            " score INTEGER NOT NULL,"
+            " saved_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def write_batch(self, rows):
+        """rows = [(order_id, score), ...] を1トランザクションで保存し、件数を返す。"""
+        saved_at = time.time()
+        with self._lock:
+            # with conn: を抜けると commit (例外なら rollback)
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO orders (order_id, score, saved_at) VALUES (?, ?, ?)",
+                    [(order_id, score, saved_at) for order_id, score in rows],
+                )
+        return len(rows)
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def merge_from(self, path):
+        """別の SQLite ファイル (shard ごとの保存先など) の orders を取り込み、件数を返す。"""
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS other", (str(path),))
+            try:
+                with self._conn:
+                    cursor = self._conn.execute(
+                        "INSERT OR REPLACE INTO orders (order_id, score, saved_at)"
+                        " SELECT order_id, score, saved_at FROM other.orders"
+                    )
+                return cursor.rowcount
+            finally:
+                self._conn.execute("DETACH DATABASE other")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BatchWriter:
+    """
+    submit された結果を溜めて、batch_size 件 or max_wait 秒でまとめて書き込む。
+
+    - submit(): writer 用 queue に入れるだけ。queue が満杯のときだけ待つ (背圧)
+      戻り値の Future は commit に成功したら None、失敗したら RuntimeError で完了する
+    - close(): 残りを書き切ってから writer Task を終了する
+    - on_commit(rows) / on_error(rows, exc): ログ用のコールバック (任意)
+    - stats: pipeline_stats.WorkerStats を渡すと commit 時間と件数を記録する (任意)
+    - tracer: tracing.Tracer を渡すと commit ごとに span を記録する (任意)
+    """
+
+    def __init__(
+        self,
+        sink,
+        batch_size=50,
+        max_wait=0.5,
+        queue_maxsize=1000,
+        on_commit=None,
+        on_error=None,
+        stats=None,
+        tracer=None,
+    ):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.on_commit = on_commit
+        self.on_error = on_error
+        self.stats = stats
+        self.tracer = tracer or Tracer(enabled=False)
+        self._queue = asyncio.Queue(maxsize=queue_maxsize)
+        self._task = None
+
+        # 集計 (writer Task だけが更新するので lock 不要)
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.batches = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def submit(self, order_id, score):
+        committed = asyncio.get_running_loop().create_future()
+        await self._queue.put((order_id, score, committed))
+        return committed
+
+    async def close(self):
+        await self._queue.put(_STOP)
+        await self._task
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # 1件目が来るまでは普通に待つ (空のバッチは作らない)
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.batch_size:
+                # すでに溜まっている分は待たずに取り出す
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            # 書き込み中に届いた分は次のバッチにまとまる
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch):
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        rows = [(order_id, score) for order_id, score, _ in batch]
+        try:
+            with self.tracer.span("commit", rows=len(rows)):
+                await asyncio.to_thread(self.sink.write_batch, rows)
+        except Exception as exc:
+            # writer 自体は止めず、失敗件数として記録する
+            self.rows_failed += len(rows)
+            for order_id, _, committed in batch:
+                # 待っている側が cancel 済みなら Future はもう完了している
+                if not committed.done():
+                    committed.set_exception(RuntimeError(f"commit failed: {order_id}: {exc}"))
+                    # 待っていない呼び出し側でも "exception was never retrieved" を出さないように
+                    committed.exception()
+            if self.on_error is not None:
+                self.on_error(rows, exc)
+            return
+
+        self.rows_written += len(rows)
+        self.batches += 1
+        for _, _, committed in batch:
+            if not committed.done():
+                committed.set_result(None)
+        if self.stats is not None:
+            self.stats.observe("commit", loop.time() - started_at)
+            self.stats.incr("rows_committed", len(rows))
+        if self.on_commit is not None:
+            self.on_commit(rows)
@@ -0,0 +1,103 @@
+﻿# batch_writer.py の効果を測るベンチマークです。
+# 「1件ごとに to_thread + commit」と「writer ステージでまとめて commit」を
+# 同じ件数・同じ並行数で流して rows/sec を比べます。
+#
+# 使い方:
+#   python bench_db_writer.py --rows 5000 --producers 8
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from batch_writer import BatchWriter, SqliteOrderSink
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="SQLite 保存方式の rows/sec 比較")
+    parser.add_argument("--rows", type=int, default=5000, help="保存する件数")
+    parser.add_argument("--producers", type=int, default=8, help="同時に保存する worker 数")
+    parser.add_argument("--batch-size", type=int, default=200, help="writer の最大バッチ件数")
+    parser.add_argument("--max-wait", type=float, default=0.05, help="writer の最大待ち秒数")
+    return parser
+
+
+async def run_per_order(sink, rows, producers):
+    """今までの方式: 1件ごとにスレッドへ逃がして commit する。"""
+    queue = asyncio.Queue()
+    for row in rows:
+        queue.put_nowait(row)
+
+    async def producer():
+        while not queue.empty():
+            order_id, score = queue.get_nowait()
+            await asyncio.to_thread(sink.write_batch, [(order_id, score)])
+
+    await asyncio.gather(*(producer() for _ in range(producers)))
+
+
+async def run_batched(sink, rows, producers, batch_size, max_wait):
+    """
+    writer ステージ方式 (script_10 と同じ受け渡し):
+    submit したら commit を待たずに次へ進み、task_done は commit の Future が完了したときに呼ぶ。
+    queue.join() で全件の commit を待ってから writer を止める。
+    """
+    queue = asyncio.Queue()
+    for row in rows:
+        queue.put_nowait(row)
+
+    writer = BatchWriter(sink, batch_size=batch_size, max_wait=max_wait).start()
+
+    async def producer():
+        while not queue.empty():
+            order_id, score = queue.get_nowait()
+            committed = await writer.submit(order_id, score)
+            committed.add_done_callback(lambda _: queue.task_done())
+
+    await asyncio.gather(*(producer() for _ in range(producers)))
+    await queue.join()
+    await writer.close()
+    return writer.batches
+
+
+def measure(label, path, coro_factory, row_count):
+    sink = SqliteOrderSink(path)
+    start = time.perf_counter()
+    extra = asyncio.run(coro_factory(sink))
+    elapsed = time.perf_counter() - start
+    saved = sink.count()
+    sink.close()
+
+    detail = f" batches={extra}" if extra is not None else ""
+    print(
+        f"{label:<10} rows={saved:>7} elapsed={elapsed:7.3f}s "
+        f"rows/sec={row_count / elapsed:10.1f}{detail}"
+    )
+    return elapsed
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    rows = [(f"ORD-{i:07d}", 80 + i % 20) for i in range(args.rows)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        per_order = measure(
+            "per_order",
+            Path(tmp) / "per_order.sqlite3",
+            lambda sink: run_per_order(sink, rows, args.producers),
+            args.rows,
+        )
+        batched = measure(
+            "batch",
+            Path(tmp) / "batch.sqlite3",
+            lambda sink: run_batched(sink, rows, args.producers, args.batch_size, args.max_wait),
+            args.rows,
+        )
+
+    print(f"speedup={per_order / batched:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
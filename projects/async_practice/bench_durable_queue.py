@@ -0,0 +1,90 @@
+﻿# asyncio.Queue (メモリ) と DurableQueue (SQLite) のスループット比較です。
+#
+# - producer 数を変えて put -> get -> task_done を N 件流す
+# - producer が1本だと put ごとに commit (fsync) が1回になる
+#   producer が増えると同時に来た put が1回の commit にまとまる (group commit)
+#   -> items/commit が大きいほど fsync 1回あたりの件数が多い
+#
+# 使い方:
+#   python bench_durable_queue.py --items 5000 --producers 1 16 256
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from durable_queue import DurableQueue
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="メモリ queue と durable queue の比較")
+    parser.add_argument("--items", type=int, default=5000, help="流す件数")
+    parser.add_argument("--producers", type=int, nargs="+", default=[1, 16, 256])
+    parser.add_argument("--consumers", type=int, default=8)
+    parser.add_argument("--queue-maxsize", type=int, default=1000)
+    return parser
+
+
+async def run_pipeline(order_queue, items, producers, consumers):
+    """producers 本で items 件 put し、consumers 本で取り出して task_done する。"""
+
+    async def produce(start):
+        for i in range(start, items, producers):
+            await order_queue.put({"id": f"ORD-{i:07d}", "amount": i})
+
+    async def consume():
+        while True:
+            item = await order_queue.get()
+            order_queue.task_done()
+            if item is None:
+                return
+
+    consumer_tasks = [asyncio.create_task(consume()) for _ in range(consumers)]
+    started = time.perf_counter()
+    await asyncio.gather(*(produce(p) for p in range(producers)))
+    await order_queue.join()
+    elapsed = time.perf_counter() - started
+
+    for _ in range(consumers):
+        await order_queue.put(None)
+    await asyncio.gather(*consumer_tasks)
+    return elapsed
+
+
+async def bench_memory(items, producers, consumers, maxsize):
+    return await run_pipeline(asyncio.Queue(maxsize=maxsize), items, producers, consumers), None
+
+
+async def bench_durable(items, producers, consumers, maxsize):
+    with tempfile.TemporaryDirectory() as tmp:
+        order_queue = await DurableQueue(Path(tmp) / "queue.sqlite3", maxsize=maxsize).start()
+        elapsed = await run_pipeline(order_queue, items, producers, consumers)
+        await order_queue.close()
+    return elapsed, order_queue.snapshot()
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    print(f"items={args.items} consumers={args.consumers} queue_max={args.queue_maxsize}")
+    print(f"{'backend':>8} {'producers':>9} {'items/s':>10} {'commits':>8} {'items/commit':>12}")
+
+    for producers in args.producers:
+        for name, bench in (("memory", bench_memory), ("durable", bench_durable)):
+            elapsed, snapshot = asyncio.run(
+                bench(args.items, producers, args.consumers, args.queue_maxsize)
+            )
+            commits = "-"
+            per_commit = "-"
+            if snapshot is not None:
+                commits = snapshot["commits"]
+                per_commit = f"{snapshot['committed_items'] / max(commits, 1):.1f}"
+            print(
+                f"{name:>8} {producers:>9} {args.items / elapsed:>10.0f} "
+                f"{commits:>8} {per_commit:>12}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,117 @@
+﻿# hedging.py の効果を測るベンチマークです。
+# 一部のレプリカが遅い疑似上流に同じリクエスト列を流し、
+# hedge なし / あり で p50 / p95 / p99 と上流への呼び出し数を比べます。
+#
+# 使い方:
+#   python bench_hedging.py --requests 2000 --slow-ratio 0.05
+
+import argparse
+import asyncio
+import random
+import time
+
+from hedging import Hedger, LatencyWindow
+from resilience import RetryBudget
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="hedged request の p99 / 追加負荷の比較")
+    parser.add_argument("--requests", type=int, default=2000, help="リクエスト数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同時に投げる数")
+    parser.add_argument("--limit", type=int, default=64, help="上流への同時呼び出し上限")
+    parser.add_argument("--fast-ms", type=float, default=5.0, help="通常レプリカの応答時間")
+    parser.add_argument("--slow-ms", type=float, default=80.0, help="遅いレプリカの応答時間")
+    parser.add_argument("--slow-ratio", type=float, default=0.05, help="遅いレプリカに当たる確率")
+    parser.add_argument("--budget-ratio", type=float, default=0.1, help="hedge 予算 (リクエスト比)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser
+
+
+def make_upstream(args, rng):
+    """呼ぶたびにレプリカを引き直す疑似上流。hedge は別レプリカに当たる想定。"""
+
+    async def upstream():
+        slow = rng.random() < args.slow_ratio
+        jitter = rng.uniform(0.8, 1.2)
+        await asyncio.sleep((args.slow_ms if slow else args.fast_ms) * jitter / 1000)
+        return "ok"
+
+    return upstream
+
+
+async def run(args, hedging):
+    rng = random.Random(args.seed)
+    upstream = make_upstream(args, rng)
+    limiter = asyncio.Semaphore(args.limit)
+    latencies = LatencyWindow(maxlen=args.requests)
+    hedger = Hedger(
+        limiter,
+        RetryBudget(ratio=args.budget_ratio, initial_tokens=0.0),
+        min_samples=50,
+        window=500,
+    )
+    upstream_calls = 0
+
+    async def plain_call():
+        nonlocal upstream_calls
+        async with limiter:
+            upstream_calls += 1
+            return await upstream()
+
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    async def client():
+        loop = asyncio.get_running_loop()
+        while not queue.empty():
+            queue.get_nowait()
+            started_at = loop.time()
+            if hedging:
+                await hedger.call(lambda hedge: upstream())
+            else:
+                await plain_call()
+            latencies.record(loop.time() - started_at)
+
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    wall = time.perf_counter() - wall_start
+
+    calls = hedger.upstream_calls if hedging else upstream_calls
+    return {
+        "p50": latencies.percentile(0.50),
+        "p95": latencies.percentile(0.95),
+        "p99": latencies.percentile(0.99),
+        "upstream_calls": calls,
+        "hedges": hedger.hedges,
+        "wall": wall,
+    }
+
+
+def show(label, result, requests):
+    print(
+        f"{label:<8} p50={result['p50'] * 1000:7.2f}ms p95={result['p95'] * 1000:7.2f}ms "
+        f"p99={result['p99'] * 1000:7.2f}ms upstream_calls={result['upstream_calls']:>6} "
+        f"(+{100.0 * (result['upstream_calls'] - requests) / requests:4.1f}%) "
+        f"wall={result['wall']:.2f}s"
+    )
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+
+    baseline = asyncio.run(run(args, hedging=False))
+    hedged = asyncio.run(run(args, hedging=True))
+
+    show("no_hedge", baseline, args.requests)
+    show("hedge", hedged, args.requests)
+    print(
+        f"p99 改善: {baseline['p99'] * 1000:.2f}ms -> {hedged['p99'] * 1000:.2f}ms "
+        f"({100.0 * (1 - hedged['p99'] / baseline['p99']):.1f}% 短縮) / "
+        f"追加負荷: +{100.0 * (hedged['upstream_calls'] - args.requests) / args.requests:.1f}% の呼び出し"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,111 @@
+﻿# script_10 の API 呼び出しを「1件ずつ」と「micro-batching」で比べるベンチマークです。
+#
+# - 注文を一気に流し (受付間隔 0)、worker を多めにして API 呼び出しを混ませる
+# - 上流への呼び出し回数 (= api_sem を取った回数) と orders/s、api 段階の p50/p99 を出す
+# - バッチ版は上流1回の所要時間が「API_OK_SECONDS + 件数 × --per-item」になる
+#
+# 使い方:
+#   python bench_micro_batch.py --orders 2000 --workers 64 --batch-size 4 16 64
+
+import argparse
+import asyncio
+import importlib
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from bench_pipeline_scale import synthetic_orders
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="API の micro-batching ベンチマーク")
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--api-concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02, help="上流1回の基本の所要時間 (秒)")
+    parser.add_argument("--per-item", type=float, default=0.001, help="バッチ1件あたりの追加時間 (秒)")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--window", type=float, default=0.005, help="バッチを待つ最大秒数")
+    return parser
+
+
+def run_one(args, batch_size):
+    """子プロセスで1設定ぶん実行する。batch_size=None なら1件ずつ。"""
+    module = importlib.import_module("script_10_practical_pipeline")
+    module.ORDERS_SOURCE = None
+    module.ORDERS = synthetic_orders(args.orders)
+    module.INGEST_INTERVAL_SECONDS = 0.0
+    module.API_OK_SECONDS = args.latency
+    module.API_BATCH_PER_ITEM_SECONDS = args.per_item
+    module.WORKER_MIN = args.workers
+    module.WORKER_MAX = args.workers
+    module.QUEUE_MAXSIZE = args.workers
+    module.API_CONCURRENCY = args.api_concurrency
+    module.ADAPTIVE_CONCURRENCY = False
+    module.HEDGE_ENABLED = False
+    module.LOG_BACKEND = "off"
+    module.STATS_REPORT_INTERVAL_SECONDS = 3600.0
+    module.API_BATCH_ENABLED = batch_size is not None
+    module.API_BATCH_MAX_SIZE = batch_size or 1
+    module.API_BATCH_WINDOW_SECONDS = args.window
+
+    # 上流の呼び出し回数を数える (どちらの経路も api_sem を1回取って1回呼ぶ)
+    calls = {"upstream": 0}
+    single, batch = module.fake_external_api, module.fake_external_api_batch
+
+    async def counted_single(*call_args):
+        calls["upstream"] += 1
+        return await single(*call_args)
+
+    async def counted_batch(*call_args):
+        calls["upstream"] += 1
+        return await batch(*call_args)
+
+    module.fake_external_api = counted_single
+    module.fake_external_api_batch = counted_batch
+
+    with tempfile.TemporaryDirectory() as tmp:
+        module.DB_PATH = Path(tmp) / "orders.sqlite3"
+        start = time.perf_counter()
+        snapshot = asyncio.run(module.main())
+        elapsed = time.perf_counter() - start
+
+    return {
+        "elapsed": elapsed,
+        "upstream": calls["upstream"],
+        "success": snapshot["counters"]["success"],
+        "api": snapshot["latency"]["api"],
+    }
+
+
+def run_isolated(*args):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_one, *args).result()
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    print(
+        f"orders={args.orders} workers={args.workers} api_concurrency={args.api_concurrency} "
+        f"latency={args.latency}s per_item={args.per_item}s window={args.window}s"
+    )
+    print(
+        f"{'batch':>6} {'orders/s':>9} {'upstream':>9} {'orders/call':>11} "
+        f"{'api_p50':>8} {'api_p99':>8} {'ok':>6}"
+    )
+    for batch_size in [None, *args.batch_size]:
+        result = run_isolated(args, batch_size)
+        api = result["api"]
+        print(
+            f"{batch_size or '-':>6} {args.orders / result['elapsed']:>9.0f} {result['upstream']:>9} "
+            f"{args.orders / result['upstream']:>11.1f} {api['p50']:>8.3f} {api['p99']:>8.3f} "
+            f"{result['success']:>6}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,168 @@
+﻿# script_10 / script_11 のパイプラインに大量の合成データ (10万〜100万件) を流し、
+# worker / queue まわりのオーバーヘッドを測るベンチマークです。
+#
+# - 待ち時間 (API / スキャン / 受付間隔など) はすべて 0 (または --latency 秒) にする
+#   -> 残る時間はほぼ「イベントループ + queue + worker の処理コスト」
+# - worker 数と QUEUE_MAXSIZE の組み合わせごとに orders/sec・1件あたりの時間・ピークメモリを出す
+# - 設定ごとに新しいプロセスで実行するので、前の設定の影響を受けない
+#
+# 使い方:
+#   python bench_pipeline_scale.py --orders 100000 --workers 1 8 64 --queue-maxsize 1 64 1024
+#   python bench_pipeline_scale.py --pipeline 11 --orders 100000
+
+import argparse
+import asyncio
+import importlib
+import itertools
+import multiprocessing
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+PIPELINES = {
+    "10": "script_10_practical_pipeline",
+    "11": "script_11_image_upload_queue",
+}
+
+# 「待ち時間」を表す設定値。timeout 系は 0 にすると即 timeout になるので含めない
+LATENCY_SETTINGS = {
+    "10": ("INGEST_INTERVAL_SECONDS", "API_OK_SECONDS", "API_ERROR_SECONDS"),
+    "11": (
+        "INGEST_INTERVAL_SECONDS",
+        "VALIDATION_SECONDS",
+        "SCAN_OK_SECONDS",
+        "SCAN_ERROR_SECONDS",
+        "UPLOAD_SECONDS",
+    ),
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="async パイプラインの大量件数ベンチマーク")
+    parser.add_argument("--pipeline", choices=sorted(PIPELINES), default="10")
+    parser.add_argument("--orders", type=int, default=100_000, help="合成データの件数")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--queue-maxsize", type=int, nargs="+", default=[1, 64, 1024])
+    parser.add_argument("--latency", type=float, default=0.0, help="各待ち時間 (秒)")
+    parser.add_argument(
+        "--thumbnail-executor",
+        default="to_thread",
+        help="script_11 のサムネイル実行場所 (to_thread / thread / process)",
+    )
+    parser.add_argument("--no-memory", action="store_true", help="ピークメモリを測らない")
+    return parser
+
+
+def synthetic_orders(count):
+    """script_10 用の合成注文。generator なので件数が増えてもメモリは増えない。"""
+    for i in range(count):
+        yield {
+            "id": f"ORD-{i:07d}",
+            "customer": f"CUST-{i % 1000:04d}",
+            "amount": 50000 + (i * 7919) % 300000,
+            "plan": ["ok"],
+        }
+
+
+def synthetic_uploads(count):
+    """script_11 用の合成アップロード要求。"""
+    for i in range(count):
+        yield {
+            "file_id": f"IMG-{i:07d}",
+            "user": f"user{i % 1000:04d}",
+            "size_mb": 1.0 + i % 20,
+            "scan_plan": ["ok"],
+        }
+
+
+def configure(module, pipeline, orders, workers, maxsize, latency, tmp, thumbnail_executor):
+    """モジュールの設定値をベンチマーク用に書き換える。"""
+    for name in LATENCY_SETTINGS[pipeline]:
+        setattr(module, name, latency)
+
+    # worker 数は固定にする (自動増減の影響を除く)
+    module.WORKER_MIN = workers
+    module.WORKER_MAX = workers
+    module.QUEUE_MAXSIZE = maxsize
+    module.LOG_BACKEND = "off"
+    module.HEDGE_ENABLED = False
+    module.STATS_REPORT_INTERVAL_SECONDS = 3600.0
+    # 上流の同時実行上限は worker 数にそろえ、worker/queue のコストだけが見えるようにする
+    module.ADAPTIVE_CONCURRENCY = False
+
+    if pipeline == "10":
+        module.ORDERS = synthetic_orders(orders)
+        module.API_CONCURRENCY = workers
+        module.DB_PATH = Path(tmp) / "orders.sqlite3"
+        # 保存と queue は本番と同じ (batch writer + fair queue) にそろえ、既定値に左右されないようにする
+        # writer の時間待ち (max_wait) は 0: 件数が batch_size で割り切れないと、
+        # 最後のバッチが max_wait 秒待ってから commit され、その待ちが結果に混ざるため
+        module.SAVE_MODE = "batch"
+        module.WRITE_BATCH_MAX_WAIT_SECONDS = 0.0
+        module.QUEUE_BACKEND = "fair"
+        module.IDEMPOTENCY_PATH = None
+    else:
+        module.UPLOAD_REQUESTS = synthetic_uploads(orders)
+        module.SCAN_CONCURRENCY = workers
+        # worker 数の効果を見るため、段階分割ではなく 1 worker が全段階を行う形で測る
+        module.PIPELINE_MODE = "single"
+        # アップロードは待ち時間だけの疑似にする (合成データの件数ぶんファイルを書かない)
+        module.UPLOAD_MODE = "single"
+        module.THUMBNAIL_EXECUTOR = thumbnail_executor
+        module.THUMBNAIL_EXECUTOR_WORKERS = workers
+        module.THUMBNAIL_SOURCE_WIDTH = 8
+        module.THUMBNAIL_SOURCE_HEIGHT = 8
+
+
+def run_one(pipeline, orders, workers, maxsize, latency, thumbnail_executor, trace_memory):
+    """子プロセスで1設定ぶん実行する。"""
+    module = importlib.import_module(PIPELINES[pipeline])
+    with tempfile.TemporaryDirectory() as tmp:
+        configure(module, pipeline, orders, workers, maxsize, latency, tmp, thumbnail_executor)
+
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        snapshot = asyncio.run(module.main())
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    return {"elapsed": elapsed, "success": snapshot["counters"]["success"], "peak": peak}
+
+
+def run_isolated(*args):
+    # spawn で毎回まっさらなプロセスを使う (fork だと親のメモリを引き継ぐため)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_one, *args).result()
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    print(
+        f"pipeline={args.pipeline} orders={args.orders} latency={args.latency}s "
+        f"(peak_mem は tracemalloc で別実行して計測)"
+    )
+    print(f"{'workers':>7} {'queue_max':>9} {'orders/s':>10} {'us/order':>9} {'peak_MB':>8} {'ok':>8}")
+
+    for workers, maxsize in itertools.product(args.workers, args.queue_maxsize):
+        common = (args.pipeline, args.orders, workers, maxsize, args.latency, args.thumbnail_executor)
+        timing = run_isolated(*common, False)
+        peak_mb = "-"
+        if not args.no_memory:
+            peak_mb = f"{run_isolated(*common, True)['peak'] / 1024 / 1024:.1f}"
+
+        print(
+            f"{workers:>7} {maxsize:>9} {args.orders / timing['elapsed']:>10.0f} "
+            f"{timing['elapsed'] / args.orders * 1e6:>9.1f} {peak_mb:>8} {timing['success']:>8}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,92 @@
+﻿# script_10 を SHARDS=1..N のプロセス数で動かし、orders/s がコア数に応じて伸びるかを見るベンチマークです。
+#
+# - 待ち時間はすべて 0 (または --latency 秒) にして、1件あたりのループの処理コストを限界にする
+#   -> 1プロセスだと1コアで頭打ちになり、shard を増やすとコア数までは伸びるはず
+# - 時間にはプロセスの起動 (spawn) と、最後の DB の取り込みも含む (件数が少ないと起動時間が目立つ)
+# - writer の時間待ち (WRITE_BATCH_MAX_WAIT_SECONDS) は configure で 0 にしてあり、測る時間には入らない
+#   (設定値は shard_settings で各 shard にも渡る)
+# - imbalance は「一番多い shard の件数 / 平均」。1.0 に近いほど均等に振り分けられている
+#
+# 使い方:
+#   python bench_sharded_pipeline.py --orders 100000 --shards 1 2 4 8
+
+import argparse
+import asyncio
+import importlib
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from bench_pipeline_scale import configure, synthetic_orders
+from sharded_runner import shard_for
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="script_10 のマルチプロセス (shard) ベンチマーク")
+    parser.add_argument("--orders", type=int, default=100_000)
+    parser.add_argument(
+        "--shards",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, os.cpu_count() or 1}),
+        help="比べるプロセス数",
+    )
+    parser.add_argument("--workers", type=int, default=8, help="shard ごとの worker 数")
+    parser.add_argument("--queue-maxsize", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.0, help="各待ち時間 (秒)")
+    parser.add_argument("--batch-size", type=int, default=64, help="親 -> shard へ送る件数")
+    return parser
+
+
+def run_one(args, shards):
+    """子プロセスで1設定ぶん実行する (shards > 1 ならそこからさらに shard を起動する)。"""
+    module = importlib.import_module("script_10_practical_pipeline")
+    with tempfile.TemporaryDirectory() as tmp:
+        configure(
+            module, "10", args.orders, args.workers, args.queue_maxsize, args.latency, tmp, None
+        )
+        module.SHARDS = shards
+        module.SHARD_BATCH_SIZE = args.batch_size
+        start = time.perf_counter()
+        snapshot = asyncio.run(module.main())
+        elapsed = time.perf_counter() - start
+    return {"elapsed": elapsed, "success": snapshot["counters"]["success"]}
+
+
+def imbalance(orders, shards, key):
+    """一番多い shard の件数 / 平均。振り分けは決まった値なので、実行せずに数えられる。"""
+    counts = Counter(shard_for(order[key], shards) for order in synthetic_orders(orders))
+    return max(counts.values()) / (orders / shards)
+
+
+def run_isolated(*args):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_one, *args).result()
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    print(
+        f"orders={args.orders} workers/shard={args.workers} latency={args.latency}s "
+        f"cpu_count={os.cpu_count()}"
+    )
+    print(f"{'shards':>6} {'orders/s':>9} {'speedup':>8} {'imbalance':>9} {'ok':>8}")
+    baseline = None
+    for shards in args.shards:
+        result = run_isolated(args, shards)
+        rate = args.orders / result["elapsed"]
+        baseline = baseline or rate
+        skew = imbalance(args.orders, shards, "customer")
+        print(
+            f"{shards:>6} {rate:>9.0f} {rate / baseline:>7.2f}x {skew:>9.2f} "
+            f"{result['success']:>8}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,141 @@
+﻿# script_11 の「1 worker が全段階」(single) と「段階ごとに worker を分ける」(stages) の
+# スループット比較です。
+#
+# - 待ち時間の設定値 (*_SECONDS) は --time-scale 倍に縮めて、同じ比率のまま短時間で回す
+# - スキャンは一部を timeout / error にして、scan 段階が詰まる状況を作る
+# - single の worker 数は既定で stages の worker 合計にそろえる (同じ人数での比較)
+# - stages は段階ごとの稼働率 (busy / blocked) も出す -> どこがボトルネックか
+#
+# 使い方:
+#   python bench_stage_pipeline.py --uploads 200 --time-scale 0.05
+#   python bench_stage_pipeline.py --stage-workers 1 6 2 2
+#
+# 注意: thumbnail を "process" にすると子プロセスは設定を読み直すため、
+# --thumbnail-size が効かない (既定は "thread")。
+
+import argparse
+import asyncio
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from stage_pipeline import format_utilization
+
+STAGE_NAMES = ("validate", "scan", "thumbnail", "upload")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="single と stages のスループット比較")
+    parser.add_argument("--uploads", type=int, default=200, help="アップロード要求の件数")
+    parser.add_argument("--time-scale", type=float, default=0.05, help="待ち時間の倍率")
+    parser.add_argument(
+        "--stage-workers",
+        type=int,
+        nargs=4,
+        default=[2, 3, 1, 3],
+        metavar=("VALIDATE", "SCAN", "THUMBNAIL", "UPLOAD"),
+    )
+    parser.add_argument("--stage-queue-maxsize", type=int, default=4)
+    parser.add_argument("--single-workers", type=int, default=None, help="既定: stages の合計")
+    parser.add_argument("--thumbnail-executor", default="thread")
+    parser.add_argument("--thumbnail-size", type=int, default=256, help="元画像の1辺 (px)")
+    return parser
+
+
+def synthetic_uploads(count):
+    """10件に1件は timeout、10件に1件は error から始まるスキャン。"""
+    for i in range(count):
+        if i % 10 == 3:
+            plan = ["timeout", "ok"]
+        elif i % 10 == 7:
+            plan = ["error", "ok"]
+        else:
+            plan = ["ok"]
+        yield {"file_id": f"IMG-{i:05d}", "user": f"user{i % 50:02d}", "size_mb": 5.0, "scan_plan": plan}
+
+
+def run_one(mode, args, single_workers):
+    """子プロセスで1モードぶん実行する。"""
+    module = importlib.import_module("script_11_image_upload_queue")
+    for name in dir(module):
+        value = getattr(module, name)
+        if name.endswith("_SECONDS") and isinstance(value, (int, float)):
+            setattr(module, name, value * args.time_scale)
+    # 受付は詰まらせない (パイプライン側の処理能力を測る)
+    module.INGEST_INTERVAL_SECONDS = 0.0
+    module.UPLOAD_REQUESTS = synthetic_uploads(args.uploads)
+    module.LOG_BACKEND = "off"
+    module.STATS_REPORT_INTERVAL_SECONDS = 3600.0
+    module.HEDGE_ENABLED = False
+    # アップロードは待ち時間だけの疑似にする (合成データの件数ぶんファイルを書かない)
+    module.UPLOAD_MODE = "single"
+    module.THUMBNAIL_EXECUTOR = args.thumbnail_executor
+    module.THUMBNAIL_SOURCE_WIDTH = args.thumbnail_size
+    module.THUMBNAIL_SOURCE_HEIGHT = args.thumbnail_size
+
+    module.PIPELINE_MODE = mode
+    module.STAGE_WORKERS = dict(zip(STAGE_NAMES, args.stage_workers))
+    module.STAGE_QUEUE_MAXSIZE = {name: args.stage_queue_maxsize for name in STAGE_NAMES[1:]}
+    module.QUEUE_MAXSIZE = args.stage_queue_maxsize
+    # single は worker 数を固定 (自動増減なし) にして人数をそろえる
+    module.WORKER_MIN = single_workers
+    module.WORKER_MAX = single_workers
+    module.THUMBNAIL_EXECUTOR_WORKERS = single_workers
+
+    # 稼働率は main() の中でしか取れないので、組み立て関数を包んで pipeline を捕まえる
+    captured = {}
+    build = module.build_stage_pipeline
+
+    def build_and_capture(*build_args):
+        captured["pipeline"] = build(*build_args)
+        return captured["pipeline"]
+
+    module.build_stage_pipeline = build_and_capture
+
+    async def timed_main():
+        started = asyncio.get_running_loop().time()
+        snapshot = await module.main()
+        elapsed = asyncio.get_running_loop().time() - started
+        utilization = None
+        if "pipeline" in captured:
+            utilization = captured["pipeline"].utilization()
+        return snapshot, elapsed, utilization
+
+    snapshot, elapsed, utilization = asyncio.run(timed_main())
+    return {"elapsed": elapsed, "counters": snapshot["counters"], "utilization": utilization}
+
+
+def run_isolated(*args):
+    # 設定の書き換えが混ざらないよう、モードごとに新しいプロセスで実行する
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_one, *args).result()
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    single_workers = args.single_workers or sum(args.stage_workers)
+    print(
+        f"uploads={args.uploads} time_scale={args.time_scale} "
+        f"stage_workers={dict(zip(STAGE_NAMES, args.stage_workers))} single_workers={single_workers}"
+    )
+    print(f"{'mode':>7} {'elapsed_s':>9} {'uploads/s':>9} {'success':>8} {'failed':>7}")
+
+    results = {}
+    for mode in ("single", "stages"):
+        result = results[mode] = run_isolated(mode, args, single_workers)
+        counters = result["counters"]
+        print(
+            f"{mode:>7} {result['elapsed']:>9.2f} {args.uploads / result['elapsed']:>9.1f} "
+            f"{counters['success']:>8} {counters['failed']:>7}"
+        )
+
+    print(f"\nstages / single = {results['single']['elapsed'] / results['stages']['elapsed']:.2f}x")
+    print("\nstages の段階ごとの稼働率:")
+    for line in format_utilization(results["stages"]["utilization"]):
+        print(f"  {line}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,73 @@
+﻿# サムネイル生成 (純Pythonの縮小処理) を thread / process で実行し、
+# worker 数を増やしたときのスループットを比べるベンチマークです。
+# thread は GIL のせいで worker を増やしても伸びず、process はコア数まで伸びるはずです。
+#
+# 使い方:
+#   python bench_thumbnail_executor.py --images 24 --workers 1 2 4
+
+import argparse
+import asyncio
+import os
+import time
+
+from stage_executor import StageExecutor
+from thumbnail import generate_thumbnail
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="thread / process の thumbnail スループット比較")
+    parser.add_argument("--images", type=int, default=24, help="生成するサムネイル数")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, os.cpu_count() or 1],
+        help="試す worker 数 (複数指定可)",
+    )
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=960)
+    parser.add_argument("--factor", type=int, default=8)
+    return parser
+
+
+async def run(kind, workers, args):
+    # pipeline と同じく「worker 数 = 同時に投げる数 = executor の大きさ」にそろえる
+    executor = StageExecutor(kind, max_workers=workers, name="bench")
+    try:
+        # プロセス起動コストを測定から外すため、先に1周温めておく
+        await asyncio.gather(
+            *(executor.run(generate_thumbnail, "warmup", 16, 16, 8) for _ in range(workers))
+        )
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                executor.run(generate_thumbnail, f"IMG-{i:04d}", args.width, args.height, args.factor)
+                for i in range(args.images)
+            )
+        )
+        return time.perf_counter() - start
+    finally:
+        # shutdown(wait=True) は worker の終了を待つので、ループを止めないようスレッドで呼ぶ
+        await asyncio.to_thread(executor.shutdown)
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    print(f"cpu_count={os.cpu_count()} images={args.images} size={args.width}x{args.height}")
+
+    for workers in sorted(set(args.workers)):
+        results = {kind: asyncio.run(run(kind, workers, args)) for kind in ("thread", "process")}
+        print(
+            f"workers={workers:>2} "
+            + " ".join(
+                f"{kind}={args.images / elapsed:6.2f} img/s ({elapsed:6.2f}s)"
+                for kind, elapsed in results.items()
+            )
+            + f" process/thread={results['thread'] / results['process']:.2f}x"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
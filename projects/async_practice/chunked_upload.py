@@ -0,0 +1,266 @@
+﻿# 大きいファイルを part (チャンク) に分けて並行に送る「マルチパートアップロード」です。
+# script_11 から使います。
+# 学べること:
+# 1) 1ファイルを part に分け、part ごとに並行で送る (1ファイルでも回線を複数本使える)
+# 2) 失敗した part だけを送り直す。送り終わった part はストレージ側に残るので、
+#    途中で止まったファイルも、次はまだ無い part だけを送れば済む (再開)
+# 3) part の同時送信数は全ファイル合計で上限を決める (SizeAwareSlots)
+#    空きを待つ順番は「残りサイズが小さいファイル優先」にして、大きいファイルが枠を埋めても
+#    後から来た小さいファイルが先に終わるようにする
+#
+# 使い方:
+#     storage = LocalDirectoryStorage("storage")
+#     uploader = ChunkedUploader(storage, part_size=2 * MB, max_concurrency=4)
+#     path = await uploader.upload("IMG-001.jpg", size, read_part)
+#
+# read_part(offset, length) はファイルの該当部分の bytes を返す同期関数 (to_thread の中で呼ぶ)。
+#
+# 注意:
+# - LocalDirectoryStorage は S3 などのマルチパート API の代わり (ローカルのディレクトリに書く)
+# - 途中の part は root/.uploads/<key>/ に置かれ、complete で1ファイルにまとめてから消す
+
+import asyncio
+import heapq
+import itertools
+import os
+import shutil
+from pathlib import Path
+
+from resilience import backoff_delay
+from tracing import Tracer
+
+MB = 1024 * 1024
+
+
+class UploadFailed(Exception):
+    """再送しても送れない part があった。送り終わった part は残っているので、後で再開できる。"""
+
+
+class LocalDirectoryStorage:
+    """
+    マルチパートアップロードの API を、ローカルのディレクトリで置き換えたもの。
+
+    - create_upload(key): upload_id を返す。途中の同じ key があれば同じ id (= 続きから)
+    - list_parts(upload_id): 送り終わった part 番号 -> サイズ
+    - upload_part(upload_id, part_number, data): part を1つ保存する
+    - complete(upload_id, part_count): part をつなげて1ファイルにし、保存先のパスを返す
+    - seconds_per_mb: 送信にかかる時間の疑似 (1MB あたりの秒数)
+    - inject_failures(key, {part_number: 回数}): その part を指定回数だけ一時エラーにする (デモ用)
+
+    ファイル操作はブロッキングなので to_thread で行う。
+    """
+
+    def __init__(self, root, seconds_per_mb=0.0):
+        self.root = Path(root)
+        self.seconds_per_mb = seconds_per_mb
+        self._failures = {}
+
+    def inject_failures(self, key, failures):
+        for part_number, count in failures.items():
+            self._failures[(key, int(part_number))] = count
+
+    async def create_upload(self, key):
+        await asyncio.to_thread(self._part_dir(key).mkdir, parents=True, exist_ok=True)
+        return key
+
+    async def list_parts(self, upload_id):
+        return await asyncio.to_thread(self._list_parts, upload_id)
+
+    async def upload_part(self, upload_id, part_number, data):
+        await asyncio.sleep(len(data) / MB * self.seconds_per_mb)
+        remaining = self._failures.get((upload_id, part_number), 0)
+        if remaining:
+            self._failures[(upload_id, part_number)] = remaining - 1
+            raise ConnectionError(f"storage temporary error: part {part_number}")
+        await asyncio.to_thread(self._write_part, upload_id, part_number, data)
+
+    async def complete(self, upload_id, part_count):
+        return await asyncio.to_thread(self._complete, upload_id, part_count)
+
+    # ---- ブロッキング処理 (to_thread から呼ぶ) ----
+
+    def _part_dir(self, upload_id):
+        return self.root / ".uploads" / upload_id
+
+    def _part_path(self, upload_id, part_number):
+        return self._part_dir(upload_id) / f"part-{part_number:05d}"
+
+    def _list_parts(self, upload_id):
+        parts = {}
+        for path in self._part_dir(upload_id).glob("part-*"):
+            if path.suffix == ".tmp":
+                continue
+            parts[int(path.name.split("-")[1])] = path.stat().st_size
+        return parts
+
+    def _write_part(self, upload_id, part_number, data):
+        # 書きかけの part が「送り終わった」に見えないよう、別名で書いてから置き換える
+        path = self._part_path(upload_id, part_number)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _complete(self, upload_id, part_count):
+        target = self.root / upload_id
+        tmp = target.with_name(target.name + ".tmp")
+        with open(tmp, "wb") as out:
+            for part_number in range(1, part_count + 1):
+                with open(self._part_path(upload_id, part_number), "rb") as part:
+                    shutil.copyfileobj(part, out)
+        os.replace(tmp, target)
+        shutil.rmtree(self._part_dir(upload_id))
+        return target
+
+
+class SizeAwareSlots:
+    """
+    同時実行の上限。空きを待つ人は「締め切り」の早い順に通す。
+
+    締め切り = 並んだ時刻 + 残りサイズ(MB) × seconds_per_mb
+    -> 小さいファイルほど先に通るが、大きいファイルも待った分だけ前に進むので、ずっと後回しにはならない
+    """
+
+    def __init__(self, limit, seconds_per_mb=0.5):
+        self.limit = limit
+        self.seconds_per_mb = seconds_per_mb
+        self._in_use = 0
+        self._waiters = []
+        self._order = itertools.count()
+
+    async def acquire(self, size):
+        if self._in_use < self.limit and not self._waiters:
+            self._in_use += 1
+            return
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        deadline = loop.time() + size / MB * self.seconds_per_mb
+        heapq.heappush(self._waiters, (deadline, next(self._order), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 枠をもらった直後にキャンセルされた -> 返しておく
+                self.release()
+            raise
+
+    def release(self):
+        self._in_use -= 1
+        while self._waiters and self._in_use < self.limit:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self._in_use += 1
+                waiter.set_result(None)
+
+    def snapshot(self):
+        return {"limit": self.limit, "in_use": self._in_use, "waiting": len(self._waiters)}
+
+
+class ChunkedUploader:
+    """
+    ファイルを part_size ごとに分けて storage に送る。
+
+    - max_concurrency: 全ファイル合計での part の同時送信数
+    - max_retries: part ごとの再送回数 (part 単位で数える。ファイル全体はやり直さない)
+    - backoff_base / backoff_max: 再送前に待つ秒数 (full jitter)。待っている間は枠を返す
+    - size_priority_seconds_per_mb: SizeAwareSlots の seconds_per_mb
+    - on_retry(key, part_number, attempt, exc): ログ用 (任意)
+    - tracer: tracing.Tracer を渡すと part ごとに span を記録する (任意)
+    """
+
+    def __init__(
+        self,
+        storage,
+        part_size=8 * MB,
+        max_concurrency=4,
+        max_retries=3,
+        backoff_base=0.2,
+        backoff_max=2.0,
+        size_priority_seconds_per_mb=0.5,
+        on_retry=None,
+        tracer=None,
+    ):
+        self.storage = storage
+        self.part_size = part_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.slots = SizeAwareSlots(max_concurrency, seconds_per_mb=size_priority_seconds_per_mb)
+        self.on_retry = on_retry
+        self.tracer = tracer or Tracer(enabled=False)
+
+        # 集計
+        self.files = 0
+        self.parts_uploaded = 0
+        self.parts_resumed = 0
+        self.part_retries = 0
+        self.bytes_uploaded = 0
+
+    async def upload(self, key, size, read_part):
+        """key のファイル (size バイト) を送り、保存先を返す。送り終わった part は送らない。"""
+        upload_id = await self.storage.create_upload(key)
+        done = await self.storage.list_parts(upload_id)
+
+        parts = []
+        for index, offset in enumerate(range(0, max(size, 1), self.part_size)):
+            part_number = index + 1
+            length = min(self.part_size, size - offset)
+            if done.get(part_number) == length:
+                self.parts_resumed += 1
+                continue
+            parts.append((part_number, offset, length))
+        part_count = max(1, -(-size // self.part_size))
+
+        # このファイルの残りサイズ。part を送るたびに減り、枠の取り合いでの順番に効く
+        remaining = [sum(length for _, _, length in parts)]
+        try:
+            async with asyncio.TaskGroup() as group:
+                for part_number, offset, length in parts:
+                    group.create_task(
+                        self._upload_part(
+                            key, upload_id, part_number, offset, length, read_part, remaining
+                        )
+                    )
+        except* UploadFailed as failed:
+            # どれか1つの part が再送しても失敗 -> 残りの part は止める (送れた分は残る)
+            raise failed.exceptions[0] from None
+
+        self.files += 1
+        return await self.storage.complete(upload_id, part_count)
+
+    def snapshot(self):
+        return {
+            "files": self.files,
+            "parts_uploaded": self.parts_uploaded,
+            "parts_resumed": self.parts_resumed,
+            "part_retries": self.part_retries,
+            "mb_uploaded": round(self.bytes_uploaded / MB, 1),
+            **self.slots.snapshot(),
+        }
+
+    async def _upload_part(self, key, upload_id, part_number, offset, length, read_part, remaining):
+        for attempt in range(1, self.max_retries + 2):
+            await self.slots.acquire(remaining[0])
+            try:
+                with self.tracer.span("upload_part", part=part_number, attempt=attempt):
+                    data = await asyncio.to_thread(read_part, offset, length)
+                    await self.storage.upload_part(upload_id, part_number, data)
+            except (OSError, asyncio.TimeoutError) as exc:
+                if attempt > self.max_retries:
+                    raise UploadFailed(
+                        f"{key} part {part_number} failed after {attempt} attempts: {exc}"
+                    ) from exc
+                self.part_retries += 1
+                if self.on_retry is not None:
+                    self.on_retry(key, part_number, attempt, exc)
+            else:
+                remaining[0] -= length
+                self.parts_uploaded += 1
+                self.bytes_uploaded += length
+                return
+            finally:
+                self.slots.release()
+
+            # 待っている間は枠を返しておく (他のファイルの part を先に送れる)
+            delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+            with self.tracer.span("backoff", part=part_number, attempt=attempt):
+                await asyncio.sleep(delay)
@@ -0,0 +1,206 @@
+﻿# 再起動しても消えない queue です (ローカル SQLite に保存)。
+# asyncio.Queue と同じ put / get / task_done / join / qsize で使えます。
+#
+# 学べること:
+# 1) put は「ディスクに書けた (commit した)」ところで初めて戻る -> 受付済みの注文は落ちても消えない
+# 2) group commit: 同時に来た put をまとめて1回の commit (= 1回の fsync) にする
+#    commit 中に届いた put は次の commit にまとまるので、件数が増えても fsync はあまり増えない
+# 3) task_done で「処理済み」を記録し、起動時には未処理の分だけを読み直して再投入する
+#
+# 注意:
+# - item は JSON にできる値 (dict / list / str / 数値) に限る
+# - None (終了シグナル) は保存しない。再起動後に stop signal が復活しないようにするため
+# - task_done は get と同じ Task から呼ぶこと (どの item の完了かを Task で見分けるため)
+#   完了が別の場所 (commit のコールバックなど) で決まるときは、get した Task で
+#   detach_task_done() を呼び、返ってきた関数を完了したときに呼ぶ
+# - 処理済みの記録 (ack) は少し遅れて書くので、落ちる直前の分はもう一度処理されることがある
+#   (at-least-once)
+
+import asyncio
+import functools
+import json
+import sqlite3
+
+
+class _SqliteQueueStore:
+    """DurableQueue の保存先。メソッドはすべてブロッキングなので to_thread から呼ぶ。"""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        # WAL + synchronous=FULL: commit ごとに WAL を fsync する (= commit したら消えない)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue_items ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " payload TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def load_pending(self):
+        return self._conn.execute("SELECT seq, payload FROM queue_items ORDER BY seq").fetchall()
+
+    def commit(self, payloads, acked_seqs):
+        """追加分と処理済み分を1トランザクションで書き、追加分の seq を返す。"""
+        seqs = []
+        with self._conn:
+            for payload in payloads:
+                cursor = self._conn.execute(
+                    "INSERT INTO queue_items (payload) VALUES (?)", (payload,)
+                )
+                seqs.append(cursor.lastrowid)
+            if acked_seqs:
+                self._conn.executemany(
+                    "DELETE FROM queue_items WHERE seq = ?", [(seq,) for seq in acked_seqs]
+                )
+        return seqs
+
+    def close(self):
+        self._conn.close()
+
+
+class DurableQueue:
+    """
+    SQLite に保存する asyncio.Queue 互換の queue。
+
+    - start(): 未処理の item を読み込んで再投入し、commit 用 Task を起動する
+    - close(): 残っている ack を書いてから閉じる
+    - on_replay(item): 再投入する item を変換したいとき用 (受付時刻の付け直しなど, 任意)
+    - ack_flush_interval: put がなくても、この秒数ごとに溜まった ack を書く
+    """
+
+    def __init__(self, path, maxsize=0, on_replay=None, ack_flush_interval=0.5, ack_batch=256):
+        self.path = path
+        self.on_replay = on_replay
+        self.ack_flush_interval = ack_flush_interval
+        self.ack_batch = ack_batch
+
+        self._store = _SqliteQueueStore(path)
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._pending_puts = []
+        self._pending_acks = []
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._committer = None
+        self._replayer = None
+        # Task -> get で渡した item の seq (task_done でどれが終わったか分かるように)
+        self._in_progress = {}
+
+        # 集計
+        self.replayed = 0
+        self.commits = 0
+        self.committed_items = 0
+        self.acked_items = 0
+
+    # ---- 起動 / 停止 ----
+
+    async def start(self):
+        rows = await asyncio.to_thread(self._store.load_pending)
+        self.replayed = len(rows)
+        self._committer = asyncio.create_task(self._commit_loop())
+        self._replayer = asyncio.create_task(self._replay(rows))
+        return self
+
+    async def close(self):
+        self._closing = True
+        self._wakeup.set()
+        await self._committer
+        await asyncio.to_thread(self._store.close)
+
+    # ---- asyncio.Queue と同じ入口 ----
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    async def put(self, item):
+        if item is None:
+            # 終了シグナルは保存しない
+            await self._queue.put((None, None))
+            return
+
+        # commit されるまで待つ。まとめて書かれるので fsync は put の件数より少ない
+        done = asyncio.get_running_loop().create_future()
+        self._pending_puts.append((json.dumps(item, ensure_ascii=False), done))
+        self._wakeup.set()
+        seq = await done
+
+        # ここから先はメモリ上の queue。maxsize を超えるならここで待つ (背圧)
+        await self._queue.put((seq, item))
+
+    async def get(self):
+        seq, item = await self._queue.get()
+        if seq is not None:
+            self._in_progress[asyncio.current_task()] = seq
+        return item
+
+    def task_done(self):
+        self._ack(self._in_progress.pop(asyncio.current_task(), None))
+
+    def detach_task_done(self):
+        """今の Task が get した item の task_done を、あとでどこからでも呼べる関数にして返す。"""
+        return functools.partial(self._ack, self._in_progress.pop(asyncio.current_task(), None))
+
+    def _ack(self, seq):
+        if seq is not None:
+            # ack は急がない: put の commit に相乗りするか、溜まったら書く
+            self._pending_acks.append(seq)
+            if len(self._pending_acks) >= self.ack_batch:
+                self._wakeup.set()
+        self._queue.task_done()
+
+    async def join(self):
+        # 再投入がまだ途中なら、それが全部 queue に入るのを先に待つ
+        if self._replayer is not None:
+            await self._replayer
+        await self._queue.join()
+
+    def snapshot(self):
+        return {
+            "replayed": self.replayed,
+            "commits": self.commits,
+            "committed_items": self.committed_items,
+            "acked_items": self.acked_items,
+            "qsize": self.qsize(),
+        }
+
+    # ---- 内部処理 ----
+
+    async def _replay(self, rows):
+        for seq, payload in rows:
+            item = json.loads(payload)
+            if self.on_replay is not None:
+                item = self.on_replay(item)
+            await self._queue.put((seq, item))
+
+    async def _commit_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.ack_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            # ここで取り出した分が1回の commit にまとまる
+            puts, self._pending_puts = self._pending_puts, []
+            acks, self._pending_acks = self._pending_acks, []
+
+            if puts or acks:
+                try:
+                    seqs = await asyncio.to_thread(
+                        self._store.commit, [payload for payload, _ in puts], acks
+                    )
+                except Exception as exc:
+                    # 書けなかった put は呼び出し側に例外を返す (受付失敗)
+                    for _, done in puts:
+                        if not done.done():
+                            done.set_exception(exc)
+                else:
+                    self.commits += 1
+                    self.committed_items += len(puts)
+                    self.acked_items += len(acks)
+                    for (_, done), seq in zip(puts, seqs):
+                        if not done.done():
+                            done.set_result(seq)
+
+            if self._closing and not self._pending_puts and not self._pending_acks:
+                return
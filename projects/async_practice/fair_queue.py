@@ -0,0 +1,84 @@
+﻿# 優先度クラス + 顧客ごとの公平な取り出しができる queue です。
+# asyncio.Queue を継承しているので put / get / task_done / join / maxsize はそのまま使えます。
+# (asyncio.PriorityQueue と同じく _init / _put / _get を差し替えるやり方)
+#
+# 学べること:
+# 1) 優先度クラス: 高いクラスに item があれば、必ずそちらを先に出す
+# 2) 同じクラスの中は weighted fair queuing (WFQ):
+#    1人の顧客がまとめて投入しても、他の顧客の注文と交互に取り出される
+#    重み2の顧客は重み1の顧客の2倍の頻度で取り出される
+# 3) 同じ顧客・同じクラスの注文は到着順のまま (追い越しは起きない)
+#
+# しくみ (クラスごと):
+#   顧客ごとに「仮想の終了時刻」を持ち、put のたびに
+#     tag = max(いまの仮想時刻, その顧客の前回の tag) + 1 / 重み
+#   を付けて heap に入れる。get は tag が最小のものを取り出し、仮想時刻をその tag に進める。
+#
+# 注意:
+# - 優先度は厳密なので、高いクラスが途切れないと低いクラスは待たされ続ける
+
+import asyncio
+import heapq
+import itertools
+
+
+class FairQueue(asyncio.Queue):
+    """
+    優先度クラス + 顧客ごとの WFQ で取り出す asyncio.Queue。
+
+    - classes: クラス名のタプル。先頭ほど優先 (例: ("high", "normal"))
+    - priority_of(item): item のクラス名を返す
+    - key_of(item): 公平に扱う単位 (顧客など) を返す
+    - weights: {key: 重み}。無いものは 1
+    """
+
+    def __init__(self, maxsize=0, classes=("default",), priority_of=None, key_of=None, weights=None):
+        # super().__init__ の中で _init が呼ばれるので、その前に設定しておく
+        self.classes = tuple(classes)
+        self.priority_of = priority_of or (lambda item: self.classes[-1])
+        self.key_of = key_of or (lambda item: None)
+        self.weights = dict(weights or {})
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        # クラス名 -> [(tag, 到着順, key, item), ...] の heap
+        self._heaps = {name: [] for name in self.classes}
+        # クラス名 -> {key: 最後に付けた tag} (queue に残っている key だけ持つ)
+        self._last_tags = {name: {} for name in self.classes}
+        # クラス名 -> 仮想時刻 (最後に取り出した tag)
+        self._virtual_time = {name: 0.0 for name in self.classes}
+        self._arrival = itertools.count()
+        self._size = 0
+
+    def _put(self, item):
+        name = self.priority_of(item)
+        key = self.key_of(item)
+        last_tags = self._last_tags[name]
+        tag = max(self._virtual_time[name], last_tags.get(key, 0.0))
+        tag += 1.0 / self.weights.get(key, 1)
+        last_tags[key] = tag
+        heapq.heappush(self._heaps[name], (tag, next(self._arrival), key, item))
+        self._size += 1
+
+    def _get(self):
+        for name in self.classes:
+            heap = self._heaps[name]
+            if heap:
+                tag, _, key, item = heapq.heappop(heap)
+                self._virtual_time[name] = tag
+                # この key の最後の item だったら記録を消す (顧客数ぶん増え続けないように)
+                if self._last_tags[name].get(key) == tag:
+                    del self._last_tags[name][key]
+                self._size -= 1
+                return item
+        raise asyncio.QueueEmpty
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0
+
+    def class_sizes(self):
+        """クラスごとの残数 (ログ用)。"""
+        return {name: len(heap) for name, heap in self._heaps.items()}
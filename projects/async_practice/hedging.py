@@ -0,0 +1,159 @@
+﻿# 遅いレプリカに当たったときの「待ちぼうけ」を減らす hedged request です。
+# 学べること:
+# 1) 1回目の呼び出しが p95 を超えても返ってこなければ、2回目 (hedge) を並行で出す
+# 2) 先に終わった方を採用し、残りは cancel する
+# 3) hedge も同時実行上限 (Semaphore / AdaptiveLimiter) と hedge 予算の範囲でしか出さない
+#
+# 流れ:
+#   primary 開始 --(p95 秒待つ)--> まだ終わらない? --(予算OK)--> hedge 開始
+#                                                     └ 先に成功した方を返す / もう一方は cancel
+
+import asyncio
+from collections import deque
+
+
+class LatencyWindow:
+    """直近 maxlen 件の所要時間から percentile を出す (秒)。"""
+
+    def __init__(self, maxlen=1000):
+        self._samples = deque(maxlen=maxlen)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, q):
+        """q は 0〜1。サンプルがなければ None。"""
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+
+def _consume_exception(task):
+    """終わった Task の例外を取り出す (ログに "never retrieved" を出さないため)。"""
+    if not task.cancelled():
+        task.exception()
+
+
+class Hedger:
+    """
+    hedged request の実行役。上流ごとに1つ作って全 worker で共有する。
+
+    - limiter: hedge も含めて各試行はこれを通る (同時実行上限にカウントされる)
+    - budget: hedge を出す前に try_spend() する (resilience.RetryBudget を流用)
+    - quantile: この percentile を超えたら hedge を出す (既定 p95)
+    - min_samples: これだけ成功サンプルが集まるまでは hedge しない
+    """
+
+    def __init__(
+        self,
+        limiter,
+        budget,
+        quantile=0.95,
+        min_samples=20,
+        window=1000,
+        refresh_every=20,
+        on_hedge=None,
+    ):
+        self.limiter = limiter
+        self.budget = budget
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.refresh_every = refresh_every
+        self.on_hedge = on_hedge
+
+        # 1試行ごとの所要時間 (hedge を出す目安)
+        self.attempt_latency = LatencyWindow(window)
+        # hedge 込みで call() 全体にかかった時間 (p99 の報告用)
+        self.call_latency = LatencyWindow(window)
+        self._hedge_delay = None
+        self._since_refresh = 0
+
+        self.calls = 0
+        self.upstream_calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self):
+        """今の hedge までの待ち秒数。サンプル不足なら None (hedge しない)。"""
+        if len(self.attempt_latency) < self.min_samples:
+            return None
+        # 毎回 sort しないよう、refresh_every 件ごとに計算し直す
+        if self._hedge_delay is None or self._since_refresh >= self.refresh_every:
+            self._hedge_delay = self.attempt_latency.percentile(self.quantile)
+            self._since_refresh = 0
+        return self._hedge_delay
+
+    async def call(self, attempt_factory):
+        """
+        attempt_factory(hedge) が返すコルーチンを実行する。
+        hedge=False が1回目、hedge=True が追加の試行。
+        両方失敗したら、1回目の例外をそのまま投げる。
+        """
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        self.calls += 1
+        self.budget.record_request()
+
+        primary = asyncio.create_task(self._attempt(attempt_factory, hedge=False))
+        tasks = [primary]
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                await asyncio.wait({primary}, timeout=delay)
+                if not primary.done() and self.budget.try_spend():
+                    self.hedges += 1
+                    if self.on_hedge is not None:
+                        self.on_hedge(delay)
+                    tasks.append(asyncio.create_task(self._attempt(attempt_factory, hedge=True)))
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        self.call_latency.record(loop.time() - started_at)
+                        return task.result()
+            # ここに来る = 全試行が失敗
+            return primary.result()
+        finally:
+            for task in tasks:
+                if task.done():
+                    # 同時に終わって使わなかった試行の例外も取り出しておく
+                    _consume_exception(task)
+                else:
+                    task.cancel()
+                    # cancel が間に合わず例外で終わった場合も同じく取り出す
+                    task.add_done_callback(_consume_exception)
+
+    async def _attempt(self, attempt_factory, hedge):
+        async with self.limiter:
+            loop = asyncio.get_running_loop()
+            started_at = loop.time()
+            self.upstream_calls += 1
+            result = await attempt_factory(hedge)
+            # 成功した試行だけを「普段の応答時間」として覚える
+            self.attempt_latency.record(loop.time() - started_at)
+            self._since_refresh += 1
+            return result
+
+    def snapshot(self):
+        p99 = self.call_latency.percentile(0.99)
+        # limiter 待ちの間に不要になった hedge は上流に届いていないので数えない
+        extra = max(0, self.upstream_calls - self.calls)
+        return {
+            "calls": self.calls,
+            "upstream_calls": self.upstream_calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            # 1回ずつ呼んだ場合と比べて、上流への呼び出しが何 % 増えたか
+            "extra_load_pct": round(100.0 * extra / self.calls, 1) if self.calls else 0.0,
+            "hedge_delay": None if self._hedge_delay is None else round(self._hedge_delay, 3),
+            "call_p99": None if p99 is None else round(p99, 3),
+        }
@@ -0,0 +1,185 @@
+﻿# 同じ注文IDを2回処理しないための「冪等性 (idempotency) キャッシュ」です。
+# script_10 から使います。
+# 学べること:
+# 1) 完了済みの注文IDは結果を覚えておき、もう一度来たら処理せずその結果を返す
+# 2) 処理中の注文IDがもう一度来たら、2本目は始めずに1本目の結果を待つ (相乗り)
+# 3) メモリ側は件数上限付きの LRU (古いものから忘れる)。
+#    再起動後や LRU から消えた後も効かせたいときは SQLite の永続層を足す
+#
+# 使い方:
+#     cache = IdempotencyCache(max_entries=10_000, store=SqliteIdempotencyStore("idem.sqlite3"))
+#     result = await cache.run(order["id"], lambda: process(order))
+#
+#     # 保存 (commit) を待たずに次へ進みたいとき: func は (結果, 保存が済んだら完了する Future) を返す
+#     settled = await cache.run_deferred(order["id"], lambda: process_and_submit(order))
+#     settled.add_done_callback(...)   # 保存まで済んだら結果、失敗なら例外で完了する
+#
+# 注意:
+# - 失敗した処理は覚えない (あとで同じIDが来たら、もう一度実行する)
+# - 永続層に書くのは処理が終わった後なので、その間に落ちた注文はもう一度処理される
+#   (run_deferred では保存の Future が完了した後。保存前に「完了済み」にはならない)
+# - 結果は JSON にできる値にする (永続層に保存するため)
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SqliteIdempotencyStore:
+    """完了済みの結果を保存する SQLite。メソッドはブロッキングなので to_thread から呼ぶ。"""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency ("
+            " key TEXT PRIMARY KEY,"
+            " result TEXT NOT NULL,"
+            " completed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM idempotency WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, result):
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO idempotency (key, result, completed_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(result, ensure_ascii=False), time.time()),
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class IdempotencyCache:
+    """
+    key ごとに func を1回だけ実行する。
+
+    - run(key, func): func は引数なしで awaitable を返す関数
+      完了済み -> 覚えている結果 / 実行中 -> その結果を待つ / どちらでもない -> func を実行
+    - run_deferred(key, func): func は (結果, 確定 Future) を返す。確定 Future が完了するまで
+      key は「実行中」のまま。戻り値は確定したら結果になる Future で、待つかどうかは呼び出し側が決める
+    - max_entries: メモリに覚える完了済みの件数 (超えたら最近使っていないものから忘れる)
+    - store: SqliteIdempotencyStore など get / put を持つ永続層 (任意)
+    """
+
+    def __init__(self, max_entries=10_000, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self._done = OrderedDict()
+        self._in_flight = {}
+        # 確定 (保存) を待っている Task (終わるまで参照を持っておく)
+        self._settling = set()
+
+        # 集計
+        self.hits = 0
+        self.store_hits = 0
+        self.joined = 0
+        self.misses = 0
+        self.failures = 0
+        self.evictions = 0
+
+    async def run(self, key, func):
+        async def run_and_confirm():
+            confirmed = asyncio.get_running_loop().create_future()
+            confirmed.set_result(None)
+            return await func(), confirmed
+
+        settled = await self.run_deferred(key, run_and_confirm)
+        # shield: 相乗り側が cancel されても1本目は止めない
+        return await asyncio.shield(settled)
+
+    async def run_deferred(self, key, func):
+        loop = asyncio.get_running_loop()
+        if key in self._done:
+            self._done.move_to_end(key)
+            self.hits += 1
+            settled = loop.create_future()
+            settled.set_result(self._done[key])
+            return settled
+
+        running = self._in_flight.get(key)
+        if running is not None:
+            self.joined += 1
+            return running
+
+        # await より前に登録する (この後に来た同じ key は必ず相乗りになる)
+        running = loop.create_future()
+        self._in_flight[key] = running
+        try:
+            if self.store is not None:
+                stored = await asyncio.to_thread(self.store.get, key)
+                if stored is not None:
+                    self.store_hits += 1
+                    self._remember(key, stored)
+                    running.set_result(stored)
+                    del self._in_flight[key]
+                    return running
+
+            self.misses += 1
+            result, confirmed = await func()
+        except BaseException as exc:
+            self._fail(key, running, exc)
+            raise
+
+        # 確定 (保存の commit) を待つのは別 Task。呼び出し側はここで次の仕事へ戻れる
+        task = asyncio.create_task(self._settle(key, running, result, confirmed))
+        self._settling.add(task)
+        task.add_done_callback(self._settling.discard)
+        return running
+
+    async def _settle(self, key, running, result, confirmed):
+        try:
+            await confirmed
+            self._remember(key, result)
+            if self.store is not None:
+                await asyncio.to_thread(self.store.put, key, result)
+        except BaseException as exc:
+            self._fail(key, running, exc)
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+        else:
+            running.set_result(result)
+            del self._in_flight[key]
+
+    def _fail(self, key, running, exc):
+        self.failures += 1
+        del self._in_flight[key]
+        if isinstance(exc, asyncio.CancelledError):
+            exc = RuntimeError(f"in-flight run cancelled: {key}")
+        running.set_exception(exc)
+        # 相乗りがいなくても "exception was never retrieved" を出さないように
+        running.exception()
+
+    def _remember(self, key, result):
+        self._done[key] = result
+        self._done.move_to_end(key)
+        while len(self._done) > self.max_entries:
+            self._done.popitem(last=False)
+            self.evictions += 1
+
+    def snapshot(self):
+        served = self.hits + self.store_hits + self.joined
+        total = served + self.misses
+        return {
+            "hits": self.hits,
+            "store_hits": self.store_hits,
+            "joined": self.joined,
+            "misses": self.misses,
+            "failures": self.failures,
+            "evictions": self.evictions,
+            "entries": len(self._done),
+            # 上流 (API + 保存) を呼ばずに済んだ割合
+            "saved_ratio": served / total if total else 0.0,
+        }
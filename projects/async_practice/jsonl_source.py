@@ -0,0 +1,209 @@
+﻿# 注文などの入力を JSON Lines (1行1レコード) で少しずつ読む「入力ソース」です。
+# script_10 / script_11 の ingest から async for で使います。
+# 学べること:
+# 1) async generator は「次の1件を要求されたときだけ」読む
+#    -> ingest が queue.put で待っている間は読み込みも止まる (背圧がファイルまで届く)
+#    -> 10件でも1000万件でもメモリに載るのは数十KBの読みかけ分だけ
+# 2) ファイル読み込みはブロッキングなので、まとめて (chunk_size ぶん) to_thread で読む
+#    改行が来るまで MAX_LINE_BYTES を超えた行は、読みながら捨てる (1行が何GBでもメモリは増えない)
+# 3) 壊れた行は on_error に知らせて飛ばし、全体は止めない
+#
+# 使い方:
+#     source = JsonlSource("orders.jsonl", required=("id", "customer"))
+#     async for order in source:
+#         await queue.put(order)
+#
+#     JsonlSource("-")                                   # 標準入力
+#     JsonlSource("orders.jsonl", follow=True)           # tail -f のように追記を待ち続ける
+#
+# 注意:
+# - stdin がパイプなら StreamReader で読む。ファイルのリダイレクト (< orders.jsonl) はスレッドで読む
+# - follow=True は idle_timeout 秒追記がなければ終わる (None なら終わらない)
+
+import asyncio
+import json
+import sys
+
+# 1行の最大バイト数 (これを超える行は中身を持たずに捨て、壊れた行として数える)
+MAX_LINE_BYTES = 1024 * 1024
+
+
+class JsonlSource:
+    """
+    JSON Lines を1レコードずつ返す async iterable。
+
+    - path: ファイルパス。"-" なら標準入力
+    - required: 各レコードに必須のキー (無ければ壊れた行扱い)
+    - validate(record): 値の確認 (任意)。ValueError を出したレコードは壊れた行扱い
+    - follow: True ならファイル末尾に来ても終わらず、追記を poll_interval 秒ごとに見に行く
+    - on_error(line_no, line, exc): 壊れた行の通知 (任意)
+    """
+
+    def __init__(
+        self,
+        path,
+        required=(),
+        validate=None,
+        follow=False,
+        poll_interval=0.5,
+        idle_timeout=None,
+        chunk_size=64 * 1024,
+        on_error=None,
+    ):
+        self.path = path
+        self.required = tuple(required)
+        self.validate = validate
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.chunk_size = chunk_size
+        self.on_error = on_error
+
+        # 集計
+        self.lines = 0
+        self.records = 0
+        self.malformed = 0
+
+    def __aiter__(self):
+        return self._records()
+
+    def snapshot(self):
+        return {"lines": self.lines, "records": self.records, "malformed": self.malformed}
+
+    # ---- 行 -> レコード ----
+
+    async def _records(self):
+        async for line in self._lines():
+            self.lines += 1
+            if not line.strip():
+                continue
+            try:
+                record = self._parse(line)
+            except ValueError as exc:
+                self.malformed += 1
+                if self.on_error is not None:
+                    self.on_error(self.lines, line, exc)
+                continue
+            self.records += 1
+            yield record
+
+    def _parse(self, line):
+        if len(line) > MAX_LINE_BYTES:
+            raise ValueError(f"line too long: {len(line)} bytes")
+        # json.JSONDecodeError / UnicodeDecodeError は ValueError のサブクラス
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError(f"not an object: {type(record).__name__}")
+        missing = [key for key in self.required if key not in record]
+        if missing:
+            raise ValueError(f"missing keys: {missing}")
+        if self.validate is not None:
+            self.validate(record)
+        return record
+
+    # ---- 行の読み込み (bytes の行を1つずつ返す) ----
+
+    async def _lines(self):
+        if self.path == "-":
+            async for line in self._stdin_lines():
+                yield line
+            return
+
+        stream = await asyncio.to_thread(open, self.path, "rb")
+        try:
+            async for line in self._file_lines(stream):
+                yield line
+        finally:
+            stream.close()
+
+    async def _file_lines(self, stream):
+        # chunk_size バイトずつまとめて読む (1行ずつ to_thread すると遅い)
+        # read1 は届いている分だけ返すので、端末やパイプでも chunk_size がそろうまで待たない
+        async def read_chunk():
+            return await asyncio.to_thread(stream.read1, self.chunk_size)
+
+        async for line in self._split_lines(read_chunk, self.follow):
+            yield line
+
+    async def _split_lines(self, read_chunk, follow):
+        """read_chunk() が返す bytes を行に分けて返す。空の bytes が末尾 (EOF) の合図。"""
+        loop = asyncio.get_running_loop()
+        # まだ改行が来ていない「読みかけの行」(follow なら書きかけの行)
+        partial = b""
+        # MAX_LINE_BYTES を超えた行の残りを、次の改行まで捨てている途中か
+        skipping = False
+        idle_since = loop.time()
+        while True:
+            chunk = await read_chunk()
+            if not chunk:
+                if not follow or (
+                    self.idle_timeout is not None and loop.time() - idle_since >= self.idle_timeout
+                ):
+                    if partial:
+                        yield partial
+                    return
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            idle_since = loop.time()
+            start = 0
+            while True:
+                end = chunk.find(b"\n", start)
+                if end == -1:
+                    break
+                line = chunk[start:end + 1]
+                start = end + 1
+                if skipping:
+                    # 長すぎた行はここで終わり
+                    skipping = False
+                    continue
+                if partial:
+                    line = partial + line
+                    partial = b""
+                yield line
+
+            if not skipping:
+                partial += chunk[start:]
+                if len(partial) > MAX_LINE_BYTES:
+                    # 改行を待たずにここで見切る。残りは次の改行まで読み捨てる
+                    partial = b""
+                    skipping = True
+                    self._line_too_long(ValueError(f"line too long: > {MAX_LINE_BYTES} bytes"))
+
+    def _line_too_long(self, exc):
+        """長すぎる行を (中身は持たずに) 壊れた行として数える。"""
+        self.lines += 1
+        self.malformed += 1
+        if self.on_error is not None:
+            self.on_error(self.lines, b"", exc)
+
+    async def _stdin_lines(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer
+            )
+        except (OSError, ValueError):
+            # パイプではない (ファイルのリダイレクト等) -> スレッドで読む
+            async for line in self._file_lines(sys.stdin.buffer):
+                yield line
+            return
+
+        # ファイルと同じく chunk_size ずつ読んで行に分ける
+        # (readline は長すぎる行で例外を出したあと、その行の続きを次の行として返してしまう)
+        async def read_chunk():
+            return await reader.read(self.chunk_size)
+
+        async for line in self._split_lines(read_chunk, follow=False):
+            yield line
+
+
+async def iterate_with_interval(items, interval):
+    """
+    list / generator を interval 秒おきに1件ずつ返す (組み込みのデモデータ用)。
+    JsonlSource と同じく async for で使える。
+    """
+    for item in items:
+        await asyncio.sleep(interval)
+        yield item
@@ -0,0 +1,117 @@
+﻿# 同時に来た呼び出しを少しだけ待ってまとめ、1回のバッチ呼び出しにする「micro-batching」です。
+# script_10 から使います。
+# 学べること:
+# 1) 1件目が来てから max_wait 秒 (または max_batch_size 件) で区切って1回で送る
+#    -> 上流への呼び出し回数と Semaphore の取り合いが、ほぼ「平均バッチ件数」分の1になる
+# 2) 結果はバッチの中の順番どおりに、それぞれ待っている呼び出し元へ配り直す (fan-out)
+# 3) 1件ごとのエラーはその呼び出し元にだけ返す (他の件は成功のまま)
+#
+# 使い方:
+#     batcher = MicroBatcher(send_batch, max_batch_size=16, max_wait=0.01)
+#     result = await batcher.submit(request)   # 各 worker から
+#     await batcher.close()
+#
+# send_batch(items) は items と同じ長さのリストを返す。
+# 要素が例外インスタンスなら、その item の呼び出し元にだけ例外として返す。
+#
+# 注意:
+# - 空いているときも1件目は max_wait 秒待たされる (混んでいるときほど得をする)
+# - submit を wait_for で cancel した item は、まだ送っていなければバッチから外す
+
+import asyncio
+
+
+class MicroBatcher:
+    """
+    submit(item) を溜めて call_batch(items) にまとめる。
+
+    - max_batch_size: この件数に達したらすぐ送る
+    - max_wait: 1件目が来てからこの秒数で、件数未満でも送る
+    - on_batch(items): 送るときのログ用 (任意)
+    """
+
+    def __init__(self, call_batch, max_batch_size=16, max_wait=0.01, on_batch=None):
+        self.call_batch = call_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.on_batch = on_batch
+        self._pending = []
+        self._timer = None
+        self._sending = set()
+
+        # 集計
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.batch_failures = 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self._pending.append((item, done))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await done
+
+    async def close(self):
+        """溜まっている分を送り、送信中のバッチが全部終わるまで待つ。"""
+        self._flush()
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+
+    def snapshot(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": self.items / self.batches if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "batch_failures": self.batch_failures,
+        }
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # 呼び出し元が先に cancel (timeout 等) したものは送らない
+        batch = [(item, done) for item, done in self._pending if not done.done()]
+        self._pending = []
+        if not batch:
+            return
+
+        self.batches += 1
+        self.items += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        task = asyncio.create_task(self._send(batch))
+        # 送信中の Task を持っておく (GC で消えないように + close で待つため)
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch):
+        items = [item for item, _ in batch]
+        if self.on_batch is not None:
+            self.on_batch(items)
+        try:
+            results = await self.call_batch(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"batch returned {len(results)} results for {len(items)} items")
+        except asyncio.CancelledError:
+            for _, done in batch:
+                done.cancel()
+            raise
+        except Exception as exc:
+            # バッチ全体の失敗 (timeout 等) は全員に同じ例外を返す
+            self.batch_failures += 1
+            for _, done in batch:
+                if not done.done():
+                    done.set_exception(exc)
+            return
+
+        for (_, done), result in zip(batch, results):
+            if done.done():
+                continue
+            if isinstance(result, BaseException):
+                done.set_exception(result)
+            else:
+                done.set_result(result)
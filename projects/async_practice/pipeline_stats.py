@@ -0,0 +1,206 @@
+﻿# パイプラインの集計 (件数 + 段階ごとの所要時間) です。
+# 学べること:
+# 1) worker ごとに自分専用の集計を持てば、Lock なしで更新できる (合算は読むときだけ)
+# 2) 所要時間は対数バケットのヒストグラムに入れる
+#    -> 記録は O(1)・メモリ一定なので本番でも付けっぱなしにできる
+# 3) 実行中でも snapshot() でいつでも途中経過を取り出せる
+#
+# 使い方:
+#     stats = PipelineStats(counter_names=("success", "failed"))
+#     my = stats.for_worker("worker-1")
+#     with my.timed("api"):
+#         await call()
+#     my.incr("success")
+#     stats.snapshot()  # {"counters": {...}, "latency": {"api": {"p50": ...}}}
+
+import asyncio
+import math
+
+
+def _loop_time():
+    return asyncio.get_running_loop().time()
+
+
+class LatencyHistogram:
+    """
+    対数バケットのヒストグラム (秒)。
+
+    バケットの幅は growth 倍ずつ広がるので、percentile の誤差は相対で約 (growth - 1)。
+    既定 (1µs〜1時間, growth=1.1) でバケット数は 230 程度。
+    """
+
+    def __init__(self, min_value=1e-6, max_value=3600.0, growth=1.1):
+        self.min_value = min_value
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self._bucket_count = int(math.log(max_value / min_value) / self._log_growth) + 2
+        self.counts = [0] * self._bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= self.min_value:
+            index = 0
+        else:
+            index = int(math.log(seconds / self.min_value) / self._log_growth) + 1
+            if index >= self._bucket_count:
+                index = self._bucket_count - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """同じ設定のヒストグラムを足し込む。"""
+        for index, value in enumerate(other.counts):
+            if value:
+                self.counts[index] += value
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """q は 0〜1。該当バケットの上端を返す (ただし観測した最大値は超えない)。"""
+        if self.count == 0:
+            return None
+        target = max(1, math.ceil(q * self.count))
+        cumulative = 0
+        for index, value in enumerate(self.counts):
+            cumulative += value
+            if cumulative >= target:
+                return min(self.min_value * self.growth**index, self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 4),
+            "p50": round(self.percentile(0.50), 4),
+            "p95": round(self.percentile(0.95), 4),
+            "p99": round(self.percentile(0.99), 4),
+            "max": round(self.max, 4),
+        }
+
+
+class _Timer:
+    """WorkerStats.timed() の戻り値。with を抜けたときに所要時間を記録する。"""
+
+    __slots__ = ("_stats", "_stage", "_started_at")
+
+    def __init__(self, stats, stage):
+        self._stats = stats
+        self._stage = stage
+
+    def __enter__(self):
+        self._started_at = self._stats.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stats.observe(self._stage, self._stats.clock() - self._started_at)
+        return False
+
+
+class WorkerStats:
+    """
+    1つの worker (Task) 専用の集計。
+    その worker しか書き込まないので Lock は不要。
+    """
+
+    def __init__(self, name, clock=None):
+        self.name = name
+        self.clock = clock or _loop_time
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def timed(self, stage):
+        return _Timer(self, stage)
+
+
+class PipelineStats:
+    """
+    worker ごとの WorkerStats をまとめる入れ物。
+    counters() / latency() / snapshot() は呼ばれたときに全 worker 分を合算する。
+    """
+
+    def __init__(self, counter_names=(), clock=None):
+        self.counter_names = tuple(counter_names)
+        self.clock = clock
+        self._workers = {}
+
+    def for_worker(self, name):
+        worker_stats = self._workers.get(name)
+        if worker_stats is None:
+            worker_stats = self._workers[name] = WorkerStats(name, clock=self.clock)
+        return worker_stats
+
+    def counters(self):
+        merged = {name: 0 for name in self.counter_names}
+        for worker_stats in self._workers.values():
+            for name, value in worker_stats.counters.items():
+                merged[name] = merged.get(name, 0) + value
+        return merged
+
+    def latency(self):
+        merged = {}
+        for worker_stats in self._workers.values():
+            for stage, histogram in worker_stats.histograms.items():
+                if stage not in merged:
+                    merged[stage] = LatencyHistogram()
+                merged[stage].merge(histogram)
+        return merged
+
+    def merge(self, other):
+        """
+        別の PipelineStats (別プロセスで動いた shard の集計など) を worker ごとに足し込む。
+        同じ名前の worker は合算されるので、shard ごとに worker 名を変えておく。
+        """
+        for name, other_stats in other._workers.items():
+            worker_stats = self.for_worker(name)
+            for counter, value in other_stats.counters.items():
+                worker_stats.incr(counter, value)
+            for stage, histogram in other_stats.histograms.items():
+                if stage not in worker_stats.histograms:
+                    worker_stats.histograms[stage] = LatencyHistogram()
+                worker_stats.histograms[stage].merge(histogram)
+
+    def snapshot(self):
+        return {
+            "counters": self.counters(),
+            "latency": {stage: h.summary() for stage, h in self.latency().items()},
+        }
+
+
+async def report_periodically(stats, interval, report):
+    """
+    interval 秒ごとに stats.snapshot() を report(snapshot) に渡す。
+    main 側で create_task して、終わったら cancel する。
+    """
+    while True:
+        await asyncio.sleep(interval)
+        report(stats.snapshot())
+
+
+def format_latency(snapshot):
+    """snapshot の latency 部分を1段階1行の文字列にする (ログ用)。"""
+    lines = []
+    for stage, summary in snapshot["latency"].items():
+        if summary["count"] == 0:
+            continue
+        lines.append(
+            f"{stage:<11} n={summary['count']:<5} p50={summary['p50']:.3f}s "
+            f"p95={summary['p95']:.3f}s p99={summary['p99']:.3f}s max={summary['max']:.3f}s"
+        )
+    return lines
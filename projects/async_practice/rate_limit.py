@@ -0,0 +1,248 @@
+﻿# 上流への呼び出しを「1秒に何回まで」に抑える token bucket です。
+# script_10 / script_11 から使います。
+# 学べること:
+# 1) Semaphore は「同時に何件」しか決めない。応答が速いと1秒あたりの回数はいくらでも増える
+#    -> 上流の「毎秒 N 回まで」の制限には token bucket を使う
+# 2) token は rate 個/秒で貯まり、最大 burst 個まで貯めておける
+#    (空いた後の最初の burst 回は待たずに呼べて、それ以降は 1/rate 秒に1回になる)
+# 3) 待ち時間は「予約」で決める: 取った瞬間に token を1つ減らし (マイナスになってよい)、
+#    足りない分が貯まるまで sleep する -> Lock なしで先着順になる
+# 4) 複数プロセスで1つの上限を守るときは、token の残りをファイルに置いてロックして更新する
+#
+# 使い方:
+#     bucket = TokenBucket(rate=10, burst=5)               # このプロセスだけ
+#     bucket = FileTokenBucket("api.bucket", rate=10, burst=5)  # プロセスをまたいで共有
+#     api_sem = RateLimitedSlots(bucket, asyncio.Semaphore(4), on_wait=record)
+#     async with api_sem:        # token を待ってから slot (同時実行の枠) を待つ
+#         await call()
+#
+# on_wait(kind, seconds) には kind="token_wait" (回数の上限待ち) と
+# kind="slot_wait" (同時実行の枠待ち) が別々に届く。
+
+import asyncio
+import os
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _loop_time():
+    return asyncio.get_running_loop().time()
+
+
+class TokenBucket:
+    """
+    プロセス内の token bucket。
+
+    - rate: 1秒あたりに貯まる token 数 (= 長い目で見た 回/秒 の上限)
+    - burst: 貯めておける最大数
+    - acquire(): token を1つ取る。待った秒数を返す
+    """
+
+    def __init__(self, rate, burst=1, clock=None):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate > 0, burst >= 1 にしてください")
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock or _loop_time
+        self._tokens = float(burst)
+        self._updated_at = None
+
+        # 集計
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_seconds = 0.0
+
+    async def acquire(self):
+        delay = await self._reserve_async()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # 使わなかった token は返す (後ろに並んだ人の分は減らさない)
+                # shield: 返している途中でもう一度 cancel されても、返すのは最後までやる
+                await asyncio.shield(self._refund_async())
+                raise
+            self.delayed += 1
+            self.wait_seconds += delay
+        self.acquired += 1
+        return delay
+
+    async def close(self):
+        pass
+
+    def snapshot(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "acquired": self.acquired,
+            "delayed": self.delayed,
+            "wait_seconds": round(self.wait_seconds, 4),
+        }
+
+    async def _reserve_async(self):
+        return self._reserve()
+
+    async def _refund_async(self):
+        self._refund()
+
+    def _reserve(self):
+        """token を1つ予約し、それが使えるまでの秒数を返す。"""
+        now = self.clock()
+        if self._updated_at is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self.rate)
+
+    def _refund(self):
+        self._tokens = min(self.burst, self._tokens + 1)
+
+
+# ファイルの先頭に置く状態: (token の残り, 最後に更新した時刻)
+_STATE = struct.Struct("<dd")
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    複数プロセスで共有する token bucket。
+
+    token の残りと更新時刻を path のファイルに置き、ファイルロックを取って読み書きする。
+    同じ path を渡したプロセス同士で rate / burst を分け合う (rate / burst は全員同じ値にする)。
+    時刻はプロセス間で共通の time.time() を使う。ロック待ちでループを止めないよう to_thread で更新する。
+    """
+
+    def __init__(self, path, rate, burst=1):
+        super().__init__(rate, burst, clock=time.time)
+        self.path = str(path)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        # cancel された予約と、その token を返している Task (終わるまで参照を持っておく)
+        self._late_refunds = set()
+
+    async def close(self):
+        # 返し終わる前に fd を閉じると、返す処理が閉じた (or 別の) fd を読み書きしてしまう
+        # 予約が済むとその返却 Task が増えるので、空になるまで繰り返す
+        while self._late_refunds:
+            await asyncio.gather(*self._late_refunds, return_exceptions=True)
+        os.close(self._fd)
+
+    async def _reserve_async(self):
+        reserving = asyncio.ensure_future(asyncio.to_thread(self._reserve))
+        try:
+            return await asyncio.shield(reserving)
+        except asyncio.CancelledError:
+            # スレッドの中の予約は止められないので、済んだらその token を返す
+            reserving.add_done_callback(self._refund_late)
+            self._late_refunds.add(reserving)
+            reserving.add_done_callback(self._late_refunds.discard)
+            raise
+
+    async def _refund_async(self):
+        await asyncio.to_thread(self._refund)
+
+    def _refund_late(self, reserving):
+        if reserving.cancelled() or reserving.exception() is not None:
+            return
+        task = asyncio.ensure_future(self._refund_async())
+        self._late_refunds.add(task)
+        task.add_done_callback(self._late_refunds.discard)
+
+    def _reserve(self):
+        with _FileLock(self._fd):
+            now = self.clock()
+            tokens, updated_at = self._read(now)
+            # 時計が戻った (再起動など) ときは経過0として扱う
+            elapsed = max(0.0, now - updated_at)
+            tokens = min(self.burst, tokens + elapsed * self.rate) - 1
+            self._write(tokens, now)
+        return max(0.0, -tokens / self.rate)
+
+    def _refund(self):
+        with _FileLock(self._fd):
+            now = self.clock()
+            tokens, updated_at = self._read(now)
+            self._write(min(self.burst, tokens + 1), updated_at)
+
+    def _read(self, now):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        data = os.read(self._fd, _STATE.size)
+        if len(data) < _STATE.size:
+            # 新しいファイル: 満タンから始める
+            return float(self.burst), now
+        return _STATE.unpack(data)
+
+    def _write(self, tokens, updated_at):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, _STATE.pack(tokens, updated_at))
+
+
+class _FileLock:
+    """ファイル全体の排他ロック (with で使う)。"""
+
+    def __init__(self, fd):
+        self._fd = fd
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_LOCK, _STATE.size)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, _STATE.size)
+        return False
+
+
+class RateLimitedSlots:
+    """
+    token (回数の上限) -> slot (同時実行の上限) の順に取る、Semaphore 互換のリミッター。
+
+    - slots: asyncio.Semaphore や adaptive_limit.AdaptiveLimiter
+    - on_wait(kind, seconds): 待ち時間の記録用 (任意)。kind は "token_wait" / "slot_wait"
+
+    token を先に取るのは、token 待ちの間に slot を握らないため
+    (握ったまま待つと同時実行の枠が無駄になり、AdaptiveLimiter が「遅い」と誤解する)。
+    """
+
+    def __init__(self, bucket, slots, on_wait=None):
+        self.bucket = bucket
+        self.slots = slots
+        self.on_wait = on_wait
+
+        # 集計
+        self.token_wait_seconds = 0.0
+        self.slot_wait_seconds = 0.0
+
+    async def __aenter__(self):
+        token_wait = await self.bucket.acquire()
+        started_at = _loop_time()
+        await self.slots.__aenter__()
+        slot_wait = _loop_time() - started_at
+
+        self.token_wait_seconds += token_wait
+        self.slot_wait_seconds += slot_wait
+        if self.on_wait is not None:
+            self.on_wait("token_wait", token_wait)
+            self.on_wait("slot_wait", slot_wait)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self.slots.__aexit__(exc_type, exc, tb)
+
+    def snapshot(self):
+        return {
+            **self.bucket.snapshot(),
+            "token_wait_seconds": round(self.token_wait_seconds, 4),
+            "slot_wait_seconds": round(self.slot_wait_seconds, 4),
+        }
@@ -0,0 +1,190 @@
+﻿# 外部API呼び出しの「リトライ嵐」を防ぐための部品です。
+# script_10 / script_11 のリトライループで共有して使います。
+# 学べること:
+# 1) 指数バックオフ + ジッター: 待ち時間を倍々にしつつランダムにずらし、一斉リトライを防ぐ
+# 2) リトライ予算: リトライ回数を「全リクエスト数の一定割合」までに抑える
+# 3) サーキットブレーカー: 上流が不調な間は呼ばずに即失敗させ、worker を無駄に待たせない
+#
+# ブレーカーの状態:
+#   closed    -> 通常。連続失敗が threshold に達したら open へ
+#   open      -> 即失敗 (CircuitOpenError)。reset_timeout 秒たったら half_open へ
+#   half_open -> お試しで少数だけ通す。成功なら closed、失敗なら再び open
+
+import asyncio
+import random
+
+
+class CircuitOpenError(Exception):
+    """
+    ブレーカーが open のため呼び出しをしなかったことを表す。
+
+    リトライループの except RuntimeError に拾われないよう、
+    RuntimeError ではなく Exception を直接継承している。
+    """
+
+
+def backoff_delay(attempt, base, cap, rng=random):
+    """
+    attempt 回目の失敗のあとに待つ秒数 (full jitter)。
+
+    0 〜 min(cap, base * 2^(attempt-1)) の一様乱数にする。
+    """
+    return rng.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class RetryBudget:
+    """
+    リトライできる回数を「リクエスト数 × ratio」に制限するトークン方式の予算。
+
+    - record_request(): 初回呼び出しのたびに ratio トークン貯まる
+    - try_spend(): リトライ前に1トークン使う。足りなければ False (リトライしない)
+    起動直後でも少しはリトライできるよう initial_tokens から始める。
+    """
+
+    def __init__(self, ratio=0.2, initial_tokens=5.0, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = min(initial_tokens, max_tokens)
+        self.requests = 0
+        self.retries = 0
+        self.denied = 0
+
+    def record_request(self):
+        self.requests += 1
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self):
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            self.retries += 1
+            return True
+        self.denied += 1
+        return False
+
+    def snapshot(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "denied": self.denied,
+            "tokens": round(self._tokens, 2),
+        }
+
+
+class CircuitBreaker:
+    """
+    with breaker: の形で呼び出しを囲んで使う。
+
+    - 入口: open なら CircuitOpenError を投げる (呼び出し自体をしない)
+    - 出口: 例外なしなら成功、例外 (キャンセル以外) なら失敗として記録
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=5,
+        reset_timeout=5.0,
+        half_open_max_calls=1,
+        clock=None,
+        on_change=None,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        # 指定がなければイベントループの時計を使う
+        self.clock = clock or (lambda: asyncio.get_running_loop().time())
+        self.on_change = on_change
+
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._half_open_in_flight = 0
+
+        self.rejected = 0
+        self.opened = 0
+
+    def __enter__(self):
+        self.before_call()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.record_success()
+        elif not issubclass(exc_type, Exception):
+            # CancelledError などは上流の健康状態と関係ないので、枠だけ返す
+            self._release_probe()
+        else:
+            self.record_failure()
+        return False
+
+    def before_call(self):
+        if self.state == self.OPEN:
+            if self.clock() - self._opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            else:
+                self.rejected += 1
+                raise CircuitOpenError(f"circuit open: {self.name}")
+
+        if self.state == self.HALF_OPEN:
+            if self._half_open_in_flight >= self.half_open_max_calls:
+                self.rejected += 1
+                raise CircuitOpenError(f"circuit half-open (probe中): {self.name}")
+            self._half_open_in_flight += 1
+
+    def record_success(self):
+        self._release_probe()
+        self._consecutive_failures = 0
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self._release_probe()
+        self._consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            self._opened_at = self.clock()
+            if self.state != self.OPEN:
+                self.opened += 1
+                self._set_state(self.OPEN)
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self._consecutive_failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+    def _release_probe(self):
+        if self._half_open_in_flight > 0:
+            self._half_open_in_flight -= 1
+
+    def _set_state(self, state):
+        old, self.state = self.state, state
+        if state != self.HALF_OPEN:
+            self._half_open_in_flight = 0
+        if self.on_change is not None:
+            self.on_change(old, state)
+
+
+class RetryPolicy:
+    """
+    1つの上流サービスに対する backoff / retry budget / circuit breaker のまとめ役。
+    上流ごとに1つ作り、全 worker で共有する。
+    """
+
+    def __init__(self, breaker, budget, backoff_base, backoff_max, rng=random):
+        self.breaker = breaker
+        self.budget = budget
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rng = rng
+
+    def backoff(self, attempt):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max, self.rng)
+
+    def snapshot(self):
+        return {"breaker": self.breaker.snapshot(), "budget": self.budget.snapshot()}
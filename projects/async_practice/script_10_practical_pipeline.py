@@ -5,25 +5,91 @@
 # 3) 外部API呼び出しを Semaphore + timeout + retry で守る
 # 4) 同期処理(DB保存想定)を to_thread で逃がす
 # 5) join/gather で「仕事完了」と「Task終了」を分けて待つ
+# 6) DB保存を writer ステージに渡し、まとめて commit する (batch_writer.py)
+# 7) 同時呼び出し上限を AIMD で自動調整する (adaptive_limit.py)
+# 8) ジッター付き指数バックオフ / リトライ予算 / サーキットブレーカー (resilience.py)
+# 9) 遅い応答には hedge (2本目) を出して先に返った方を使う (hedging.py, 任意)
+# 10) worker ごとの集計 + 段階ごとの所要時間ヒストグラム (pipeline_stats.py)
+# 11) ログを別スレッドでまとめて JSON Lines に書く (async_logger.py, 任意)
+# 12) 受注 queue をディスクに置き、再起動しても未処理分から再開する (durable_queue.py, 任意)
+# 13) queue の混み具合で worker 数を増減し、終了シグナルなしで止める (worker_pool.py)
+# 14) 金額で優先度クラスを分け、クラス内は顧客ごとに公平に取り出す (fair_queue.py)
+# 15) 注文を JSON Lines ファイル / 標準入力から少しずつ読む (jsonl_source.py, 任意)
+# 16) 同じ注文IDは API / 保存を1回だけ行い、重複分は結果を使い回す (idempotency.py)
+# 17) 同時に来た API 呼び出しをまとめて1回のバッチ呼び出しにする (micro_batch.py, 任意)
+# 18) 注文ごと / worker ごとの処理区間を記録し、Chrome trace で開ける JSON に書き出す (tracing.py, 任意)
+# 19) 注文を顧客ごとに N 個のプロセスへ振り分け、1コアの限界を超える (sharded_runner.py, 任意)
+# 20) 同時実行数とは別に「1秒あたりの呼び出し回数」を token bucket で抑える (rate_limit.py, 任意)
+#
+# 実行例:
+#   python script_10_practical_pipeline.py                   # 組み込みの ORDERS
+#   python script_10_practical_pipeline.py orders.jsonl      # ファイル ("-" なら標準入力)
+#   python script_10_practical_pipeline.py orders.jsonl --follow   # 追記を待ち続ける
+#   python script_10_practical_pipeline.py --trace trace.json  # https://ui.perfetto.dev で開く
+#   python script_10_practical_pipeline.py orders.jsonl --shards 4  # 4プロセスで処理
 #
 # 全体の流れ:
-# A. main が worker を先に起動 (worker は queue.get() で待機)
+# A. main が worker pool を先に起動 (worker は queue.get() で待機)
 # B. ingest_orders が注文を queue に入れる
-# C. worker が注文を取り出して API -> 保存 を実行
-# D. ingest_orders が最後に None(終了シグナル) を worker 数ぶん入れる
-# E. main が queue.join() で「全件 task_done 済み」を待つ
-# F. main が gather() で「worker Task 自体の終了」を待つ
+# C. worker が注文を取り出して API -> writer へ受け渡し (commit は待たずに次の注文へ)
+#    「処理済み」(task_done / idempotency) の記録は writer の commit が終わったときに行う
+#    queue が溜まる / 待ち時間が伸びると pool が worker を増やし、暇になると減らす
+# D. main が pool.close() で「全件 task_done 済み」を待ち、待機中の worker を止める
+# E. main が writer.close() で残りを書き切ってから終了
 
+import argparse
 import asyncio
+import functools
 import time
+from pathlib import Path
+
+from adaptive_limit import AdaptiveLimiter
+from async_logger import AsyncLogger
+from batch_writer import BatchWriter, SqliteOrderSink
+from durable_queue import DurableQueue
+from fair_queue import FairQueue
+from hedging import Hedger
+from idempotency import IdempotencyCache, SqliteIdempotencyStore
+from jsonl_source import JsonlSource, iterate_with_interval
+from micro_batch import MicroBatcher
+from pipeline_stats import PipelineStats, format_latency, report_periodically
+from rate_limit import FileTokenBucket, RateLimitedSlots, TokenBucket
+from resilience import CircuitBreaker, RetryBudget, RetryPolicy
+from sharded_runner import ShardedRunner
+from tracing import Tracer
+from worker_pool import WorkerPool
 
 # -------- 設定値 --------
-# worker 数: 同時に注文処理する担当者数
-WORKER_COUNT = 3
+# worker 数: 同時に注文処理する担当者数。MIN..MAX の間で自動で増減する
+WORKER_MIN = 1
+WORKER_MAX = 4
+# この間隔で worker 数を見直す
+SCALE_INTERVAL_SECONDS = 1.0
+# worker 1本あたりの queue 残数がこれを超えたら増やす
+SCALE_UP_QUEUE_DEPTH = 1
+# 取り出した注文の queue 待ち時間がこれを超えたら増やす
+SCALE_UP_ITEM_AGE_SECONDS = 2.0
+# この秒数仕事がなかった worker は止める (WORKER_MIN 本までは残す)
+WORKER_IDLE_SECONDS = 3.0
 # queue 上限: これを超える投入は put 側が待つ
 QUEUE_MAXSIZE = 4
 # 外部API 同時呼び出し上限 (過負荷防止)
+# ADAPTIVE_CONCURRENCY=True なら、これは初期値で MIN..MAX の間を自動で動く
 API_CONCURRENCY = 2
+ADAPTIVE_CONCURRENCY = True
+API_CONCURRENCY_MIN = 1
+API_CONCURRENCY_MAX = 8
+# 成功でもこれより遅ければ「混んでいる」とみなして上限を下げる
+API_LATENCY_TARGET_SECONDS = 3.0
+# 1秒あたりの呼び出し回数の上限 (rate_limit.py)。None なら回数は制限しない
+# API_CONCURRENCY は「同時に何件」なので、応答が速いと回数はいくらでも増える
+# retry / hedge も1回に数える。バッチ API はバッチ1回で1回
+API_RATE_LIMIT = None
+# 空いた後でも待たずに呼べる回数 (token を貯めておける最大数)
+API_RATE_BURST = 5
+# 上限を複数プロセスで共有するファイル。None ならこのプロセスだけで数える
+# (SHARDS > 1 のときは、None でも全 shard で共有する一時ファイルを使う)
+API_RATE_SHARED_PATH = None
 # 1回のAPI呼び出しタイムアウト
 API_TIMEOUT_SECONDS = 4.0
 # リトライ回数 (MAX_RETRY=2 なら最大3回試行)
@@ -34,9 +100,119 @@ INGEST_INTERVAL_SECONDS = 1.2
 API_OK_SECONDS = 2.2
 API_ERROR_SECONDS = 1.8
 API_TIMEOUT_EXTRA_SECONDS = 3.0
-RETRY_BACKOFF_SECONDS = 1.0
-DB_SAVE_SECONDS = 1.5
+# バッチ API で1件増えるごとに増える処理時間
+API_BATCH_PER_ITEM_SECONDS = 0.05
 
+# -------- リトライ制御 (resilience.py) --------
+# 1回目の失敗後の待ち時間の基準。2回目以降は倍々 (上限 RETRY_BACKOFF_MAX_SECONDS) で、
+# 実際には 0〜その値の乱数だけ待つ (full jitter)
+RETRY_BACKOFF_SECONDS = 1.0
+RETRY_BACKOFF_MAX_SECONDS = 8.0
+# リトライは「リクエスト数 × RATIO」回まで (最初の数回ぶんは INITIAL_TOKENS で確保)
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_INITIAL_TOKENS = 5.0
+# 連続でこの回数失敗したらブレーカーを open にして即失敗させる
+BREAKER_FAILURE_THRESHOLD = 5
+# open にしてからこの秒数たったら、お試しで1件だけ通す
+BREAKER_RESET_SECONDS = 5.0
+
+# -------- hedged request (hedging.py) --------
+# True にすると、1回目が p95 を超えても返らないとき2本目を並行で出す
+HEDGE_ENABLED = False
+HEDGE_QUANTILE = 0.95
+# これだけ成功サンプルが集まるまでは hedge しない
+HEDGE_MIN_SAMPLES = 3
+# hedge は「リクエスト数 × RATIO」本まで
+HEDGE_BUDGET_RATIO = 0.1
+HEDGE_BUDGET_INITIAL_TOKENS = 2.0
+
+# -------- 集計 (pipeline_stats.py) --------
+# 実行中もこの間隔で途中経過 (件数) をログに出す
+STATS_REPORT_INTERVAL_SECONDS = 5.0
+
+# -------- ログ出力 (async_logger.py) --------
+# "print": 従来どおり1件ずつ画面に表示
+# "jsonl": queue に積んで別スレッドがまとめて JSON Lines で書く (ループを止めない)
+# "off": 何も出さない (bench_pipeline_scale.py でオーバーヘッドだけを測るとき用)
+LOG_BACKEND = "print"
+# None なら標準出力
+LOG_PATH = None
+LOG_LEVEL = "INFO"
+# 試行ごとに出るうるさいログ (ATTEMPT セクション) は INFO 以下をこの割合だけ残す
+# (WARNING 以上は全部残す。api_limit の変化や hedge 発射など、たまにしか出ない API のログは間引かない)
+LOG_SAMPLE_RATES = {"ATTEMPT": 0.2}
+
+# -------- DB保存 --------
+# "batch": writer ステージでまとめて commit / "per_order": 1件ごとに to_thread + commit
+SAVE_MODE = "batch"
+DB_PATH = Path(__file__).with_name("orders.sqlite3")
+# この件数たまったら commit
+WRITE_BATCH_SIZE = 50
+# 1件目が来てからこの秒数たったら、件数未満でも commit
+WRITE_BATCH_MAX_WAIT_SECONDS = 0.5
+# writer 用 queue 上限: 書き込みが追いつかないときだけ worker 側が待つ
+WRITE_QUEUE_MAXSIZE = 100
+
+# -------- 受注 queue (fair_queue.py / durable_queue.py) --------
+# "fair": 優先度クラス + 顧客ごとの公平な取り出し (落ちたら queue の中身は消える)
+# "memory": asyncio.Queue (到着順)
+# "durable": SQLite に保存 (到着順)。put は commit まで待ち、起動時に未処理 (task_done 前) の分を再投入
+QUEUE_BACKEND = "fair"
+QUEUE_PATH = Path(__file__).with_name("order_queue.sqlite3")
+# 優先度クラス: 上から順に判定し、amount がしきい値以上なら そのクラス (先頭ほど優先)
+PRIORITY_CLASSES = (("high", 200000), ("normal", 0))
+# 顧客ごとの重み (無い顧客は 1)。重み2なら同じクラス内で2倍の頻度で取り出される
+CUSTOMER_WEIGHTS = {}
+
+
+# -------- API の micro-batching (micro_batch.py) --------
+# True: 同時に来た呼び出しをまとめてバッチ API に1回で送る (api_sem もバッチ1回で1枠)
+# hedge はバッチとは併用しない (HEDGE_ENABLED は無視される)
+API_BATCH_ENABLED = False
+# この件数たまったらすぐ送る
+API_BATCH_MAX_SIZE = 16
+# 1件目が来てからこの秒数で、件数未満でも送る
+API_BATCH_WINDOW_SECONDS = 0.05
+
+# -------- 重複注文の抑止 (idempotency.py) --------
+# 再投入やクライアントの再送で同じ注文IDが来ても、API 呼び出しと保存は1回だけにする
+IDEMPOTENCY_ENABLED = True
+# メモリに覚える完了済み注文の件数 (LRU)
+IDEMPOTENCY_MAX_ENTRIES = 10_000
+# None: メモリだけ (再起動で忘れる) / パス: 完了済みを SQLite にも残す
+IDEMPOTENCY_PATH = None
+
+# -------- 入力ソース (jsonl_source.py) --------
+# None: 下の ORDERS を INGEST_INTERVAL_SECONDS 間隔で流す (デモ)
+# "orders.jsonl" など: JSON Lines を1行ずつ読む / "-": 標準入力
+# 読む速さは queue の空き次第 (QUEUE_MAXSIZE が満杯なら読み込みも止まる)
+ORDERS_SOURCE = None
+# True: ファイル末尾に来ても終わらず、追記を待ち続ける (tail -f)
+ORDERS_SOURCE_FOLLOW = False
+ORDERS_SOURCE_POLL_SECONDS = 0.5
+# FOLLOW のとき、この秒数追記がなければ受付終了 (None なら終わらない)
+ORDERS_SOURCE_IDLE_SECONDS = None
+
+# -------- トレース (tracing.py) --------
+# None: 記録しない / パス: 受付・queue 待ち・API 試行・backoff・保存の区間を
+# Chrome trace-event 形式の JSON に書き出す (chrome://tracing や https://ui.perfetto.dev で開く)
+TRACE_PATH = None
+# 記録する最大件数 (超えた分は捨てる)
+TRACE_MAX_EVENTS = 1_000_000
+
+# -------- マルチプロセス (sharded_runner.py) --------
+# 1: 1プロセス (1つのイベントループ) で処理する
+# N: 注文を SHARD_KEY で N 個のプロセスに振り分け、それぞれが自分の worker pool で処理する
+#    各 shard は DB / 受注 queue / idempotency / trace を自分専用のファイル (*.shard0.* など) に書き、
+#    終了時に親が集計と DB_PATH への保存結果をまとめる
+SHARDS = 1
+# 振り分けのキー。同じ顧客は必ず同じ shard に行くので、
+# 顧客ごとの公平な取り出しと注文IDの重複排除が shard の中だけで完結する
+SHARD_KEY = "customer"
+# 親 -> shard へはこの件数ずつまとめて送る (プロセス間の受け渡し回数を減らす)
+SHARD_BATCH_SIZE = 64
+# shard ごとの送信 queue の上限 (バッチ数)。shard が遅いと親の読み込みが待つ
+SHARD_QUEUE_MAXSIZE = 16
 
 # 実務イメージの入力データ。
 # plan:
@@ -50,47 +226,162 @@ ORDERS = [
     {"id": "ORD-1004", "customer": "東和電機", "amount": 90000, "plan": ["ok"]},
     {"id": "ORD-1005", "customer": "南野企画", "amount": 75000, "plan": ["timeout", "timeout", "ok"]},
     {"id": "ORD-1006", "customer": "西原物流", "amount": 41000, "plan": ["ok"]},
+    # クライアントの再送 (同じ注文ID) -> idempotency で API / 保存は省略される
+    {"id": "ORD-1001", "customer": "青山商事", "amount": 120000, "plan": ["ok"]},
 ]
 
 
-def log(section, message, blank=False):
-    """見やすいログ形式で表示する。"""
+# main() が LOG_BACKEND に応じて設定する (None なら print)
+_logger = None
+# main() が TRACE_PATH に応じて設定する (無効のままなら何も記録しない)
+_tracer = Tracer(enabled=False)
+
+
+def log(section, message, blank=False, level="INFO"):
+    """
+    見やすいログ形式で表示する。
+
+    LOG_BACKEND="jsonl" のときは async_logger に積むだけで、すぐ戻る。
+    """
+    if _logger is not None:
+        _logger.log(level, section, message)
+        return
+    if LOG_BACKEND == "off":
+        return
     if blank:
         print()
     print(f"{time.strftime('%X')} | {section:<7} | {message}")
 
 
-def blocking_save(order_id, score):
+def setup_logging():
+    global _logger
+    if LOG_BACKEND == "jsonl":
+        _logger = AsyncLogger(LOG_PATH, level=LOG_LEVEL, sample_rates=LOG_SAMPLE_RATES)
+
+
+def shutdown_logging():
+    global _logger
+    if _logger is not None:
+        logger, _logger = _logger, None
+        logger.close()
+        log("MAIN", f"logger={logger.snapshot()}")
+
+
+def setup_tracing():
+    global _tracer
+    if TRACE_PATH is not None:
+        # queue 待ちは accepted_at (loop.time) から測るので、時計をそろえる
+        _tracer = Tracer(clock=asyncio.get_running_loop().time, max_events=TRACE_MAX_EVENTS)
+
+
+def shutdown_tracing():
+    global _tracer
+    if _tracer.enabled:
+        tracer, _tracer = _tracer, Tracer(enabled=False)
+        tracer.export(TRACE_PATH)
+        log("MAIN", f"trace={tracer.snapshot()} -> {TRACE_PATH}")
+
+
+def record_limiter_wait(stats, kind, seconds):
+    """RateLimitedSlots の待ち時間 (token_wait / slot_wait) を集計とトレースに記録する。"""
+    stats.for_worker("limiter").observe(kind, seconds)
+    if seconds > 0:
+        now = asyncio.get_running_loop().time()
+        _tracer.complete(kind, now - seconds, now)
+
+
+def blocking_save(sink, order_id, score):
     """
-    同期処理の例: DB保存/ファイル書き込みを想定。
+    同期処理の例: 1件ずつ SQLite に保存して commit する (SAVE_MODE="per_order")。
 
     ここはブロッキング処理なので、worker から直接呼ぶとイベントループを止める。
     そのため worker 側では asyncio.to_thread(...) 経由で実行する。
     """
-    time.sleep(DB_SAVE_SECONDS)
+    sink.write_batch([(order_id, score)])
     log("DB", f"保存完了 {order_id} score={score}")
 
 
-async def ingest_orders(order_queue, worker_count):
+def order_priority(order):
+    """
+    注文の優先度クラス名を返す。sla (PRIORITY_CLASSES のクラス名) が付いていればそれを使う。
+    知らない sla や数値でない amount は ValueError (queue に入れる前に弾く)。
+    """
+    if "sla" in order:
+        if order["sla"] not in dict(PRIORITY_CLASSES):
+            raise ValueError(f"unknown sla: {order['sla']!r}")
+        return order["sla"]
+    amount = order["amount"]
+    # bool は int のサブクラスなので別に弾く
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+        raise ValueError(f"amount is not a number: {amount!r}")
+    for name, min_amount in PRIORITY_CLASSES:
+        if amount >= min_amount:
+            return name
+    return PRIORITY_CLASSES[-1][0]
+
+
+def open_order_source():
+    """ORDERS_SOURCE に応じた入力 (async for で1件ずつ取り出せるもの) を返す。"""
+    if ORDERS_SOURCE is None:
+        return iterate_with_interval(ORDERS, INGEST_INTERVAL_SECONDS)
+    return JsonlSource(
+        ORDERS_SOURCE,
+        required=("id", "customer", "amount"),
+        # sla / amount がおかしい行も、壊れた行として on_error に知らせて飛ばす
+        validate=order_priority,
+        follow=ORDERS_SOURCE_FOLLOW,
+        poll_interval=ORDERS_SOURCE_POLL_SECONDS,
+        idle_timeout=ORDERS_SOURCE_IDLE_SECONDS,
+        on_error=lambda line_no, line, exc: log(
+            "INGEST", f"不正な行をスキップ line={line_no} reason={exc}", level="WARNING"
+        ),
+    )
+
+
+async def ingest_orders(order_queue, source=None):
     """
     受注を queue に投入する producer 側。
+    source を渡さなければ open_order_source() から読む (shard では親から届いた注文)。
 
     ポイント:
     - await order_queue.put(...) は queue が満杯なら待機する
-    - 最後に None を worker 数ぶん投入し、worker に終了を伝える
+      (待っている間は入力ソースも次の行を読まない = メモリが増えない)
+    - accepted_at (受付時刻) と priority (優先度クラス) を付けて入れ、
+      worker 側でクラスごとの queue 待ち時間を測る
+    - 終了シグナルは入れない (worker の停止は pool.close() が行う)
     """
-    for order in ORDERS:
-        await asyncio.sleep(INGEST_INTERVAL_SECONDS)
-        await order_queue.put(order)
+    loop = asyncio.get_running_loop()
+    if source is None:
+        source = open_order_source()
+    async for order in source:
+        try:
+            priority = order_priority(order)
+        except ValueError as exc:
+            # ファイルからの入力は JsonlSource が先に弾くので、ここに来るのは組み込みの ORDERS など
+            log("INGEST", f"不正な注文をスキップ {order.get('id')} reason={exc}", level="WARNING")
+            continue
+        # 満杯で put が待った時間も enqueue の区間に入る
+        with _tracer.context(track="ingest", order=order["id"]), _tracer.span(
+            "enqueue", priority=priority
+        ):
+            # 外から来る注文には plan (疑似API の挙動) が無いので、正常応答にしておく
+            await order_queue.put(
+                {
+                    "plan": ["ok"],
+                    **order,
+                    "accepted_at": loop.time(),
+                    "priority": priority,
+                }
+            )
         log(
             "INGEST",
             f"受付 {order['id']} ({order['customer']}) / queue={order_queue.qsize()}",
         )
 
-    for _ in range(worker_count):
-        await order_queue.put(None)
-
-    log("INGEST", "受付終了 (stop signal 投入)", blank=True)
+    if isinstance(source, JsonlSource):
+        log("INGEST", f"受付終了 source={source.snapshot()}", blank=True)
+    else:
+        log("INGEST", "受付終了", blank=True)
 
 
 async def fake_external_api(order, attempt):
@@ -115,117 +406,516 @@ async def fake_external_api(order, attempt):
     return {"score": score}
 
 
-async def call_api_with_retry(order, api_sem):
+async def fake_external_api_batch(requests):
+    """
+    バッチ対応の外部APIの疑似処理。requests = [(order, attempt), ...]
+
+    1回の呼び出しで全件を処理し、1件ごとの結果 (dict か 例外インスタンス) を同じ順番で返す。
+    - 所要時間は API_OK_SECONDS + 1件あたり API_BATCH_PER_ITEM_SECONDS
+    - "timeout" の件は上流側で期限切れになった扱い (TimeoutError を返す。バッチ全体は待たせない)
+    - "error" の件はその件だけ一時エラー
+    """
+    await asyncio.sleep(API_OK_SECONDS + API_BATCH_PER_ITEM_SECONDS * len(requests))
+    results = []
+    for order, attempt in requests:
+        plan = order["plan"]
+        mode = plan[attempt - 1] if attempt - 1 < len(plan) else plan[-1]
+        if mode == "timeout":
+            results.append(asyncio.TimeoutError())
+        elif mode == "error":
+            results.append(RuntimeError("temporary upstream error"))
+        else:
+            results.append({"score": 95 if order["amount"] >= 100000 else 80})
+    return results
+
+
+async def send_api_batch(requests, api_sem):
+    """MicroBatcher から呼ばれる。バッチ1回につき api_sem を1枠だけ使う。"""
+    async with api_sem:
+        # バッチを送り出した worker (1件目 or 満杯にした注文) の行に記録される
+        with _tracer.span("api_batch", size=len(requests)):
+            return await asyncio.wait_for(
+                fake_external_api_batch(requests),
+                timeout=API_TIMEOUT_SECONDS,
+            )
+
+
+async def api_attempt(order, attempt, hedge=False):
+    """
+    1回分の呼び出し (timeout 付き)。
+
+    hedge=True は「別レプリカに出した2本目」の想定なので、
+    plan の次の要素で応答させる (同じ遅いレプリカに当たり続けないように)。
+    """
+    log("ATTEMPT", f"{'hedge' if hedge else 'call'} {order['id']} attempt={attempt}")
+    with _tracer.span("api_attempt", attempt=attempt, hedge=hedge):
+        return await asyncio.wait_for(
+            fake_external_api(order, attempt + 1 if hedge else attempt),
+            timeout=API_TIMEOUT_SECONDS,
+        )
+
+
+async def call_api_with_retry(order, api_sem, policy, hedger=None, batcher=None):
     """
     API呼び出しの保護層。
 
-    1) Semaphore で同時呼び出し数を制限
-    2) wait_for で1回のタイムアウトを制御
-    3) timeout / 一時エラー時はリトライ
+    1) サーキットブレーカーが open なら呼ばずに即失敗 (CircuitOpenError)
+    2) Semaphore で同時呼び出し数を制限
+    3) wait_for で1回のタイムアウトを制御
+    4) timeout / 一時エラー時は、リトライ予算が残っていればジッター付きで待ってリトライ
+
+    API_RATE_LIMIT があれば api_sem は RateLimitedSlots で、2) の前に回数の上限 (token) も待つ。
+
+    batcher があれば、各試行は batcher に渡してバッチ API で送る
+    (Semaphore / timeout はバッチ1回単位で send_api_batch がかける)。
     """
+    policy.budget.record_request()
     for attempt in range(1, MAX_RETRY + 2):
         try:
-            # ここを通るのは同時に API_CONCURRENCY 件まで
-            async with api_sem:
-                log("API", f"call {order['id']} attempt={attempt}")
-                return await asyncio.wait_for(
-                    fake_external_api(order, attempt),
-                    timeout=API_TIMEOUT_SECONDS,
-                )
+            # open 中はここで CircuitOpenError -> except に入らず worker まで伝わる
+            with policy.breaker:
+                if batcher is not None:
+                    log("ATTEMPT", f"batch投入 {order['id']} attempt={attempt}")
+                    return await batcher.submit((order, attempt))
+                if hedger is not None:
+                    # hedge 本も含めて、各試行は hedger の中で api_sem を通る
+                    return await hedger.call(lambda hedge: api_attempt(order, attempt, hedge))
+                # ここを通るのは同時に API_CONCURRENCY 件まで (adaptive なら今の limit 件まで)
+                async with api_sem:
+                    return await api_attempt(order, attempt)
         except asyncio.TimeoutError:
-            log("API", f"timeout {order['id']} attempt={attempt}")
+            log("API", f"timeout {order['id']} attempt={attempt}", level="WARNING")
         except RuntimeError as exc:
-            log("API", f"error {order['id']} attempt={attempt} reason={exc}")
+            log("API", f"error {order['id']} attempt={attempt} reason={exc}", level="WARNING")
 
         if attempt <= MAX_RETRY:
-            log("API", f"retry待機 {order['id']} {RETRY_BACKOFF_SECONDS}秒")
-            await asyncio.sleep(RETRY_BACKOFF_SECONDS)
+            if not policy.budget.try_spend():
+                log("API", f"retry予算切れ {order['id']} -> リトライせず失敗", level="WARNING")
+                break
+            delay = policy.backoff(attempt)
+            log("ATTEMPT", f"retry待機 {order['id']} {delay:.2f}秒")
+            with _tracer.span("backoff", attempt=attempt):
+                await asyncio.sleep(delay)
 
     raise RuntimeError(f"API failed after retries: {order['id']}")
 
 
-async def worker(name, order_queue, api_sem, stats, stats_lock):
+async def handle_order(
+    name, order, api_sem, policy, hedger, batcher, stats, save_result, idempotency
+):
     """
-    queue を読み続ける consumer 側。
-
-    1件ごとの処理:
-    - queue.get() で取得 (空なら待つ)
-    - None なら終了
-    - API呼び出し + DB保存
-    - 成功/失敗を stats に反映
-    - finally で task_done() を必ず呼ぶ
+    worker pool の worker が1件ごとに呼ぶ処理 (consumer 側)。
+
+    - queue.get() / task_done() は pool 側が行う
+    - API呼び出し + save_result で保存側へ受け渡し、commit を待たずに戻る
+      戻り値は commit で完了する Future (pool はその完了時に task_done を呼ぶ)
+    - idempotency があれば、同じ注文IDの2回目以降は API / 保存をせず1回目の結果を使う
+    - 成功/失敗と各段階の所要時間をその worker 専用の集計 (my_stats) に記録
+    - トレースはこの worker の行と、この注文の行に記録する
     """
-    while True:
-        order = await order_queue.get()
-        try:
-            if order is None:
-                log(name, "stop signal 受信 -> 終了", blank=True)
-                return
+    with _tracer.context(track=name, order=order["id"]), _tracer.span("order"):
+        return await _handle_order(
+            name, order, api_sem, policy, hedger, batcher, stats, save_result, idempotency
+        )
 
-            log(name, f"開始 {order['id']} ({order['customer']})", blank=True)
 
-            try:
-                result = await call_api_with_retry(order, api_sem)
+async def _handle_order(
+    name, order, api_sem, policy, hedger, batcher, stats, save_result, idempotency
+):
+    # この worker しか書き込まないので lock は不要 (合算は stats 側が読むときに行う)
+    my_stats = stats.for_worker(name)
+    started_at = my_stats.clock()
+    queue_wait = started_at - order["accepted_at"]
+    my_stats.observe("queue_wait", queue_wait)
+    # 優先度クラスごとの待ち時間 (format_latency で wait_high / wait_normal の行になる)
+    my_stats.observe(f"wait_{order['priority']}", queue_wait)
+    # 待っている間 worker は別の仕事をしているので、注文の行にだけ描く
+    _tracer.complete("queue_wait", order["accepted_at"], started_at, order_only=True)
+    log(name, f"開始 {order['id']} ({order['customer']})", blank=True)
+
+    executed = False
+
+    async def process():
+        nonlocal executed
+        executed = True
+        with my_stats.timed("api"):
+            result = await call_api_with_retry(order, api_sem, policy, hedger, batcher)
+
+        # 保存側へ渡す。batch なら writer の queue に入れるだけで
+        # commit は待たずに次の queue.get() へ戻る
+        # 戻ってくる committed が完了するまでは、idempotency / durable queue に「処理済み」と残さない
+        with my_stats.timed("save"), _tracer.span("save"):
+            committed = await save_result(order["id"], result["score"])
+        return result, committed
+
+    def record(settled):
+        # commit (or 相乗りした1本目の commit) が終わったところで成否を数える
+        exc = RuntimeError("cancelled") if settled.cancelled() else settled.exception()
+        if exc is not None:
+            # 注文単位の失敗として記録し、worker 全体は継続する
+            my_stats.incr("failed")
+            log(name, f"失敗 {order['id']} reason={exc}", level="ERROR")
+        elif executed:
+            my_stats.incr("success")
+            log(name, f"完了 {order['id']}")
+        else:
+            my_stats.incr("deduplicated")
+            _tracer.instant("deduplicated")
+            log(name, f"重複のため省略 {order['id']} (処理済み or 処理中の結果を使用)")
+
+    try:
+        if idempotency is None:
+            _, settled = await process()
+        else:
+            settled = await idempotency.run_deferred(order["id"], process)
+    except Exception as exc:
+        my_stats.incr("failed")
+        log(name, f"失敗 {order['id']} reason={exc}", level="ERROR")
+        return None
+
+    settled.add_done_callback(record)
+    return settled
 
-                # 同期保存処理をスレッドへ逃がす（イベントループを止めない）
-                await asyncio.to_thread(blocking_save, order["id"], result["score"])
 
-                # stats は共有データなので lock で保護して更新
-                async with stats_lock:
-                    stats["success"] += 1
+async def main():
+    if SHARDS > 1:
+        stats = await run_sharded()
+    else:
+        stats = await run_pipeline()
+    return stats.snapshot()
 
-                log(name, f"完了 {order['id']}")
-            except Exception as exc:
-                # 注文単位の失敗として記録し、worker 全体は継続する
-                async with stats_lock:
-                    stats["failed"] += 1
-                log(name, f"失敗 {order['id']} reason={exc}")
-        finally:
-            # get で受け取った1件に対する完了通知。
-            # これが不足すると queue.join() が解除されない。
-            order_queue.task_done()
 
+async def run_pipeline(source=None, prefix=""):
+    """
+    1つのイベントループでパイプライン全体を動かし、集計 (PipelineStats) を返す。
 
-async def main():
+    - source: 注文の入力 (None なら open_order_source())
+    - prefix: worker 名の前に付ける文字列 (shard ごとに集計を分けるため)
+    """
     # -------- 起動フェーズ --------
+    setup_logging()
+    setup_tracing()
     log("MAIN", "開始", blank=True)
     log(
         "MAIN",
         (
-            f"設定 worker={WORKER_COUNT}, queue_max={QUEUE_MAXSIZE}, "
+            f"設定 worker={WORKER_MIN}..{WORKER_MAX}, queue_max={QUEUE_MAXSIZE}, "
             f"api_concurrency={API_CONCURRENCY}, timeout={API_TIMEOUT_SECONDS}s"
         ),
     )
 
-    order_queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
-    api_sem = asyncio.Semaphore(API_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    if QUEUE_BACKEND == "durable":
+        # 前回の受付時刻は別のループの時計なので、再投入時に付け直す
+        order_queue = await DurableQueue(
+            QUEUE_PATH,
+            maxsize=QUEUE_MAXSIZE,
+            on_replay=lambda order: {**order, "accepted_at": loop.time()},
+        ).start()
+        if order_queue.replayed:
+            log("MAIN", f"前回の未処理 {order_queue.replayed}件を再投入", level="WARNING")
+    elif QUEUE_BACKEND == "fair":
+        order_queue = FairQueue(
+            maxsize=QUEUE_MAXSIZE,
+            classes=[name for name, _ in PRIORITY_CLASSES],
+            priority_of=lambda order: order["priority"],
+            key_of=lambda order: order["customer"],
+            weights=CUSTOMER_WEIGHTS,
+        )
+    else:
+        order_queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+
+    # 集計の入れ物。各 worker は stats.for_worker(name) で自分専用の集計を持つ
+    stats = PipelineStats(counter_names=("success", "failed", "deduplicated"))
+    reporter = asyncio.create_task(
+        report_periodically(
+            stats,
+            STATS_REPORT_INTERVAL_SECONDS,
+            lambda snapshot: log("STATS", f"途中経過 {snapshot['counters']}"),
+        )
+    )
 
-    # 全workerで共有する集計オブジェクト
-    stats = {"success": 0, "failed": 0}
-    stats_lock = asyncio.Lock()
+    if ADAPTIVE_CONCURRENCY:
+        # Semaphore と同じ async with で使える。上限の変化はログに出す
+        api_slots = AdaptiveLimiter(
+            API_CONCURRENCY,
+            min_limit=API_CONCURRENCY_MIN,
+            max_limit=API_CONCURRENCY_MAX,
+            latency_threshold=API_LATENCY_TARGET_SECONDS,
+            on_change=lambda old, new: log("API", f"api_limit {old} -> {new}"),
+        )
+    else:
+        api_slots = asyncio.Semaphore(API_CONCURRENCY)
+
+    # 回数の上限があれば「token -> slot」の順に取るリミッターで包む (async with の使い方は同じ)
+    # どちらで待ったかは集計の token_wait / slot_wait に分けて記録する
+    api_sem = api_slots
+    rate_bucket = None
+    if API_RATE_LIMIT is not None:
+        if API_RATE_SHARED_PATH is not None:
+            rate_bucket = FileTokenBucket(API_RATE_SHARED_PATH, API_RATE_LIMIT, API_RATE_BURST)
+        else:
+            rate_bucket = TokenBucket(API_RATE_LIMIT, API_RATE_BURST)
+        api_sem = RateLimitedSlots(
+            rate_bucket,
+            api_slots,
+            on_wait=lambda kind, seconds: record_limiter_wait(stats, kind, seconds),
+        )
+
+    # backoff / retry budget / circuit breaker は全workerで1つを共有する
+    policy = RetryPolicy(
+        breaker=CircuitBreaker(
+            "api",
+            failure_threshold=BREAKER_FAILURE_THRESHOLD,
+            reset_timeout=BREAKER_RESET_SECONDS,
+            on_change=lambda old, new: log("API", f"breaker {old} -> {new}", level="WARNING"),
+        ),
+        budget=RetryBudget(
+            ratio=RETRY_BUDGET_RATIO,
+            initial_tokens=RETRY_BUDGET_INITIAL_TOKENS,
+        ),
+        backoff_base=RETRY_BACKOFF_SECONDS,
+        backoff_max=RETRY_BACKOFF_MAX_SECONDS,
+    )
+
+    batcher = None
+    if API_BATCH_ENABLED:
+        batcher = MicroBatcher(
+            lambda requests: send_api_batch(requests, api_sem),
+            max_batch_size=API_BATCH_MAX_SIZE,
+            max_wait=API_BATCH_WINDOW_SECONDS,
+            on_batch=lambda requests: log(
+                "API", f"batch call {len(requests)}件 {[order['id'] for order, _ in requests]}"
+            ),
+        )
+
+    hedger = None
+    if HEDGE_ENABLED and batcher is None:
+        hedger = Hedger(
+            api_sem,
+            RetryBudget(ratio=HEDGE_BUDGET_RATIO, initial_tokens=HEDGE_BUDGET_INITIAL_TOKENS),
+            quantile=HEDGE_QUANTILE,
+            min_samples=HEDGE_MIN_SAMPLES,
+            on_hedge=lambda delay: log("API", f"hedge 発射 ({delay:.2f}秒超過)"),
+        )
+
+    # -------- 保存先の準備 --------
+    sink = SqliteOrderSink(DB_PATH)
+    writer = None
+    if SAVE_MODE == "batch":
+        # commit は worker とは別の行 (writer) に記録する
+        with _tracer.context(track="writer", order=None):
+            writer = BatchWriter(
+                sink,
+                batch_size=WRITE_BATCH_SIZE,
+                max_wait=WRITE_BATCH_MAX_WAIT_SECONDS,
+                queue_maxsize=WRITE_QUEUE_MAXSIZE,
+                on_commit=lambda rows: log(
+                    "DB", f"commit {len(rows)}件 {[row[0] for row in rows]}"
+                ),
+                on_error=lambda rows, exc: log("DB", f"commit失敗 {len(rows)}件 reason={exc}"),
+                stats=stats.for_worker(f"{prefix}writer"),
+                tracer=_tracer,
+            ).start()
+
+        # 戻り値は commit で完了する Future (commit に失敗したら RuntimeError になる)
+        save_result = writer.submit
+    else:
+
+        async def save_result(order_id, score):
+            # 同期保存処理をスレッドへ逃がす（イベントループを止めない）
+            # スレッドの空き待ちも含めた時間が to_thread の区間になる
+            with _tracer.span("to_thread", func="blocking_save"):
+                await asyncio.to_thread(blocking_save, sink, order_id, score)
+            # ここで保存は終わっているので、完了済みの Future を返す (batch と同じ形)
+            committed = asyncio.get_running_loop().create_future()
+            committed.set_result(None)
+            return committed
+
+    # 同じ注文IDの重複処理を防ぐ (全workerで1つを共有する)
+    idempotency = None
+    if IDEMPOTENCY_ENABLED:
+        idempotency = IdempotencyCache(
+            max_entries=IDEMPOTENCY_MAX_ENTRIES,
+            store=SqliteIdempotencyStore(IDEMPOTENCY_PATH) if IDEMPOTENCY_PATH else None,
+        )
 
     # worker を先に起動して、queue.get() 待機状態にしておく
-    workers = [
-        asyncio.create_task(worker(f"worker-{i+1}", order_queue, api_sem, stats, stats_lock))
-        for i in range(WORKER_COUNT)
-    ]
+    pool = WorkerPool(
+        order_queue,
+        lambda name, order: handle_order(
+            name, order, api_sem, policy, hedger, batcher, stats, save_result, idempotency
+        ),
+        min_workers=WORKER_MIN,
+        max_workers=WORKER_MAX,
+        scale_interval=SCALE_INTERVAL_SECONDS,
+        scale_up_depth=SCALE_UP_QUEUE_DEPTH,
+        max_item_age=SCALE_UP_ITEM_AGE_SECONDS,
+        age_of=lambda order: loop.time() - order["accepted_at"],
+        idle_timeout=WORKER_IDLE_SECONDS,
+        name=f"{prefix}worker",
+        on_scale=lambda old, new, reason: log("POOL", f"worker {old} -> {new} ({reason})"),
+    ).start()
 
     # -------- 投入フェーズ --------
-    await ingest_orders(order_queue, WORKER_COUNT)
+    await ingest_orders(order_queue, source)
 
     # -------- 完了待ちフェーズ --------
-    log("MAIN", "queue.join 待機開始", blank=True)
-    # queue.join は「put された全件に task_done が対応するまで」待つ。
-    await order_queue.join()
-    log("MAIN", "queue.join 解除 (全件 task_done 済み)")
+    log("MAIN", "pool.close 待機開始", blank=True)
+    # queue.join で「put された全件に task_done が対応するまで」待ち、
+    # そのあと get で待っているだけの worker を止める (終了シグナル不要)
+    await pool.close()
+    log("MAIN", f"pool.close 完了 (全件 task_done 済み) / pool={pool.snapshot()}")
+
+    if writer is not None:
+        # worker が全員終わった = もう submit は来ないので、残りを書き切って止める
+        log("MAIN", "writer 停止待ち (残りを commit)")
+        await writer.close()
+        log(
+            "MAIN",
+            f"writer rows={writer.rows_written} batches={writer.batches} failed={writer.rows_failed}",
+        )
+    sink.close()
+    reporter.cancel()
+
+    if QUEUE_BACKEND == "durable":
+        # 残っている ack (処理済みの記録) を書いてから閉じる
+        await order_queue.close()
+        log("MAIN", f"order_queue={order_queue.snapshot()}")
+
+    if ADAPTIVE_CONCURRENCY:
+        log("MAIN", f"api_limiter={api_slots.snapshot()}")
+    if rate_bucket is not None:
+        log("MAIN", f"api_rate={api_sem.snapshot()}")
+        await rate_bucket.close()
+    log("MAIN", f"api_policy={policy.snapshot()}")
+    if hedger is not None:
+        log("MAIN", f"api_hedge={hedger.snapshot()}")
+    if batcher is not None:
+        await batcher.close()
+        log("MAIN", f"api_batch={batcher.snapshot()}")
+    if idempotency is not None:
+        log("MAIN", f"idempotency={idempotency.snapshot()}")
+        if idempotency.store is not None:
+            idempotency.store.close()
+
+    for line in format_latency(stats.snapshot()):
+        log("STATS", line)
+    log("MAIN", f"終了 / stats={stats.counters()}", blank=True)
+    shutdown_tracing()
+    # 残りのログを書き切る (jsonl のときだけ)
+    shutdown_logging()
+    return stats
+
+
+def shard_path(path, index):
+    """shard 専用のファイル名 (orders.sqlite3 -> orders.shard0.sqlite3)。None はそのまま。"""
+    if path is None:
+        return None
+    path = Path(path)
+    return path.with_name(f"{path.stem}.shard{index}{path.suffix}")
+
+
+def shard_settings():
+    """
+    子プロセスへ渡す設定値 (大文字の名前のもの)。
+    spawn で起動した子はモジュールを読み直して初期値に戻るので、親で変えた値を渡し直す。
+    ORDERS は親だけが読む (generator のこともあり pickle できない) ので渡さない。
+    """
+    return {
+        name: value for name, value in globals().items() if name.isupper() and name != "ORDERS"
+    }
+
 
-    log("MAIN", "gather 待機開始 (worker Task 終了待ち)")
-    # gather は worker Task 自体の終了を待つ。
-    # (None を受けて return した Task をここで回収)
-    await asyncio.gather(*workers)
+async def run_shard(index, source, settings):
+    """sharded_runner の子プロセスで動く1つの shard。"""
+    global SHARDS, DB_PATH, QUEUE_PATH, IDEMPOTENCY_PATH, TRACE_PATH
+    globals().update(settings)
+    SHARDS = 1
+    # SQLite への同時書き込みを避けるため、ファイルは shard ごとに分ける
+    DB_PATH = shard_path(DB_PATH, index)
+    QUEUE_PATH = shard_path(QUEUE_PATH, index)
+    IDEMPOTENCY_PATH = shard_path(IDEMPOTENCY_PATH, index)
+    TRACE_PATH = shard_path(TRACE_PATH, index)
+    return await run_pipeline(source, prefix=f"shard{index}-")
 
-    log("MAIN", f"終了 / stats={stats}", blank=True)
+
+async def run_sharded():
+    """
+    注文を SHARDS 個のプロセスに振り分けて処理し、集計と保存結果を親にまとめる。
+
+    1) 親は入力を読み、SHARD_KEY で決まる shard へ送るだけ (API も保存もしない)
+    2) 各 shard は run_pipeline を自分のイベントループで動かす
+    3) 全 shard が終わったら、worker 別の集計を合算し、shard ごとの DB を DB_PATH に取り込む
+    """
+    setup_logging()
+    log("MAIN", f"開始 shards={SHARDS} key={SHARD_KEY}", blank=True)
+    settings = shard_settings()
+    rate_path = None
+    if API_RATE_LIMIT is not None and API_RATE_SHARED_PATH is None:
+        # shard ごとに別々の bucket だと合計で SHARDS 倍呼んでしまうので、ファイルで共有する
+        rate_path = Path(DB_PATH).with_name(f"{Path(DB_PATH).stem}.api_rate")
+        rate_path.unlink(missing_ok=True)
+        settings["API_RATE_SHARED_PATH"] = rate_path
+    runner = ShardedRunner(
+        functools.partial(run_shard, settings=settings),
+        shards=SHARDS,
+        key_of=lambda order: order[SHARD_KEY],
+        batch_size=SHARD_BATCH_SIZE,
+        queue_maxsize=SHARD_QUEUE_MAXSIZE,
+    ).start()
+    try:
+        async for order in open_order_source():
+            await runner.submit(order)
+        log("MAIN", f"受付終了 / runner={runner.snapshot()}", blank=True)
+        shard_stats = await runner.close()
+    except BaseException:
+        # 例外や Ctrl+C (cancel) のときは子プロセスを止めてから抜ける
+        runner.abort()
+        raise
+
+    # worker 名は shard ごとに違う (shard0-worker-1 など) ので、合算しても混ざらない
+    stats = PipelineStats(counter_names=shard_stats[0].counter_names)
+    for index, one in enumerate(shard_stats):
+        stats.merge(one)
+        log("STATS", f"shard{index} {one.counters()}")
+
+    sink = SqliteOrderSink(DB_PATH)
+    for index in range(SHARDS):
+        path = shard_path(DB_PATH, index)
+        merged = await asyncio.to_thread(sink.merge_from, path)
+        path.unlink()
+        log("DB", f"shard{index} の {merged}件を {DB_PATH.name} に取り込み")
+    sink.close()
+    if rate_path is not None:
+        rate_path.unlink(missing_ok=True)
+
+    for line in format_latency(stats.snapshot()):
+        log("STATS", line)
+    log("MAIN", f"終了 / stats={stats.counters()}", blank=True)
+    shutdown_logging()
+    return stats
+
+
+def apply_command_line(argv=None):
+    """コマンドライン引数で入力ソース / トレース / プロセス数の設定値を上書きする。"""
+    global ORDERS_SOURCE, ORDERS_SOURCE_FOLLOW, TRACE_PATH, SHARDS
+    parser = argparse.ArgumentParser(description="注文処理パイプライン")
+    parser.add_argument("source", nargs="?", help='JSON Lines ファイル ("-" なら標準入力)')
+    parser.add_argument("--follow", action="store_true", help="追記を待ち続ける")
+    parser.add_argument("--trace", metavar="PATH", help="Chrome trace 形式の JSON を書き出す")
+    parser.add_argument("--shards", type=int, help="注文を振り分けるプロセス数")
+    args = parser.parse_args(argv)
+    if args.source is not None:
+        ORDERS_SOURCE = args.source
+    if args.follow:
+        ORDERS_SOURCE_FOLLOW = True
+    if args.trace is not None:
+        TRACE_PATH = args.trace
+    if args.shards is not None:
+        SHARDS = args.shards
 
 
 if __name__ == "__main__":
+    apply_command_line()
     asyncio.run(main())
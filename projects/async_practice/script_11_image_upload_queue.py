@@ -3,16 +3,80 @@
 # 1) Queue でアップロード要求を受け渡す
 # 2) Worker が並行で処理する
 # 3) 外部スキャンAPIを Semaphore + timeout + retry で守る
-# 4) 同期処理(サムネイル生成)を to_thread へ逃がす
+# 4) CPU負荷の高い同期処理(サムネイル生成)を executor へ逃がす
+#    (to_thread / thread / process を切り替え可能: stage_executor.py)
 # 5) join / gather で「仕事完了」と「Task終了」を分けて待つ
-
+# 6) 同時スキャン上限を AIMD で自動調整する (adaptive_limit.py)
+# 7) ジッター付き指数バックオフ / リトライ予算 / サーキットブレーカー (resilience.py)
+# 8) 遅い応答には hedge (2本目) を出して先に返った方を使う (hedging.py, 任意)
+# 9) worker ごとの集計 + 段階ごとの所要時間ヒストグラム (pipeline_stats.py)
+# 10) ログを別スレッドでまとめて JSON Lines に書く (async_logger.py, 任意)
+# 11) queue の混み具合で worker 数を増減し、終了シグナルなしで止める (worker_pool.py)
+# 12) 段階ごとに queue と worker を分け、背圧と段階ごとの稼働率を見る (stage_pipeline.py)
+# 13) アップロード要求を JSON Lines ファイル / 標準入力から少しずつ読む (jsonl_source.py, 任意)
+# 14) ファイルごと / worker ごとの処理区間を記録し、Chrome trace で開ける JSON に書き出す (tracing.py, 任意)
+# 15) 同時実行数とは別に「1秒あたりのスキャン回数」を token bucket で抑える (rate_limit.py, 任意)
+# 16) 大きいファイルは part に分けて並行に送り、失敗した part だけ送り直す (chunked_upload.py)
+#     part の同時送信数は全 worker で共有し、残りサイズの小さいファイルを先に通す
+#
+# 実行例:
+#   python script_11_image_upload_queue.py                    # 組み込みの UPLOAD_REQUESTS
+#   python script_11_image_upload_queue.py uploads.jsonl      # ファイル ("-" なら標準入力)
+#   python script_11_image_upload_queue.py uploads.jsonl --follow   # 追記を待ち続ける
+#   python script_11_image_upload_queue.py --trace trace.json  # https://ui.perfetto.dev で開く
+
+import argparse
 import asyncio
 import time
+from pathlib import Path
+
+from adaptive_limit import AdaptiveLimiter
+from async_logger import AsyncLogger
+from chunked_upload import MB, ChunkedUploader, LocalDirectoryStorage
+from hedging import Hedger
+from jsonl_source import JsonlSource, iterate_with_interval
+from pipeline_stats import PipelineStats, format_latency, report_periodically
+from rate_limit import FileTokenBucket, RateLimitedSlots, TokenBucket
+from resilience import CircuitBreaker, RetryBudget, RetryPolicy
+from stage_executor import StageExecutor
+from stage_pipeline import Stage, StagePipeline, format_utilization
+from thumbnail import generate_thumbnail
+from tracing import Tracer
+from worker_pool import WorkerPool
 
 # -------- 設定値 --------
-WORKER_COUNT = 3
+# "stages": validate / scan / thumbnail / upload を段階ごとの queue + worker に分ける
+# "single": 1つの worker が4段階を順番に行う (WORKER_MIN..MAX で本数を自動調整)
+PIPELINE_MODE = "stages"
+# 段階ごとの worker 数 (PIPELINE_MODE="stages")。thumbnail は THUMBNAIL_EXECUTOR で実行する
+STAGE_WORKERS = {"validate": 1, "scan": 3, "thumbnail": 2, "upload": 2}
+# 段階の間の queue 上限。下流が詰まると上流の put が待つ (validate の入力は QUEUE_MAXSIZE)
+STAGE_QUEUE_MAXSIZE = {"scan": 2, "thumbnail": 2, "upload": 2}
+# worker 数は MIN..MAX の間で自動で増減する (worker_pool.py)
+WORKER_MIN = 1
+WORKER_MAX = 4
+SCALE_INTERVAL_SECONDS = 1.0
+# worker 1本あたりの queue 残数がこれを超えたら増やす
+SCALE_UP_QUEUE_DEPTH = 1
+# 取り出した要求の queue 待ち時間がこれを超えたら増やす
+SCALE_UP_ITEM_AGE_SECONDS = 2.0
+# この秒数仕事がなかった worker は止める (WORKER_MIN 本までは残す)
+WORKER_IDLE_SECONDS = 3.0
 QUEUE_MAXSIZE = 3
+# ADAPTIVE_CONCURRENCY=True なら SCAN_CONCURRENCY は初期値で MIN..MAX の間を自動で動く
 SCAN_CONCURRENCY = 2
+ADAPTIVE_CONCURRENCY = True
+SCAN_CONCURRENCY_MIN = 1
+SCAN_CONCURRENCY_MAX = 6
+# 成功でもこれより遅ければ「混んでいる」とみなして上限を下げる
+SCAN_LATENCY_TARGET_SECONDS = 2.0
+# 1秒あたりのスキャン呼び出し回数の上限 (rate_limit.py)。None なら回数は制限しない
+# retry / hedge も1回に数える
+SCAN_RATE_LIMIT = None
+# 空いた後でも待たずに呼べる回数 (token を貯めておける最大数)
+SCAN_RATE_BURST = 3
+# 上限を複数プロセス (このスクリプトを複数起動する等) で共有するファイル。None ならこのプロセスだけ
+SCAN_RATE_SHARED_PATH = None
 SCAN_TIMEOUT_SECONDS = 3.0
 MAX_RETRY = 2
 
@@ -21,65 +85,217 @@ VALIDATION_SECONDS = 0.6
 SCAN_OK_SECONDS = 1.4
 SCAN_ERROR_SECONDS = 1.2
 SCAN_TIMEOUT_EXTRA_SECONDS = 2.2
+# リトライ制御 (resilience.py): 待ち時間は 0〜min(MAX, BACKOFF×2^(n-1)) の乱数
 RETRY_BACKOFF_SECONDS = 1.0
-THUMBNAIL_BLOCKING_SECONDS = 1.3
+RETRY_BACKOFF_MAX_SECONDS = 6.0
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_INITIAL_TOKENS = 5.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 4.0
+# hedged request (hedging.py): True で、p95 を超えたスキャンに2本目を並行で出す
+HEDGE_ENABLED = False
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 3
+HEDGE_BUDGET_RATIO = 0.1
+HEDGE_BUDGET_INITIAL_TOKENS = 2.0
+# UPLOAD_MODE="single" のときの、1ファイルの保存にかかる秒数 (サイズによらず一定の疑似)
 UPLOAD_SECONDS = 1.5
+# 実行中もこの間隔で途中経過 (件数) をログに出す (pipeline_stats.py)
+STATS_REPORT_INTERVAL_SECONDS = 5.0
+
+# -------- ログ出力 (async_logger.py) --------
+# "print": 従来どおり画面表示 / "jsonl": 別スレッドがまとめて JSON Lines で書く
+# "off": 何も出さない (ベンチマーク用)
+LOG_BACKEND = "print"
+LOG_PATH = None
+LOG_LEVEL = "INFO"
+# スキャン試行ごとのログ (ATTEMPT セクション) は INFO 以下をこの割合だけ残す
+# (scan_limit の変化や hedge 発射など、たまにしか出ない SCAN のログは間引かない)
+LOG_SAMPLE_RATES = {"ATTEMPT": 0.2}
+
+# -------- サムネイル生成 (thumbnail.py) --------
+# 純Pythonの縮小処理は GIL を握るので、"process" にしないと worker 同士で1コアを取り合う
+# "to_thread" / "thread" / "process"
+THUMBNAIL_EXECUTOR = "process"
+# PIPELINE_MODE="single" のときの executor の大きさ ("stages" では STAGE_WORKERS["thumbnail"])
+THUMBNAIL_EXECUTOR_WORKERS = WORKER_MAX
+# 元画像 (グレースケール) の大きさと縮小率
+THUMBNAIL_SOURCE_WIDTH = 2048
+THUMBNAIL_SOURCE_HEIGHT = 1536
+THUMBNAIL_FACTOR = 8
+
+# -------- アップロード (chunked_upload.py) --------
+# "chunked": part に分けて STORAGE_DIR に並行で保存 (失敗した part だけ再送、途中からの再開あり)
+# "single": 1ファイルを UPLOAD_SECONDS かけて送る疑似処理 (何も書かない)
+UPLOAD_MODE = "chunked"
+# ストレージの代わりのディレクトリ。途中の part は STORAGE_DIR/.uploads/<ファイル名>/ に残る
+STORAGE_DIR = Path(__file__).with_name("storage")
+UPLOAD_PART_MB = 2.0
+# 全 worker 合計での part の同時送信数
+UPLOAD_CONCURRENCY = 4
+# part の送信にかかる時間の疑似 (1MB あたりの秒数)
+UPLOAD_SECONDS_PER_MB = 0.2
+# part ごとの再送回数と、再送前の待ち時間 (0〜min(MAX, BACKOFF×2^(n-1)) の乱数)
+UPLOAD_PART_RETRY = 3
+UPLOAD_PART_BACKOFF_SECONDS = 0.3
+UPLOAD_PART_BACKOFF_MAX_SECONDS = 2.0
+# 同時送信の空き待ちの順番: 並んだ時刻 + 残りサイズ(MB) × この秒数 の早い順
+# 大きいほど小さいファイルが優先される (0 なら並んだ順)
+UPLOAD_SIZE_PRIORITY_SECONDS_PER_MB = 0.5
+
+# -------- 入力ソース (jsonl_source.py) --------
+# None: 下の UPLOAD_REQUESTS を INGEST_INTERVAL_SECONDS 間隔で流す (デモ)
+# "uploads.jsonl" など: JSON Lines を1行ずつ読む / "-": 標準入力
+# 読む速さは queue の空き次第 (QUEUE_MAXSIZE が満杯なら読み込みも止まる)
+UPLOADS_SOURCE = None
+# True: ファイル末尾に来ても終わらず、追記を待ち続ける (tail -f)
+UPLOADS_SOURCE_FOLLOW = False
+UPLOADS_SOURCE_POLL_SECONDS = 0.5
+# FOLLOW のとき、この秒数追記がなければ受付終了 (None なら終わらない)
+UPLOADS_SOURCE_IDLE_SECONDS = None
+
+# -------- トレース (tracing.py) --------
+# None: 記録しない / パス: 受付・queue 待ち・各段階・スキャン試行・backoff・下流待ちの区間を
+# Chrome trace-event 形式の JSON に書き出す (chrome://tracing や https://ui.perfetto.dev で開く)
+TRACE_PATH = None
+TRACE_MAX_EVENTS = 1_000_000
 
 # 実務イメージの入力データ
 # scan_plan:
 # - "ok": 正常応答
 # - "timeout": タイムアウト
 # - "error": 一時エラー
+# upload_failures (任意): {part 番号: 回数} その part の送信を指定回数だけ一時エラーにする
 UPLOAD_REQUESTS = [
     {"file_id": "IMG-001", "user": "sato", "size_mb": 4.2, "scan_plan": ["ok"]},
     {"file_id": "IMG-002", "user": "tanaka", "size_mb": 7.8, "scan_plan": ["timeout", "ok"]},
     {"file_id": "IMG-003", "user": "suzuki", "size_mb": 3.1, "scan_plan": ["error", "ok"]},
     {"file_id": "IMG-004", "user": "yamada", "size_mb": 31.0, "scan_plan": ["ok"]},  # バリデーション失敗用
-    {"file_id": "IMG-005", "user": "ito", "size_mb": 5.5, "scan_plan": ["ok"]},
+    {
+        "file_id": "IMG-005",
+        "user": "ito",
+        "size_mb": 5.5,
+        "scan_plan": ["ok"],
+        "upload_failures": {"2": 1},  # part 2 だけ1回失敗 -> その part だけ再送
+    },
 ]
 
 
-def log(section, message, blank=False):
-    """ターミナル上で見やすいログ形式にそろえる。"""
+# main() が LOG_BACKEND に応じて設定する (None なら print)
+_logger = None
+# main() が TRACE_PATH に応じて設定する (無効のままなら何も記録しない)
+_tracer = Tracer(enabled=False)
+
+
+def log(section, message, blank=False, level="INFO"):
+    """
+    ターミナル上で見やすいログ形式にそろえる。
+
+    LOG_BACKEND="jsonl" のときは async_logger に積むだけで、すぐ戻る。
+    """
+    if _logger is not None:
+        _logger.log(level, section, message)
+        return
+    if LOG_BACKEND == "off":
+        return
     if blank:
         print()
     print(f"{time.strftime('%X')} | {section:<9} | {message}")
 
 
+def setup_logging():
+    global _logger
+    if LOG_BACKEND == "jsonl":
+        _logger = AsyncLogger(LOG_PATH, level=LOG_LEVEL, sample_rates=LOG_SAMPLE_RATES)
+
+
+def shutdown_logging():
+    global _logger
+    if _logger is not None:
+        logger, _logger = _logger, None
+        logger.close()
+        log("MAIN", f"logger={logger.snapshot()}")
+
+
+def setup_tracing():
+    global _tracer
+    if TRACE_PATH is not None:
+        # queue 待ちは accepted_at (loop.time) から測るので、時計をそろえる
+        _tracer = Tracer(clock=asyncio.get_running_loop().time, max_events=TRACE_MAX_EVENTS)
+
+
+def shutdown_tracing():
+    global _tracer
+    if _tracer.enabled:
+        tracer, _tracer = _tracer, Tracer(enabled=False)
+        tracer.export(TRACE_PATH)
+        log("MAIN", f"trace={tracer.snapshot()} -> {TRACE_PATH}")
+
+
+def record_limiter_wait(stats, kind, seconds):
+    """RateLimitedSlots の待ち時間 (token_wait / slot_wait) を集計とトレースに記録する。"""
+    stats.for_worker("limiter").observe(kind, seconds)
+    if seconds > 0:
+        now = asyncio.get_running_loop().time()
+        _tracer.complete(kind, now - seconds, now)
+
+
 def blocking_generate_thumbnail(file_id):
     """
     同期処理の例。
-    画像ライブラリを使った重い処理を想定して time.sleep で代用。
+    画素バッファを純Pythonで縮小する、本物の CPU 負荷 (thumbnail.py)。
 
     注意:
     - これを async 関数の中で直接呼ぶとイベントループが止まる。
-    - なので worker では asyncio.to_thread(...) で実行する。
+    - なので worker では thumb_executor.run(...) で別スレッド/別プロセスに逃がす。
+    - process で実行するため、呼ぶのは pickle できるトップレベル関数 generate_thumbnail。
     """
-    time.sleep(THUMBNAIL_BLOCKING_SECONDS)
-    return f"thumb_{file_id}.jpg"
+    name, _, _ = generate_thumbnail(
+        file_id, THUMBNAIL_SOURCE_WIDTH, THUMBNAIL_SOURCE_HEIGHT, THUMBNAIL_FACTOR
+    )
+    return name
+
+
+def open_upload_source():
+    """UPLOADS_SOURCE に応じた入力 (async for で1件ずつ取り出せるもの) を返す。"""
+    if UPLOADS_SOURCE is None:
+        return iterate_with_interval(UPLOAD_REQUESTS, INGEST_INTERVAL_SECONDS)
+    return JsonlSource(
+        UPLOADS_SOURCE,
+        required=("file_id", "user", "size_mb"),
+        follow=UPLOADS_SOURCE_FOLLOW,
+        poll_interval=UPLOADS_SOURCE_POLL_SECONDS,
+        idle_timeout=UPLOADS_SOURCE_IDLE_SECONDS,
+        on_error=lambda line_no, line, exc: log(
+            "INGEST", f"不正な行をスキップ line={line_no} reason={exc}", level="WARNING"
+        ),
+    )
 
 
-async def receive_upload_requests(upload_queue, worker_count):
+async def receive_upload_requests(upload_queue):
     """
     producer 側: アップロード要求を queue に入れる。
 
-    流れ:
-    1) 一定間隔でリクエストを queue に投入
-    2) すべて投入後、終了シグナル(None)を worker 数ぶん投入
+    入力ソースから1件ずつ queue に投入する (queue 待ち時間を測るため受付時刻を付ける)。
+    queue が満杯なら put で待ち、その間は入力ソースも次の行を読まない。
+    終了シグナルは入れない (worker の停止は close() が行う)。
     """
-    for req in UPLOAD_REQUESTS:
-        await asyncio.sleep(INGEST_INTERVAL_SECONDS)
-        await upload_queue.put(req)
+    loop = asyncio.get_running_loop()
+    source = open_upload_source()
+    async for req in source:
+        # 満杯で put が待った時間も enqueue の区間に入る
+        with _tracer.context(track="ingest", order=req["file_id"]), _tracer.span("enqueue"):
+            # 外から来る要求には scan_plan (疑似スキャンの挙動) が無いので、正常応答にしておく
+            await upload_queue.put({"scan_plan": ["ok"], **req, "accepted_at": loop.time()})
         log(
             "INGEST",
             f"受付 {req['file_id']} user={req['user']} size={req['size_mb']}MB / queue={upload_queue.qsize()}",
         )
 
-    # queue の1要素は1workerしか取れないため、終了シグナルは worker 数ぶん必要。
-    for _ in range(worker_count):
-        await upload_queue.put(None)
-
-    log("INGEST", "受付終了 (stop signal 投入)", blank=True)
+    if isinstance(source, JsonlSource):
+        log("INGEST", f"受付終了 source={source.snapshot()}", blank=True)
+    else:
+        log("INGEST", "受付終了", blank=True)
 
 
 async def validate_request(req):
@@ -109,137 +325,413 @@ async def fake_scan_api(req, attempt):
     return {"safe": True}
 
 
-async def scan_with_retry(req, scan_sem):
+async def scan_attempt(req, attempt, hedge=False):
+    """
+    1回分の呼び出し (timeout 付き)。
+
+    hedge=True は「別レプリカに出した2本目」の想定なので、
+    plan の次の要素で応答させる (同じ遅いレプリカに当たり続けないように)。
+    """
+    log("ATTEMPT", f"{'hedge' if hedge else 'call'} {req['file_id']} attempt={attempt}")
+    with _tracer.span("scan_attempt", attempt=attempt, hedge=hedge):
+        return await asyncio.wait_for(
+            fake_scan_api(req, attempt + 1 if hedge else attempt),
+            timeout=SCAN_TIMEOUT_SECONDS,
+        )
+
+
+async def scan_with_retry(req, scan_sem, policy, hedger=None):
     """
     外部API呼び出しの保護層。
 
-    1) Semaphore で同時呼び出し数を制限
-    2) wait_for で timeout を付与
-    3) timeout / 一時エラーは retry
+    1) サーキットブレーカーが open なら呼ばずに即失敗
+    2) Semaphore で同時呼び出し数を制限
+    3) wait_for で timeout を付与
+    4) timeout / 一時エラーは、リトライ予算の範囲でジッター付きバックオフ後に retry
+
+    SCAN_RATE_LIMIT があれば scan_sem は RateLimitedSlots で、2) の前に回数の上限 (token) も待つ。
     """
+    policy.budget.record_request()
     for attempt in range(1, MAX_RETRY + 2):
         try:
-            async with scan_sem:
-                log("SCAN", f"call {req['file_id']} attempt={attempt}")
-                return await asyncio.wait_for(
-                    fake_scan_api(req, attempt),
-                    timeout=SCAN_TIMEOUT_SECONDS,
-                )
+            # open 中はここで CircuitOpenError -> except に入らず worker まで伝わる
+            with policy.breaker:
+                if hedger is not None:
+                    # hedge 本も含めて、各試行は hedger の中で scan_sem を通る
+                    return await hedger.call(lambda hedge: scan_attempt(req, attempt, hedge))
+                async with scan_sem:
+                    return await scan_attempt(req, attempt)
         except asyncio.TimeoutError:
-            log("SCAN", f"timeout {req['file_id']} attempt={attempt}")
+            log("SCAN", f"timeout {req['file_id']} attempt={attempt}", level="WARNING")
         except RuntimeError as exc:
-            log("SCAN", f"error {req['file_id']} attempt={attempt} reason={exc}")
+            log("SCAN", f"error {req['file_id']} attempt={attempt} reason={exc}", level="WARNING")
 
         if attempt <= MAX_RETRY:
-            log("SCAN", f"retry待機 {req['file_id']} {RETRY_BACKOFF_SECONDS}秒")
-            await asyncio.sleep(RETRY_BACKOFF_SECONDS)
+            if not policy.budget.try_spend():
+                log("SCAN", f"retry予算切れ {req['file_id']} -> リトライせず失敗", level="WARNING")
+                break
+            delay = policy.backoff(attempt)
+            log("ATTEMPT", f"retry待機 {req['file_id']} {delay:.2f}秒")
+            with _tracer.span("backoff", attempt=attempt):
+                await asyncio.sleep(delay)
 
     raise RuntimeError(f"scan failed after retries: {req['file_id']}")
 
 
-async def upload_to_storage(req):
-    """ストレージ保存の疑似非同期処理。"""
-    await asyncio.sleep(UPLOAD_SECONDS)
-    return f"https://cdn.example.local/{req['file_id']}.jpg"
-
-
-async def worker(name, upload_queue, scan_sem, stats, stats_lock):
+async def upload_to_storage(req, uploader=None):
     """
-    consumer 側: queue から取り出して1件ずつ処理。
+    ストレージ保存。
 
-    1) get で1件取得 (空なら待機)
-    2) None なら終了
-    3) validate -> scan(retry) -> thumbnail(to_thread) -> upload
-    4) 成功/失敗を stats に反映
-    5) finally で task_done を必ず通知
+    uploader (UPLOAD_MODE="chunked") があれば part に分けて STORAGE_DIR に保存する。
+    無ければサイズによらず UPLOAD_SECONDS かかる疑似処理。
     """
-    while True:
-        req = await upload_queue.get()
-        try:
-            if req is None:
-                log(name, "stop signal 受信 -> 終了", blank=True)
-                return
-
-            log(name, f"開始 {req['file_id']} ({req['user']})", blank=True)
-
-            try:
-                # 1) 事前チェック
-                await validate_request(req)
-
-                # 2) 外部スキャン
-                result = await scan_with_retry(req, scan_sem)
-                if not result["safe"]:
-                    raise RuntimeError("unsafe file detected")
-
-                # 3) 同期処理をスレッドへ逃がす
-                thumb_name = await asyncio.to_thread(blocking_generate_thumbnail, req["file_id"])
-
-                # 4) アップロード保存
-                url = await upload_to_storage(req)
-
-                # 共有集計は lock で保護して更新
-                async with stats_lock:
-                    stats["success"] += 1
-
-                log(name, f"完了 {req['file_id']} -> {thumb_name} -> {url}")
+    key = f"{req['file_id']}.jpg"
+    if uploader is None:
+        await asyncio.sleep(UPLOAD_SECONDS)
+    else:
+        if "upload_failures" in req:
+            uploader.storage.inject_failures(key, req["upload_failures"])
+        # 画像の中身は無いので、サイズぶんの 0 を送る
+        await uploader.upload(
+            key, int(req["size_mb"] * MB), lambda offset, length: bytes(length)
+        )
+    return f"https://cdn.example.local/{key}"
+
+
+def build_uploader():
+    """UPLOAD_MODE="chunked" なら全 worker で共有する ChunkedUploader を返す (single なら None)。"""
+    if UPLOAD_MODE != "chunked":
+        return None
+    return ChunkedUploader(
+        LocalDirectoryStorage(STORAGE_DIR, seconds_per_mb=UPLOAD_SECONDS_PER_MB),
+        part_size=int(UPLOAD_PART_MB * MB),
+        max_concurrency=UPLOAD_CONCURRENCY,
+        max_retries=UPLOAD_PART_RETRY,
+        backoff_base=UPLOAD_PART_BACKOFF_SECONDS,
+        backoff_max=UPLOAD_PART_BACKOFF_MAX_SECONDS,
+        size_priority_seconds_per_mb=UPLOAD_SIZE_PRIORITY_SECONDS_PER_MB,
+        on_retry=lambda key, part, attempt, exc: log(
+            "UPLOAD", f"part 再送 {key} part={part} attempt={attempt} reason={exc}", level="WARNING"
+        ),
+        tracer=_tracer,
+    )
 
-            except ValueError as exc:
-                # バリデーション失敗
-                async with stats_lock:
-                    stats["invalid"] += 1
-                log(name, f"入力不正 {req['file_id']} reason={exc}")
 
-            except Exception as exc:
-                # API失敗や想定外エラー
-                async with stats_lock:
-                    stats["failed"] += 1
-                log(name, f"失敗 {req['file_id']} reason={exc}")
+async def handle_upload(name, req, scan_sem, policy, hedger, thumb_executor, uploader, stats):
+    """
+    consumer 側: worker pool の worker が1件ごとに呼ぶ処理。
 
-        finally:
-            # get で受け取った1件に対応する完了通知。
-            # これが漏れると queue.join() が解除されない。
-            upload_queue.task_done()
+    1) get / task_done は pool 側が行う
+    2) validate -> scan(retry) -> thumbnail(executor) -> upload
+    3) 成功/失敗と各段階の所要時間をその worker 専用の集計 (my_stats) に記録
+    4) トレースはこの worker の行と、このファイルの行に記録する
+    """
+    with _tracer.context(track=name, order=req["file_id"]):
+        await _handle_upload(name, req, scan_sem, policy, hedger, thumb_executor, uploader, stats)
+
+
+async def _handle_upload(name, req, scan_sem, policy, hedger, thumb_executor, uploader, stats):
+    # この worker しか書き込まないので lock は不要 (合算は stats 側が読むときに行う)
+    my_stats = stats.for_worker(name)
+    record_queue_wait(my_stats, req)
+    log(name, f"開始 {req['file_id']} ({req['user']})", blank=True)
+
+    try:
+        # 1) 事前チェック
+        with my_stats.timed("validate"), _tracer.span("validate"):
+            await validate_request(req)
+
+        # 2) 外部スキャン
+        with my_stats.timed("scan"), _tracer.span("scan"):
+            result = await scan_with_retry(req, scan_sem, policy, hedger)
+        if not result["safe"]:
+            raise RuntimeError("unsafe file detected")
+
+        # 3) CPU負荷の高い同期処理を executor (スレッド or 別プロセス) へ逃がす
+        with my_stats.timed("thumbnail"), _tracer.span("thumbnail", executor=THUMBNAIL_EXECUTOR):
+            thumb_name = await thumb_executor.run(
+                blocking_generate_thumbnail, req["file_id"]
+            )
+
+        # 4) アップロード保存
+        with my_stats.timed("upload"), _tracer.span("upload"):
+            url = await upload_to_storage(req, uploader)
+
+        my_stats.incr("success")
+        log(name, f"完了 {req['file_id']} -> {thumb_name} -> {url}")
+
+    except ValueError as exc:
+        # バリデーション失敗
+        my_stats.incr("invalid")
+        log(name, f"入力不正 {req['file_id']} reason={exc}")
+
+    except Exception as exc:
+        # API失敗や想定外エラー
+        my_stats.incr("failed")
+        log(name, f"失敗 {req['file_id']} reason={exc}", level="ERROR")
+
+
+def record_queue_wait(my_stats, req):
+    """受付から worker が取り出すまでの待ち時間を集計とトレースに記録する。"""
+    started_at = my_stats.clock()
+    my_stats.observe("queue_wait", started_at - req["accepted_at"])
+    # 待っている間 worker は別の仕事をしているので、ファイルの行にだけ描く
+    _tracer.complete("queue_wait", req["accepted_at"], started_at, order_only=True)
+
+
+async def validate_stage(name, req, stats):
+    """stages の1段目: queue 待ち時間を記録してから事前チェック。"""
+    record_queue_wait(stats.for_worker(name), req)
+    log(name, f"開始 {req['file_id']} ({req['user']})", blank=True)
+    await validate_request(req)
+    return req
+
+
+async def scan_stage(name, req, scan_sem, policy, hedger):
+    """stages の2段目: 外部スキャン (retry / breaker / hedge 込み)。"""
+    result = await scan_with_retry(req, scan_sem, policy, hedger)
+    if not result["safe"]:
+        raise RuntimeError("unsafe file detected")
+    return req
+
+
+def thumbnail_stage(req):
+    """stages の3段目: executor で実行する同期関数 (process でも動くようトップレベルに置く)。"""
+    return {**req, "thumb": blocking_generate_thumbnail(req["file_id"])}
+
+
+async def upload_stage(name, req, uploader):
+    """stages の4段目: アップロード保存。"""
+    return {**req, "url": await upload_to_storage(req, uploader)}
+
+
+def build_stage_pipeline(upload_queue, scan_sem, policy, hedger, thumb_executor, uploader, stats):
+    """4段階の StagePipeline を組み立てる。先頭段階の入力は upload_queue。"""
+
+    def on_done(name, req):
+        stats.for_worker(name).incr("success")
+        log(name, f"完了 {req['file_id']} -> {req['thumb']} -> {req['url']}")
+
+    def on_error(name, stage_name, req, exc):
+        if isinstance(exc, ValueError):
+            # バリデーション失敗
+            stats.for_worker(name).incr("invalid")
+            log(name, f"入力不正 {req['file_id']} reason={exc}")
+        else:
+            # API失敗や想定外エラー
+            stats.for_worker(name).incr("failed")
+            log(name, f"失敗 {req['file_id']} stage={stage_name} reason={exc}", level="ERROR")
+
+    stages = [
+        Stage(
+            "validate",
+            lambda name, req: validate_stage(name, req, stats),
+            workers=STAGE_WORKERS["validate"],
+            queue=upload_queue,
+        ),
+        Stage(
+            "scan",
+            lambda name, req: scan_stage(name, req, scan_sem, policy, hedger),
+            workers=STAGE_WORKERS["scan"],
+            queue_maxsize=STAGE_QUEUE_MAXSIZE["scan"],
+        ),
+        Stage(
+            "thumbnail",
+            thumbnail_stage,
+            workers=STAGE_WORKERS["thumbnail"],
+            queue_maxsize=STAGE_QUEUE_MAXSIZE["thumbnail"],
+            executor=thumb_executor,
+        ),
+        Stage(
+            "upload",
+            lambda name, req: upload_stage(name, req, uploader),
+            workers=STAGE_WORKERS["upload"],
+            queue_maxsize=STAGE_QUEUE_MAXSIZE["upload"],
+        ),
+    ]
+    # 段階ごとの区間 (validate / scan / ... / blocked) はパイプライン側が記録する
+    return StagePipeline(
+        stages,
+        on_done=on_done,
+        on_error=on_error,
+        stats=stats,
+        tracer=_tracer,
+        key_of=lambda req: req["file_id"],
+    )
 
 
 async def main():
     # ---- 起動フェーズ ----
+    setup_logging()
+    setup_tracing()
     log("MAIN", "開始", blank=True)
     log(
         "MAIN",
         (
-            f"設定 worker={WORKER_COUNT}, queue_max={QUEUE_MAXSIZE}, "
-            f"scan_concurrency={SCAN_CONCURRENCY}, timeout={SCAN_TIMEOUT_SECONDS}s"
+            f"設定 mode={PIPELINE_MODE}, worker={WORKER_MIN}..{WORKER_MAX}, "
+            f"stage_workers={STAGE_WORKERS}, queue_max={QUEUE_MAXSIZE}, "
+            f"scan_concurrency={SCAN_CONCURRENCY}, timeout={SCAN_TIMEOUT_SECONDS}s, "
+            f"thumbnail={THUMBNAIL_EXECUTOR}, upload={UPLOAD_MODE}"
         ),
     )
 
     upload_queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
-    scan_sem = asyncio.Semaphore(SCAN_CONCURRENCY)
 
-    # worker 全体で共有する集計
-    stats = {"success": 0, "invalid": 0, "failed": 0}
-    stats_lock = asyncio.Lock()
+    # 集計の入れ物。各 worker は stats.for_worker(name) で自分専用の集計を持つ
+    stats = PipelineStats(counter_names=("success", "invalid", "failed"))
+
+    if ADAPTIVE_CONCURRENCY:
+        # Semaphore と同じ async with で使える。上限の変化はログに出す
+        scan_slots = AdaptiveLimiter(
+            SCAN_CONCURRENCY,
+            min_limit=SCAN_CONCURRENCY_MIN,
+            max_limit=SCAN_CONCURRENCY_MAX,
+            latency_threshold=SCAN_LATENCY_TARGET_SECONDS,
+            on_change=lambda old, new: log("SCAN", f"scan_limit {old} -> {new}"),
+        )
+    else:
+        scan_slots = asyncio.Semaphore(SCAN_CONCURRENCY)
+
+    # 回数の上限があれば「token -> slot」の順に取るリミッターで包む (async with の使い方は同じ)
+    # どちらで待ったかは集計の token_wait / slot_wait に分けて記録する
+    scan_sem = scan_slots
+    rate_bucket = None
+    if SCAN_RATE_LIMIT is not None:
+        if SCAN_RATE_SHARED_PATH is not None:
+            rate_bucket = FileTokenBucket(SCAN_RATE_SHARED_PATH, SCAN_RATE_LIMIT, SCAN_RATE_BURST)
+        else:
+            rate_bucket = TokenBucket(SCAN_RATE_LIMIT, SCAN_RATE_BURST)
+        scan_sem = RateLimitedSlots(
+            rate_bucket,
+            scan_slots,
+            on_wait=lambda kind, seconds: record_limiter_wait(stats, kind, seconds),
+        )
+
+    # backoff / retry budget / circuit breaker は全workerで1つを共有する
+    policy = RetryPolicy(
+        breaker=CircuitBreaker(
+            "scan",
+            failure_threshold=BREAKER_FAILURE_THRESHOLD,
+            reset_timeout=BREAKER_RESET_SECONDS,
+            on_change=lambda old, new: log("SCAN", f"breaker {old} -> {new}", level="WARNING"),
+        ),
+        budget=RetryBudget(
+            ratio=RETRY_BUDGET_RATIO,
+            initial_tokens=RETRY_BUDGET_INITIAL_TOKENS,
+        ),
+        backoff_base=RETRY_BACKOFF_SECONDS,
+        backoff_max=RETRY_BACKOFF_MAX_SECONDS,
+    )
+
+    hedger = None
+    if HEDGE_ENABLED:
+        hedger = Hedger(
+            scan_sem,
+            RetryBudget(ratio=HEDGE_BUDGET_RATIO, initial_tokens=HEDGE_BUDGET_INITIAL_TOKENS),
+            quantile=HEDGE_QUANTILE,
+            min_samples=HEDGE_MIN_SAMPLES,
+            on_hedge=lambda delay: log("SCAN", f"hedge 発射 ({delay:.2f}秒超過)"),
+        )
+
+    # サムネイル生成の実行場所 (全workerで共有)
+    thumb_executor = StageExecutor(
+        THUMBNAIL_EXECUTOR,
+        max_workers=(
+            STAGE_WORKERS["thumbnail"] if PIPELINE_MODE == "stages" else THUMBNAIL_EXECUTOR_WORKERS
+        ),
+        name="thumbnail",
+    )
+    # part の同時送信数の上限は全 worker で共有する
+    uploader = build_uploader()
 
     # worker を先に起動して queue 待機させる
-    workers = [
-        asyncio.create_task(worker(f"worker-{i+1}", upload_queue, scan_sem, stats, stats_lock))
-        for i in range(WORKER_COUNT)
-    ]
+    if PIPELINE_MODE == "stages":
+        runner = build_stage_pipeline(
+            upload_queue, scan_sem, policy, hedger, thumb_executor, uploader, stats
+        ).start()
+    else:
+        loop = asyncio.get_running_loop()
+        runner = WorkerPool(
+            upload_queue,
+            lambda name, req: handle_upload(
+                name, req, scan_sem, policy, hedger, thumb_executor, uploader, stats
+            ),
+            min_workers=WORKER_MIN,
+            max_workers=WORKER_MAX,
+            scale_interval=SCALE_INTERVAL_SECONDS,
+            scale_up_depth=SCALE_UP_QUEUE_DEPTH,
+            max_item_age=SCALE_UP_ITEM_AGE_SECONDS,
+            age_of=lambda req: loop.time() - req["accepted_at"],
+            idle_timeout=WORKER_IDLE_SECONDS,
+            on_scale=lambda old, new, reason: log("POOL", f"worker {old} -> {new} ({reason})"),
+        ).start()
+
+    def report(snapshot):
+        log("STATS", f"途中経過 {snapshot['counters']}")
+        if PIPELINE_MODE == "stages":
+            # busy が 100% 近い段階がボトルネック。blocked が大きい段階はその下流が遅い
+            for line in format_utilization(runner.utilization()):
+                log("STATS", line)
+
+    reporter = asyncio.create_task(
+        report_periodically(stats, STATS_REPORT_INTERVAL_SECONDS, report)
+    )
 
     # ---- 投入フェーズ ----
-    await receive_upload_requests(upload_queue, WORKER_COUNT)
+    await receive_upload_requests(upload_queue)
 
     # ---- 完了待ちフェーズ ----
-    log("MAIN", "queue.join 待機開始", blank=True)
-    # queue.join は「putされた全件に task_done が対応するまで」待つ。
-    await upload_queue.join()
-    log("MAIN", "queue.join 解除 (全件処理完了)")
-
-    log("MAIN", "gather 待機開始 (worker Task 終了待ち)")
-    # gather は worker Task 自体の終了を待つ。
-    await asyncio.gather(*workers)
-
-    log("MAIN", f"終了 / stats={stats}", blank=True)
+    log("MAIN", "close 待機開始", blank=True)
+    # queue.join で「putされた全件に task_done が対応するまで」待ち、
+    # そのあと get で待っているだけの worker を止める (終了シグナル不要)
+    # stages では先頭段階から順に同じことを行う
+    await runner.close()
+    if PIPELINE_MODE == "stages":
+        log("MAIN", "close 完了 (全段階の処理完了)")
+        for line in format_utilization(runner.utilization()):
+            log("STATS", line)
+    else:
+        log("MAIN", f"close 完了 (全件処理完了) / pool={runner.snapshot()}")
+    # worker の終了待ちでループを止めないよう、スレッドで待つ
+    await asyncio.to_thread(thumb_executor.shutdown)
+    reporter.cancel()
+
+    if ADAPTIVE_CONCURRENCY:
+        log("MAIN", f"scan_limiter={scan_slots.snapshot()}")
+    if rate_bucket is not None:
+        log("MAIN", f"scan_rate={scan_sem.snapshot()}")
+        await rate_bucket.close()
+    log("MAIN", f"scan_policy={policy.snapshot()}")
+    if hedger is not None:
+        log("MAIN", f"scan_hedge={hedger.snapshot()}")
+    if uploader is not None:
+        log("MAIN", f"upload={uploader.snapshot()} -> {STORAGE_DIR}")
+
+    for line in format_latency(stats.snapshot()):
+        log("STATS", line)
+    log("MAIN", f"終了 / stats={stats.counters()}", blank=True)
+    shutdown_tracing()
+    # 残りのログを書き切る (jsonl のときだけ)
+    shutdown_logging()
+    return stats.snapshot()
+
+
+def apply_command_line(argv=None):
+    """コマンドライン引数で入力ソース / トレースの設定値を上書きする。"""
+    global UPLOADS_SOURCE, UPLOADS_SOURCE_FOLLOW, TRACE_PATH
+    parser = argparse.ArgumentParser(description="画像アップロード処理キュー")
+    parser.add_argument("source", nargs="?", help='JSON Lines ファイル ("-" なら標準入力)')
+    parser.add_argument("--follow", action="store_true", help="追記を待ち続ける")
+    parser.add_argument("--trace", metavar="PATH", help="Chrome trace 形式の JSON を書き出す")
+    args = parser.parse_args(argv)
+    if args.source is not None:
+        UPLOADS_SOURCE = args.source
+    if args.follow:
+        UPLOADS_SOURCE_FOLLOW = True
+    if args.trace is not None:
+        TRACE_PATH = args.trace
 
 
 if __name__ == "__main__":
+    apply_command_line()
     asyncio.run(main())
@@ -0,0 +1,211 @@
+﻿# 仕事をキーで N 個のプロセス (shard) に振り分け、それぞれで別のイベントループを回す runner です。
+# script_10 から使います。
+# 学べること:
+# 1) asyncio の worker はいくら増やしても1コア (1つのイベントループ) の上で動く
+#    -> ループ自体の処理 (JSON / queue / worker の切り替え) が限界になったら、プロセスを分ける
+# 2) 同じキー (顧客ID など) は必ず同じ shard に送る
+#    -> 重複排除や顧客ごとの公平さなど「キーごとの状態」を shard の中だけで持てる
+#    -> hash() はプロセスごとに値が変わるので、crc32 のような決まった値になるハッシュを使う
+# 3) プロセス間の受け渡しは pickle されるので、1件ずつではなく batch_size 件ずつまとめて送る
+# 4) 各 queue には上限を付け、子が遅いと親の submit が待つ (プロセスをまたいだ背圧)
+#
+# 使い方:
+#     runner = ShardedRunner(run_shard, shards=4, key_of=lambda order: order["customer"]).start()
+#     async for order in source:
+#         await runner.submit(order)
+#     results = await runner.close()   # shard ごとの run_shard の戻り値 (shard 番号順)
+#
+# run_shard(index, source) は子プロセスで asyncio.run される async 関数。
+# source は async for で item を1件ずつ返す。spawn で起動するので、run_shard はトップレベルの関数
+# (または functools.partial) にし、戻り値は pickle できる値にする。
+#
+# 終了:
+# - close(): 残りを送って「もう来ない」を伝え、全 shard の戻り値を受け取ってからプロセスを join する
+# - abort(): 途中で止めるとき (例外や Ctrl+C)。子プロセスを terminate する
+# - 送り先の shard が落ちていて queue が空かないときは、submit / close が RuntimeError になる
+# - 子は SIGINT を無視する (Ctrl+C は親だけが受けて、止め方を親が決める)
+
+import asyncio
+import multiprocessing
+import queue
+import signal
+import traceback
+import zlib
+
+# 子プロセスに「もう item は来ない」を伝える印
+_END = None
+
+
+def shard_for(key, shards):
+    """key を 0..shards-1 に振り分ける。どのプロセスで計算しても同じ値になる。"""
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+class _QueueSource:
+    """子プロセス側: 親から届いたバッチを1件ずつ返す async iterable。"""
+
+    def __init__(self, inbox):
+        self._inbox = inbox
+        self.items = 0
+
+    async def __aiter__(self):
+        while True:
+            # multiprocessing.Queue.get はブロッキングなのでスレッドで待つ
+            batch = await asyncio.to_thread(self._inbox.get)
+            if batch is _END:
+                return
+            for item in batch:
+                self.items += 1
+                yield item
+
+
+def _shard_main(target, index, inbox, outbox):
+    """子プロセスの入口。target(index, source) を実行して、結果か例外を親に返す。"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        result = asyncio.run(target(index, _QueueSource(inbox)))
+    except BaseException:
+        outbox.put((index, False, traceback.format_exc()))
+    else:
+        outbox.put((index, True, result))
+
+
+class ShardedRunner:
+    """
+    item を key_of(item) で shard に振り分け、shard ごとの子プロセスで target を動かす。
+
+    - shards: プロセス数
+    - batch_size: この件数ずつまとめて子へ送る
+    - queue_maxsize: shard ごとの送信 queue の上限 (バッチ数)。満杯なら submit が待つ
+    - start_method: multiprocessing の開始方式 (既定は spawn: どの OS でも同じ動き)
+    """
+
+    def __init__(
+        self,
+        target,
+        shards,
+        key_of,
+        batch_size=64,
+        queue_maxsize=16,
+        start_method="spawn",
+    ):
+        if shards < 1:
+            raise ValueError("shards must be >= 1")
+        self.target = target
+        self.shards = shards
+        self.key_of = key_of
+        self.batch_size = batch_size
+        self.queue_maxsize = queue_maxsize
+        self._context = multiprocessing.get_context(start_method)
+        self._inboxes = []
+        self._outbox = None
+        self._processes = []
+        self._buffers = [[] for _ in range(shards)]
+
+        # 集計
+        self.submitted = [0] * shards
+        self.batches_sent = 0
+
+    def start(self):
+        self._outbox = self._context.Queue()
+        for index in range(self.shards):
+            inbox = self._context.Queue(maxsize=self.queue_maxsize)
+            process = self._context.Process(
+                target=_shard_main,
+                args=(self.target, index, inbox, self._outbox),
+                name=f"shard-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+        return self
+
+    async def submit(self, item):
+        index = shard_for(self.key_of(item), self.shards)
+        buffer = self._buffers[index]
+        buffer.append(item)
+        self.submitted[index] += 1
+        if len(buffer) >= self.batch_size:
+            await self._send(index)
+
+    async def close(self):
+        """残りを送り、全 shard の戻り値を shard 番号順のリストで返す。"""
+        for index in range(self.shards):
+            if self._buffers[index]:
+                await self._send(index)
+            await asyncio.to_thread(self._put, index, _END)
+
+        # 先に outbox を読み切ってから join する
+        # (子が queue に書いたデータを親が読むまで、子プロセスは終われない)
+        results = await asyncio.to_thread(self._collect)
+        for process in self._processes:
+            await asyncio.to_thread(process.join)
+        self._release()
+
+        failed = {index: tb for index, (ok, tb) in results.items() if not ok}
+        if failed:
+            details = "\n".join(f"--- shard {index} ---\n{tb}" for index, tb in failed.items())
+            raise RuntimeError(f"{len(failed)} shard(s) failed:\n{details}")
+        return [results[index][1] for index in range(self.shards)]
+
+    def abort(self):
+        """子プロセスを止める (送信済みで未処理の item は失われる)。"""
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            process.join()
+        self._release()
+
+    def snapshot(self):
+        return {
+            "shards": self.shards,
+            "submitted": list(self.submitted),
+            "batches_sent": self.batches_sent,
+        }
+
+    async def _send(self, index):
+        batch, self._buffers[index] = self._buffers[index], []
+        self.batches_sent += 1
+        # 子の queue が満杯なら空くまで待つ (ループは止めない)
+        await asyncio.to_thread(self._put, index, batch)
+
+    def _put(self, index, item):
+        # 子が落ちていると queue は空かないので、時々生きているかを確かめる
+        process = self._processes[index]
+        while True:
+            try:
+                self._inboxes[index].put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if not process.is_alive():
+                    raise RuntimeError(
+                        f"shard {index} exited with code {process.exitcode}"
+                    ) from None
+
+    def _collect(self):
+        results = {}
+        # 前回の確認で止まっていた shard。結果が届くのが遅れただけのこともあるので、
+        # 2回続けて「止まっていて結果も無い」ときだけ失敗とみなす
+        exited = set()
+        while len(results) < self.shards:
+            try:
+                index, ok, value = self._outbox.get(timeout=0.5)
+            except queue.Empty:
+                # 結果を返さずに落ちた shard (kill など) を待ち続けないように
+                for index, process in enumerate(self._processes):
+                    if index in results or process.is_alive():
+                        continue
+                    if index in exited:
+                        results[index] = (False, f"exited with code {process.exitcode}\n")
+                    exited.add(index)
+                continue
+            results[index] = (ok, value)
+        return results
+
+    def _release(self):
+        for inbox in self._inboxes:
+            inbox.close()
+        if self._outbox is not None:
+            self._outbox.close()
@@ -0,0 +1,59 @@
+﻿# 重い同期処理をどこで実行するかを切り替えるための小さなラッパーです。
+# 学べること:
+# - to_thread / ThreadPoolExecutor: time.sleep や I/O 待ちなら十分 (GIL を手放すため)
+# - ProcessPoolExecutor: 純Pythonの計算は GIL を握り続けるので、別プロセスでないと並列にならない
+#
+# 使い方:
+#     executor = StageExecutor("process", max_workers=3)
+#     result = await executor.run(func, arg1, arg2)
+#     executor.shutdown()
+#
+# 注意: "process" で渡す関数と引数は pickle できる必要がある
+# (モジュールのトップレベル関数にする / lambda は不可)。
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+EXECUTOR_KINDS = ("to_thread", "thread", "process")
+
+
+class StageExecutor:
+    """
+    kind:
+    - "to_thread": asyncio.to_thread と同じ (イベントループ既定のスレッドプール)
+    - "thread": 専用の ThreadPoolExecutor(max_workers)
+    - "process": 専用の ProcessPoolExecutor(max_workers)
+    """
+
+    def __init__(self, kind="to_thread", max_workers=None, name="stage"):
+        if kind not in EXECUTOR_KINDS:
+            raise ValueError(f"kind は {EXECUTOR_KINDS} のどれかにしてください: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+
+        if kind == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        elif kind == "process":
+            self._pool = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self._pool = None
+
+    async def run(self, func, *args):
+        if self._pool is None:
+            return await asyncio.to_thread(func, *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, func, *args)
+
+    def shutdown(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+        return False
+
+    def __repr__(self):
+        return f"StageExecutor(kind={self.kind!r}, max_workers={self.max_workers})"
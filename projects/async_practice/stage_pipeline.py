@@ -0,0 +1,164 @@
+﻿# 処理を段階 (stage) ごとに分け、段階ごとに queue と worker を持たせるパイプラインです。
+# script_11 から使います。
+# 学べること:
+# 1) 1つの worker が全段階を順番にやると、遅い段階の待ちで他の段階の枠まで止まる
+#    -> 段階ごとに worker を分ければ、scan を待っている間も thumbnail / upload は進む
+# 2) 段階の間の queue に上限を付けると、下流が詰まったとき上流の put が待つ (背圧)
+#    -> 詰まりが入口 (受付) まで順に伝わり、途中の queue が際限なく膨らまない
+# 3) 段階ごとの稼働率 (busy) と「下流待ち」(blocked) を見れば、どこがボトルネックか分かる
+#    busy が 100% 近い段階 = ボトルネック / blocked が大きい段階 = その下流が遅い
+#
+# 流れ:
+#   put -> [validate queue] -> validate workers -> [scan queue] -> scan workers -> ... -> on_done
+#
+# 段階の処理:
+# - executor なし: func(name, item) を await する (async 関数, name は worker 名)
+# - executor あり: func(item) を executor.run で実行する (同期関数。process なら pickle 可能なもの)
+# - 戻り値が次の段階の item になる。例外なら on_error(name, stage名, item, exc) に渡して捨てる
+
+import asyncio
+
+from tracing import Tracer
+from worker_pool import WorkerPool
+
+
+class Stage:
+    """
+    パイプラインの1段階。
+
+    - workers: この段階の worker 数
+    - queue_maxsize: この段階の入力 queue の上限 (queue を渡したときは使わない)
+    - executor: stage_executor.StageExecutor を渡すと、func を同期関数としてそこで実行する
+    - queue: 入力 queue を自分で用意したいとき (先頭段階に FairQueue を使う等, 任意)
+    """
+
+    def __init__(self, name, func, workers=1, queue_maxsize=1, executor=None, queue=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.executor = executor
+        self.queue = queue if queue is not None else asyncio.Queue(maxsize=queue_maxsize)
+        self.pool = None
+
+        # 集計 (秒は worker 全員分の合計)
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.processed = 0
+        self.errors = 0
+
+    async def run(self, name, item):
+        if self.executor is not None:
+            return await self.executor.run(self.func, item)
+        return await self.func(name, item)
+
+
+class StagePipeline:
+    """
+    Stage を順につなぐ。
+
+    - put(item): 先頭段階の queue に入れる (満杯なら待つ = 受付側への背圧)
+    - close(): 先頭段階から順に drain して worker を止める
+    - on_done(name, item): 最後の段階を抜けた item (任意)
+    - on_error(name, stage_name, item, exc): 途中で失敗した item (任意)
+    - stats: pipeline_stats.PipelineStats を渡すと段階ごとの所要時間を記録する (任意)
+    - tracer: tracing.Tracer を渡すと段階ごと / 下流待ちの span を記録する (任意)
+      key_of(item) を渡すと、その値 (ファイルIDなど) ごとの行にも記録される
+    """
+
+    def __init__(self, stages, on_done=None, on_error=None, stats=None, tracer=None, key_of=None):
+        self.stages = list(stages)
+        self.on_done = on_done
+        self.on_error = on_error
+        self.stats = stats
+        self.tracer = tracer or Tracer(enabled=False)
+        self.key_of = key_of
+        self._started_at = None
+
+    @property
+    def queue(self):
+        return self.stages[0].queue
+
+    def start(self):
+        self._started_at = asyncio.get_running_loop().time()
+        for index, stage in enumerate(self.stages):
+            following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            stage.pool = WorkerPool(
+                stage.queue,
+                self._make_handler(stage, following),
+                min_workers=stage.workers,
+                max_workers=stage.workers,
+                name=stage.name,
+            ).start()
+        return self
+
+    async def put(self, item):
+        await self.stages[0].queue.put(item)
+
+    async def close(self):
+        # 上流が空になってから下流を閉じる (上流の worker が最後に put した分も処理される)
+        for stage in self.stages:
+            await stage.pool.close()
+
+    def utilization(self):
+        """段階ごとの稼働率。busy / blocked は「worker 数 × 経過時間」に対する割合。"""
+        elapsed = asyncio.get_running_loop().time() - self._started_at
+        result = {}
+        for stage in self.stages:
+            capacity = max(stage.workers * elapsed, 1e-9)
+            result[stage.name] = {
+                "workers": stage.workers,
+                "busy": stage.busy_seconds / capacity,
+                "blocked": stage.blocked_seconds / capacity,
+                "queue": stage.queue.qsize(),
+                "processed": stage.processed,
+                "errors": stage.errors,
+            }
+        return result
+
+    def _make_handler(self, stage, following):
+        loop = asyncio.get_running_loop()
+
+        async def handle(name, item):
+            key = self.key_of(item) if self.key_of is not None else None
+            with self.tracer.context(track=name, order=key):
+                await process(name, item)
+
+        async def process(name, item):
+            started_at = loop.time()
+            try:
+                with self.tracer.span(stage.name):
+                    result = await stage.run(name, item)
+            except Exception as exc:
+                stage.errors += 1
+                if self.on_error is not None:
+                    self.on_error(name, stage.name, item, exc)
+                return
+            finally:
+                busy = loop.time() - started_at
+                stage.busy_seconds += busy
+                stage.processed += 1
+                if self.stats is not None:
+                    self.stats.for_worker(name).observe(stage.name, busy)
+
+            if following is None:
+                if self.on_done is not None:
+                    self.on_done(name, result)
+                return
+
+            # 次の段階の queue が満杯ならここで待つ (背圧)。待った時間は blocked に数える
+            put_at = loop.time()
+            with self.tracer.span("blocked"):
+                await following.queue.put(result)
+            stage.blocked_seconds += loop.time() - put_at
+
+        return handle
+
+
+def format_utilization(utilization):
+    """utilization() を1段階1行の文字列にする (ログ用)。"""
+    return [
+        f"{name:<11} workers={u['workers']:<3} busy={u['busy']:>4.0%} "
+        f"blocked={u['blocked']:>4.0%} queue={u['queue']:<4} "
+        f"processed={u['processed']} errors={u['errors']}"
+        for name, u in utilization.items()
+    ]
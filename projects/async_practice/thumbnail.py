@@ -0,0 +1,47 @@
+﻿# サムネイル生成の「本物の CPU 負荷」です。
+# 画像ライブラリは使わず、グレースケールの画素バッファを純Pythonで縮小します。
+# (ProcessPoolExecutor から呼べるよう、すべてトップレベル関数にしています)
+
+import random
+from array import array
+
+
+def make_pixels(seed, width, height):
+    """seed から決まるダミー画像 (1画素1バイトのグレースケール) を作る。"""
+    return array("B", random.Random(seed).randbytes(width * height))
+
+
+def downscale(pixels, width, height, factor):
+    """
+    factor × factor の画素を平均して1画素にする (box filter)。
+    戻り値は (縮小後の画素, 幅, 高さ)。端数の行・列は切り捨てる。
+    """
+    out_width = width // factor
+    out_height = height // factor
+    area = factor * factor
+    out = array("B", bytes(out_width * out_height))
+
+    for out_y in range(out_height):
+        # factor 行ぶんを列方向に足し込んでから、横 factor 画素ずつまとめる
+        column_sums = [0] * (out_width * factor)
+        for y in range(out_y * factor, (out_y + 1) * factor):
+            row = pixels[y * width : y * width + out_width * factor]
+            for x, value in enumerate(row):
+                column_sums[x] += value
+
+        base = out_y * out_width
+        for out_x in range(out_width):
+            start = out_x * factor
+            out[base + out_x] = sum(column_sums[start : start + factor]) // area
+
+    return out, out_width, out_height
+
+
+def generate_thumbnail(file_id, width, height, factor):
+    """
+    file_id の元画像を読み込んだ想定で縮小し、サムネイル名とサイズを返す。
+    元画像はワーカー側で作るので、プロセス間で大きなバッファを送らずに済む。
+    """
+    pixels = make_pixels(file_id, width, height)
+    _, out_width, out_height = downscale(pixels, width, height, factor)
+    return f"thumb_{file_id}.jpg", out_width, out_height
@@ -0,0 +1,174 @@
+﻿# 処理の区間 (span) を記録して、Chrome の trace-event JSON に書き出す軽い tracer です。
+# 書き出したファイルは https://ui.perfetto.dev や chrome://tracing で開けます。
+# 学べること:
+# 1) 「いつ・どの worker が・どの注文の・何をしていたか」を区間として残すと、
+#    タイムライン上で待ち時間や worker の空き時間 (何も描かれていない所) が一目で分かる
+# 2) 今どの worker / どの注文の処理中かは ContextVar で持つ
+#    -> create_task / to_thread は ContextVar を引き継ぐので、引数で回さなくてよい
+# 3) 記録は tuple を list に積むだけ。JSON への整形は export のときにまとめて行う
+#
+# 使い方:
+#     tracer = Tracer(clock=loop.time)
+#     with tracer.context(track="worker-1", order="ORD-1001"):
+#         with tracer.span("api_attempt", attempt=1):
+#             await call()
+#     tracer.export("trace.json")
+#
+# 出力の見え方:
+# - track (worker 名など) ごとに1行: その worker が何をしていたか
+# - 注文ごとに1行 (async イベント): その注文がどこで時間を使ったか
+#
+# 注意:
+# - max_events を超えた分は捨てて dropped に数える (メモリを増やし続けないため)
+# - Tracer(enabled=False) なら何も記録しない (呼び出し側はそのままでよい)
+
+import contextlib
+import contextvars
+import json
+import time
+
+# (track, order) : 今の処理がどの行 (worker 等) / どの注文のものか
+_current = contextvars.ContextVar("trace_context", default=("main", None))
+
+_NULL = contextlib.nullcontext()
+# context() で「外側の値をそのまま使う」を表す印 (None は「無し」にする意味で使うため)
+_KEEP = object()
+
+
+class _Span:
+    """with で囲んだ区間を1件記録する。"""
+
+    __slots__ = ("_tracer", "_name", "_args", "_started")
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._started = self._tracer.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._args["error"] = exc_type.__name__
+        self._tracer.complete(self._name, self._started, self._tracer.clock(), **self._args)
+        return False
+
+
+class Tracer:
+    """
+    span を記録する入れ物。
+
+    - clock: 秒を返す関数。queue 待ちのように loop.time() で測った時刻を
+      complete() に渡すなら、ここも loop.time にそろえる
+    - max_events: 記録する最大件数
+    """
+
+    def __init__(self, clock=None, max_events=1_000_000, enabled=True):
+        self.clock = clock or time.perf_counter
+        self.max_events = max_events
+        self.enabled = enabled
+        self._events = []
+        self.dropped = 0
+
+    def context(self, track=_KEEP, order=_KEEP):
+        """
+        この中の span を track の行 / order の注文に記録する。
+        省略したものは外側を引き継ぐ。order=None なら注文の行には記録しない。
+        """
+        if not self.enabled:
+            return _NULL
+        return self._context(track, order)
+
+    @contextlib.contextmanager
+    def _context(self, track, order):
+        outer_track, outer_order = _current.get()
+        token = _current.set(
+            (
+                outer_track if track is _KEEP else track,
+                outer_order if order is _KEEP else order,
+            )
+        )
+        try:
+            yield
+        finally:
+            _current.reset(token)
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL
+        return _Span(self, name, args)
+
+    def complete(self, name, start, end, order_only=False, **args):
+        """
+        開始・終了時刻が分かっている区間を記録する。
+        order_only=True なら注文の行にだけ描く (queue 待ちのように worker が働いていない区間)。
+        """
+        if not self.enabled:
+            return
+        if len(self._events) >= self.max_events:
+            self.dropped += 1
+            return
+        track, order = _current.get()
+        if order_only:
+            track = None
+        self._events.append(("X", name, start, end - start, track, order, args))
+
+    def instant(self, name, **args):
+        """一瞬の出来事 (queue への投入など) を記録する。"""
+        if not self.enabled:
+            return
+        if len(self._events) >= self.max_events:
+            self.dropped += 1
+            return
+        track, order = _current.get()
+        self._events.append(("i", name, self.clock(), 0.0, track, order, args))
+
+    def snapshot(self):
+        return {"events": len(self._events), "dropped": self.dropped}
+
+    def export(self, path):
+        """Chrome trace-event 形式の JSON を書き出す。"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self._trace_events(), "displayTimeUnit": "ms"}, f)
+
+    def _trace_events(self):
+        # tid は数値にして、行の名前は thread_name メタデータで付ける
+        tids = {}
+        events = []
+        for phase, name, start, duration, track, order, args in self._events:
+            ts = start * 1e6
+            if order is not None:
+                args = {**args, "order": order}
+            if track is None:
+                # order_only の区間は worker の行には描かない
+                pass
+            elif phase == "X":
+                events.append(
+                    {"name": name, "cat": "span", "ph": "X", "ts": ts, "dur": duration * 1e6,
+                     "pid": 1, "tid": tids.setdefault(track, len(tids) + 1), "args": args}
+                )
+            else:
+                events.append(
+                    {"name": name, "cat": "span", "ph": "i", "s": "t", "ts": ts,
+                     "pid": 1, "tid": tids.setdefault(track, len(tids) + 1), "args": args}
+                )
+            if order is not None:
+                # 注文ごとの行 (async イベント): 同じ id の b/e が1行にまとまる
+                events.append(
+                    {"name": name, "cat": "order", "ph": "b", "id": str(order), "ts": ts,
+                     "pid": 2, "tid": 0, "args": args}
+                )
+                events.append(
+                    {"name": name, "cat": "order", "ph": "e", "id": str(order),
+                     "ts": ts + duration * 1e6, "pid": 2, "tid": 0}
+                )
+
+        for track, tid in tids.items():
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": track}}
+            )
+        events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "workers"}})
+        events.append({"name": "process_name", "ph": "M", "pid": 2, "args": {"name": "orders"}})
+        return events
@@ -0,0 +1,143 @@
+﻿# 仮想時計で動くイベントループです。
+# asyncio.sleep / wait_for の timeout など「時間待ち」を本当には待たず、
+# 全 Task が待ち状態になった瞬間に、次のタイマーの時刻まで時計を進めます。
+#
+# 学べること:
+# - イベントループは「次に起きるべき時刻」まで selector.select(timeout) で眠っているだけ
+# - その select を「眠らずに時計を進める」に差し替えると、1時間ぶんの待ちも一瞬で終わる
+# - 同じコードなら毎回まったく同じ時刻の順番 (タイムライン) で進む
+#
+# 使い方:
+#     import virtual_clock
+#     virtual_clock.run(main())                       # asyncio.run(main()) の代わり
+#
+#     python virtual_clock.py script_10_practical_pipeline --seed 1
+#
+# 注意:
+# - to_thread / run_in_executor の処理中は時計を止め、スレッドの完了を実時間で待つ
+#   (ブロッキング処理は「仮想時間 0 秒」で終わる扱い)
+# - loop.time() は仮想時刻になるが、time.strftime / time.monotonic などは実時刻のまま
+
+import argparse
+import asyncio
+import importlib
+import random
+import selectors
+import time
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """本物の selector を包み、「眠る」代わりに仮想時計を進める。"""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._real = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self._real.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._real.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._real.modify(fileobj, events, data)
+
+    def get_key(self, fileobj):
+        return self._real.get_key(fileobj)
+
+    def get_map(self):
+        return self._real.get_map()
+
+    def close(self):
+        self._real.close()
+
+    def select(self, timeout=None):
+        # すぐ実行すべき callback がある / 実際の I/O が届いている -> そのまま返す
+        events = self._real.select(0)
+        if events or (timeout is not None and timeout <= 0):
+            return events
+
+        # スレッド/プロセスで処理中のものがある -> 時計を止めて、その完了を実時間で待つ
+        # (完了は call_soon_threadsafe で self-pipe に書かれるので select が起きる)
+        if self._loop.executor_jobs or timeout is None:
+            return self._real.select(None)
+
+        # 全 Task が時間待ち -> 次のタイマーまで時計を進める
+        self._loop.advance(timeout)
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """time() が仮想時刻を返す SelectorEventLoop。"""
+
+    def __init__(self, start=0.0):
+        self._virtual_now = start
+        self.executor_jobs = 0
+        super().__init__(selector=_VirtualSelector(self))
+
+    def time(self):
+        return self._virtual_now
+
+    def advance(self, seconds):
+        self._virtual_now += seconds
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.executor_jobs += 1
+        future.add_done_callback(self._executor_job_done)
+        return future
+
+    def _executor_job_done(self, future):
+        self.executor_jobs -= 1
+
+
+def run(main, start=0.0):
+    """asyncio.run(main) と同じ使い方で、VirtualClockLoop 上で実行する。"""
+    loop = VirtualClockLoop(start=start)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            # asyncio.run と同じ後片付け: 残った Task を cancel してから閉じる
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="既存スクリプトの main() を仮想時計で実行する")
+    parser.add_argument("module", help="例: script_10_practical_pipeline")
+    parser.add_argument("--seed", type=int, default=None, help="random の seed (ジッター等を固定)")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    module = importlib.import_module(args.module)
+    loop_holder = {}
+
+    async def timed_main():
+        loop_holder["loop"] = asyncio.get_running_loop()
+        return await module.main()
+
+    wall_start = time.perf_counter()
+    run(timed_main())
+    wall = time.perf_counter() - wall_start
+
+    print(f"\n仮想時間 {loop_holder['loop'].time():.3f}秒 / 実時間 {wall:.3f}秒")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
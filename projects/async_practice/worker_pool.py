@@ -0,0 +1,199 @@
+﻿# queue の混み具合に合わせて worker の本数を増減する worker pool です。
+# script_10 / script_11 から使います。
+# 学べること:
+# 1) worker 数を固定せず、queue の残数と「取り出した item の待ち時間」を見て増やす
+# 2) しばらく仕事がない worker は止める (min_workers 本までは残す)
+# 3) 終了は「None を worker 数ぶん入れる」のではなく、
+#    queue.join() で全件の完了を待ってから、get で待っている worker を cancel する
+#
+# 使い方:
+#     pool = WorkerPool(queue, handler, min_workers=1, max_workers=8).start()
+#     ... queue.put(...) ...
+#     await pool.close()   # 投入が終わってから呼ぶ
+#
+# 注意:
+# - queue.get() で待っている Task は cancel しても item を失わない
+#   (取り出す前に止まるので、item は queue に残り、次の worker が受け取る)
+# - handler が未完了の Future を返したら、worker はすぐ次の get へ戻り、
+#   task_done はその Future が完了したときに呼ぶ (join は保存の commit まで待つ)
+
+import asyncio
+import math
+
+
+class WorkerPool:
+    """
+    queue を読む worker Task の集まり。
+
+    - handler(name, item): 1件ぶんの処理 (async)。例外は errors に数えて worker は継続する
+      task_done は pool 側で呼ぶので handler では呼ばない
+      Future を返すと、task_done (と processed / errors) はその Future の完了時になる
+    - scale_up_depth: worker 1本あたりの queue 残数がこれを超えたら増やす
+    - max_item_age: 取り出した item の待ち時間がこれを超えたら増やす (age_of(item) が必要)
+    - idle_timeout: この秒数 get で待ち続けた worker は止める (min_workers 本までは残す)
+    - on_scale(old, new, reason): 本数が変わったときのログ用 (任意)
+    """
+
+    def __init__(
+        self,
+        queue,
+        handler,
+        min_workers=1,
+        max_workers=8,
+        scale_interval=0.5,
+        scale_up_depth=2,
+        max_item_age=None,
+        age_of=None,
+        idle_timeout=2.0,
+        name="worker",
+        on_scale=None,
+    ):
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError("1 <= min_workers <= max_workers が必要です")
+        self.queue = queue
+        self.handler = handler
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_interval = scale_interval
+        self.scale_up_depth = scale_up_depth
+        self.max_item_age = max_item_age
+        self.age_of = age_of
+        self.idle_timeout = idle_timeout
+        self.name = name
+        self.on_scale = on_scale
+
+        # name -> Task
+        self._workers = {}
+        # name -> get で待ち始めた時刻 (待っていない worker は入っていない)
+        self._idle_since = {}
+        self._next_id = 0
+        # 前回の見直し以降に取り出された item の最大待ち時間
+        self._max_age_seen = 0.0
+        self._scaler = None
+
+        # 集計
+        self.processed = 0
+        self.errors = 0
+        self.scale_ups = 0
+        self.scale_downs = 0
+        self.peak_workers = 0
+
+    @property
+    def size(self):
+        return len(self._workers)
+
+    def start(self):
+        for _ in range(self.min_workers):
+            self._spawn()
+        self._scaler = asyncio.create_task(self._autoscale())
+        return self
+
+    async def drain(self):
+        """queue に入った分 (処理中を含む) が全部終わるまで待つ。worker は止めない。"""
+        await self.queue.join()
+
+    async def close(self):
+        """drain してから、get で待っているだけの worker を止める。"""
+        await self.drain()
+        self._scaler.cancel()
+        tasks = list(self._workers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(self._scaler, *tasks, return_exceptions=True)
+        self._workers.clear()
+        self._idle_since.clear()
+
+    def snapshot(self):
+        return {
+            "workers": self.size,
+            "peak_workers": self.peak_workers,
+            "scale_ups": self.scale_ups,
+            "scale_downs": self.scale_downs,
+            "processed": self.processed,
+            "errors": self.errors,
+        }
+
+    # ---- worker ----
+
+    def _spawn(self):
+        self._next_id += 1
+        name = f"{self.name}-{self._next_id}"
+        self._workers[name] = asyncio.create_task(self._run_worker(name))
+        self.peak_workers = max(self.peak_workers, self.size)
+
+    def _retire(self, name):
+        self._idle_since.pop(name, None)
+        self._workers.pop(name).cancel()
+
+    async def _run_worker(self, name):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._idle_since[name] = loop.time()
+            item = await self.queue.get()
+            # ここから task_done までの間に await はないので、scaler に idle と見なされない
+            del self._idle_since[name]
+            # DurableQueue は get した Task で完了を見分けるので、あとで呼べる形にしておく
+            detach = getattr(self.queue, "detach_task_done", None)
+            finish = detach() if detach is not None else self.queue.task_done
+            pending = None
+            try:
+                if self.age_of is not None:
+                    self._max_age_seen = max(self._max_age_seen, self.age_of(item))
+                pending = await self.handler(name, item)
+            except Exception:
+                # 1件の失敗で worker を止めない (記録は handler 側の責任)
+                self.errors += 1
+            finally:
+                if isinstance(pending, asyncio.Future) and not pending.done():
+                    pending.add_done_callback(lambda done, finish=finish: self._finish(done, finish))
+                else:
+                    self.processed += 1
+                    finish()
+
+    def _finish(self, done, finish):
+        if done.cancelled() or done.exception() is not None:
+            self.errors += 1
+        self.processed += 1
+        finish()
+
+    # ---- 本数の見直し ----
+
+    async def _autoscale(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.scale_interval)
+            old = self.size
+            wanted, reason = self._wanted_workers()
+
+            if wanted > old:
+                for _ in range(wanted - old):
+                    self._spawn()
+                self.scale_ups += 1
+            elif wanted < old:
+                # 長く待っている worker から止める
+                now = loop.time()
+                idle = sorted(self._idle_since.items(), key=lambda pair: pair[1])
+                for name, since in idle[: old - wanted]:
+                    if now - since >= self.idle_timeout:
+                        self._retire(name)
+                if self.size < old:
+                    self.scale_downs += 1
+
+            if self.size != old and self.on_scale is not None:
+                self.on_scale(old, self.size, reason)
+
+    def _wanted_workers(self):
+        """(欲しい本数, 理由) を返す。"""
+        size = self.size
+        depth = self.queue.qsize()
+        max_age, self._max_age_seen = self._max_age_seen, 0.0
+
+        if depth > self.scale_up_depth * size:
+            wanted = math.ceil(depth / self.scale_up_depth)
+            return min(wanted, self.max_workers), f"queue={depth}"
+        if self.max_item_age is not None and max_age > self.max_item_age and not self._idle_since:
+            return min(size + 1, self.max_workers), f"age={max_age:.2f}s"
+        if self._idle_since:
+            # 仕事を待っている worker がいる = 余っている。止めるかどうかは idle_timeout で判断
+            return max(size - len(self._idle_since), self.min_workers), "idle"
+        return size, ""
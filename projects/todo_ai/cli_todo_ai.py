@@ -2,48 +2,145 @@
 # このスクリプトは、ユーザーの日本語入力から「タイトル」と「メモ」を提案する
 # TODO作成アシスタントの最小CLI版です。
 # タスク管理アプリの入力フォーム自動生成（タイトル/メモのたたき台）に活かせます。
+# 同じ相談への提案はキャッシュし（proposal_cache.py）、todo_ai_demo のサーバとも共有します。
+#
+# 実行例:
+#   python cli_todo_ai.py              # キャッシュを使う
+#   python cli_todo_ai.py --no-cache   # 毎回APIを呼ぶ
+#   python cli_todo_ai.py --cache-stats
+#   python cli_todo_ai.py --batch inputs.txt > proposals.jsonl   # 1行1件の相談をまとめて
+#   type inputs.txt | python cli_todo_ai.py --batch -             # 標準入力から
+#
+# バッチでは、相談を --concurrency 件ずつ同時にAPIへ送り、結果を入力の順に1行1件の JSON（JSONL）で出します。
+#   {"index": 0, "text": "...", "title": "...", "memo": "...", "cache": "HIT"}
+#   {"index": 1, "text": "...", "error": "..."}   <- 失敗した相談（残りはそのまま続ける）
+# 失敗した相談が1件でもあれば、全部を出し終えてから終了コード 1 で終わります。
 
+import argparse
 import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
 from openai import OpenAI
 from pydantic import BaseModel
 
+from proposal_cache import DEFAULT_PATH, ProposalCache
+
+MODEL = "gpt-4o-2024-08-06"
+SYSTEM_PROMPT = (
+    "あなたはTODO作成アシスタントです。\n"
+    "ユーザーの日本語入力から、短いタイトルと補足メモを作ってください。\n"
+    "タイトルは短く、メモは具体的に書きます。\n"
+)
+# キャッシュのファイル（サーバと同じファイル）と有効期限
+CACHE_PATH = DEFAULT_PATH
+CACHE_TTL_SECONDS = 24 * 3600
+# バッチで同時にAPIへ送る数（既定）
+BATCH_CONCURRENCY = 8
+
 # 返してほしい構造を定義します（Structured Outputs の schema になります）
 class TodoProposal(BaseModel):
     title: str
     memo: str
 
 
-def main():
-    # APIキーは環境変数 OPENAI_API_KEY から読み込みます
-    if not os.environ.get("OPENAI_API_KEY"):
-        raise SystemExit("OPENAI_API_KEY が未設定です。PowerShell で setx OPENAI_API_KEY \"...\" を実行してください。")
-
-    user_text = input("相談内容> ").strip()
-    if not user_text:
-        raise SystemExit("入力が空です。日本語でやりたいことを入力してください。")
+def propose(client, cache, user_text):
+    """1件分の提案を作り、(提案の dict, "HIT" / "MISS") を返す。client が None ならキャッシュだけを見る。"""
+    # 同じ相談を覚えていれば、APIを呼ばずにそのまま返す（APIキーも不要）
+    key = None
+    if cache is not None:
+        key = cache.key(user_text, model=MODEL, system_prompt=SYSTEM_PROMPT)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached, "HIT"
 
-    client = OpenAI()
+    if client is None:
+        raise RuntimeError("OPENAI_API_KEY が未設定です")
 
     response = client.responses.parse(
-        model="gpt-4o-2024-08-06",
+        model=MODEL,
         input=[
-            {
-                "role": "system",
-                "content": (
-                    "あなたはTODO作成アシスタントです。\n"
-                    "ユーザーの日本語入力から、短いタイトルと補足メモを作ってください。\n"
-                    "タイトルは短く、メモは具体的に書きます。\n"
-                ),
-            },
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_text},
         ],
         text_format=TodoProposal,
     )
 
-    proposal = response.output_parsed
-    print(json.dumps(proposal.model_dump(), ensure_ascii=False, indent=2))
+    proposal = response.output_parsed.model_dump()
+    if cache is not None:
+        cache.put(key, proposal)
+    return proposal, "MISS"
+
+
+def read_inputs(path):
+    """1行1件の相談文を読む（"-" なら標準入力）。空行は飛ばす。"""
+    if path == "-":
+        return [line.strip() for line in sys.stdin if line.strip()]
+    with open(path, encoding="utf-8-sig") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def run_batch(texts, client, cache, concurrency):
+    """相談をまとめて処理し、入力の順に JSONL で出す。失敗した件数を返す。"""
+
+    def propose_line(index, text):
+        try:
+            proposal, cache_status = propose(client, cache, text)
+        except Exception as exc:
+            # 1件の失敗でバッチ全体は止めず、その行に error を入れて続ける
+            return {"index": index, "text": text, "error": str(exc)}
+        return {"index": index, "text": text, **proposal, "cache": cache_status}
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(propose_line, i, text) for i, text in enumerate(texts)]
+        # 終わった順ではなく入力の順に出す（先頭が終われば、後ろを待たずに出していく）
+        for future in futures:
+            line = future.result()
+            failed += "error" in line
+            print(json.dumps(line, ensure_ascii=False), flush=True)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TODO作成アシスタント（CLI版）")
+    parser.add_argument("--no-cache", action="store_true", help="キャッシュを使わずに毎回APIを呼ぶ")
+    parser.add_argument("--cache-stats", action="store_true", help="キャッシュの状況を表示して終わる")
+    parser.add_argument("--batch", metavar="FILE", help="1行1件の相談をまとめて処理する（- なら標準入力）")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="バッチで同時にAPIへ送る数")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else ProposalCache(ttl_seconds=CACHE_TTL_SECONDS, path=CACHE_PATH)
+    if args.cache_stats:
+        if cache is not None:
+            print(json.dumps(cache.stats(), ensure_ascii=False, indent=2))
+        return
+
+    # APIキーは環境変数 OPENAI_API_KEY から読み込みます（無ければキャッシュにあるものだけ返せる）
+    client = OpenAI() if os.environ.get("OPENAI_API_KEY") else None
+
+    if args.batch:
+        if args.concurrency < 1:
+            raise SystemExit("--concurrency は1以上にしてください。")
+        texts = read_inputs(args.batch)
+        failed = run_batch(texts, client, cache, args.concurrency)
+        print(f"{len(texts)} 件を処理しました（失敗 {failed} 件）", file=sys.stderr)
+        # 全件を処理したうえで、失敗が1件でもあれば終了コード 1 にする（呼び出し側のスクリプトが気づけるように）
+        if failed:
+            raise SystemExit(1)
+        return
+
+    user_text = input("相談内容> ").strip()
+    if not user_text:
+        raise SystemExit("入力が空です。日本語でやりたいことを入力してください。")
 
+    try:
+        proposal, _ = propose(client, cache, user_text)
+    except RuntimeError as exc:
+        # キャッシュに無く、APIキーも無い
+        raise SystemExit(f"{exc}。PowerShell で setx OPENAI_API_KEY \"...\" を実行してください。")
+    print(json.dumps(proposal, ensure_ascii=False, indent=2))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,175 @@
+﻿# -*- coding: utf-8 -*-
+# このモジュールは、AIの提案（タイトル/メモ）を入力文ごとに覚えておくキャッシュです。
+# cli_todo_ai.py と todo_ai_demo/server.py の両方から使います。
+# 同じ相談を何度も送られても、2回目からはAPIを呼ばずに即座に返せます。
+#
+# しくみ:
+# - キーは「正規化した相談文 + モデル名 + システムプロンプト」のハッシュ
+#   （全角/半角・前後の空白・空白の連続・英字の大小の違いは同じ相談とみなす）
+# - 1段目: プロセス内のメモリ（LRU: 上限を超えたら一番古く使われたものから捨てる）
+# - 2段目: SQLite ファイル（任意）。再起動しても残り、CLI とサーバで共有できる
+# - どちらも TTL（有効期限）を過ぎたものは使わない
+#
+# 使い方:
+#     cache = ProposalCache(path=DEFAULT_PATH)
+#     key = cache.key(text, model=MODEL, system_prompt=SYSTEM_PROMPT)
+#     proposal = cache.get(key)
+#     if proposal is None:
+#         proposal = ...  # APIを呼ぶ
+#         cache.put(key, proposal)
+#     cache.stats()  # ヒット率や保持しているバイト数
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+# CLI とサーバで共有する既定のファイル
+DEFAULT_PATH = Path(__file__).with_name("proposal_cache.sqlite3")
+
+
+def normalize_text(text):
+    """相談文を正規化する（NFKC + 空白をまとめる + 英字の大小をそろえる）。"""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split()).casefold()
+
+
+class ProposalCache:
+    """
+    提案を覚えておく2段のキャッシュ。複数スレッドから呼んでよい（サーバ用）。
+
+    - max_entries / max_bytes: メモリに置く件数とバイト数の上限
+    - ttl_seconds: 有効期限（None なら期限なし）
+    - path: SQLite ファイルのパス（None ならメモリだけ）
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl_seconds=24 * 3600,
+                 path=None, clock=time.time):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        # key -> (保存した時刻, JSON の bytes)。末尾ほど最近使ったもの
+        self._memory = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS proposals ("
+                "key TEXT PRIMARY KEY, created_at REAL NOT NULL, value BLOB NOT NULL)"
+            )
+            self._db.commit()
+
+        # 集計
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, text, model, system_prompt):
+        """キャッシュのキー。システムプロンプトは前後の空白だけ無視する。"""
+        raw = json.dumps([model, system_prompt.strip(), normalize_text(text)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """覚えている提案（dict）を返す。無い・期限切れなら None。"""
+        now = self.clock()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._fresh(entry[0], now):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return json.loads(entry[1])
+                self._drop(key)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT created_at, value FROM proposals WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and self._fresh(row[0], now):
+                    # 次からはメモリで返せるように載せておく
+                    self._store(key, row[0], bytes(row[1]))
+                    self.disk_hits += 1
+                    return json.loads(row[1])
+                if row is not None:
+                    # 期限切れはファイルからも消す（ファイルが増え続けないように）
+                    self._db.execute("DELETE FROM proposals WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def put(self, key, proposal):
+        now = self.clock()
+        value = json.dumps(proposal, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._store(key, now, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO proposals (key, created_at, value) VALUES (?, ?, ?)",
+                    (key, now, value),
+                )
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM proposals")
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            result = {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self._memory),
+                "bytes": self._bytes,
+                "evictions": self.evictions,
+            }
+            if self._db is not None:
+                count, size = self._db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM proposals"
+                ).fetchone()
+                result["disk_entries"] = count
+                result["disk_bytes"] = size
+            return result
+
+    # ---- 以下は lock を持った状態で呼ぶ ----
+
+    def _fresh(self, created_at, now):
+        return self.ttl_seconds is None or now - created_at < self.ttl_seconds
+
+    def _store(self, key, created_at, value):
+        if key in self._memory:
+            self._drop(key)
+        self._memory[key] = (created_at, value)
+        self._bytes += len(value)
+        # 上限を超えたら、一番長く使われていないものから捨てる
+        while len(self._memory) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._memory))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key):
+        _, value = self._memory.pop(key)
+        self._bytes -= len(value)
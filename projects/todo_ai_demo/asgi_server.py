@@ -0,0 +1,325 @@
+﻿# -*- coding: utf-8 -*-
+# server.py と同じ画面・API を、非同期（ASGI）で動かす版です。
+# Flask 版は、上流の応答（数秒）を待つ間ずっとスレッドを1本ふさぎます。
+# こちらは待っている間にイベントループが他のリクエストを処理するので、
+# 1プロセス・1スレッドで数百件の「応答待ち」を同時に抱えられます。
+#
+# - ルートと JSON の形は server.py と同じ（MODEL / SYSTEM_PROMPT / キャッシュ / タイムアウトも server.py のもの）
+# - 上流への同時リクエストは MAX_IN_FLIGHT 件まで。超えたら待たせずにすぐ 503（Retry-After 付き）を返す
+#   （待たせても、その間メモリと接続を抱えたまま応答が遅れるだけなので、早く断って再送してもらう）
+# - キャッシュに当たったものは上流に行かないので、上限には数えない
+# - /api/propose/stream（SSE）は、ストリームを送り終わるまで上限に数える
+# - /api/propose/batch は、BATCH_CONCURRENCY 件分の枠を始める時点でまとめて取り、送り終わるまで持つ
+#   （空きが無ければ 503）
+#
+# 実行例:
+#   uvicorn asgi_server:app --port 8000
+#   python asgi_server.py
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+import server
+from proposal_stream import SSE_HEADERS, PartialFields, sse_event
+from server import (
+    BATCH_CONCURRENCY,
+    BATCH_HEADERS,
+    MODEL,
+    SYSTEM_PROMPT,
+    TodoProposal,
+    batch_line,
+    build_input,
+    read_batch,
+)
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# 上流への同時リクエストの上限（= 接続プールの大きさ）
+MAX_IN_FLIGHT = 256
+# 503 のときに「何秒後に再送してほしいか」
+RETRY_AFTER_SECONDS = 1
+# 接続プールを分ける数。httpx のプールは接続が数百本になると、1件ごとの処理が
+# 接続の本数に比例して重くなる（CPU の大半をプールの管理に使う）ので、小さなプールに分けて順番に使う
+UPSTREAM_CLIENTS = 8
+
+_clients = []
+_next_client = itertools.count()
+# 上流の応答を待っている件数（イベントループの中だけで増減するので lock は不要）
+_in_flight = 0
+
+
+def get_client():
+    """
+    全リクエストで共有する非同期クライアントを、UPSTREAM_CLIENTS 個の中から順番に返す。
+    最初の1回だけ作る（APIキーが無いと作れないので起動時ではなくここで）。
+    """
+    if not _clients:
+        # 合計の同時実行数は MAX_IN_FLIGHT で抑えるので、1つあたりの残す接続は均等に分ける
+        keepalive = -(-MAX_IN_FLIGHT // UPSTREAM_CLIENTS)
+        for _ in range(UPSTREAM_CLIENTS):
+            _clients.append(
+                AsyncOpenAI(
+                    timeout=httpx.Timeout(
+                        server.UPSTREAM_TIMEOUT_SECONDS,
+                        connect=server.UPSTREAM_CONNECT_TIMEOUT_SECONDS,
+                    ),
+                    max_retries=server.UPSTREAM_MAX_RETRIES,
+                    http_client=DefaultAsyncHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=MAX_IN_FLIGHT,
+                            max_keepalive_connections=keepalive,
+                            keepalive_expiry=server.UPSTREAM_KEEPALIVE_SECONDS,
+                        ),
+                    ),
+                )
+            )
+    return _clients[next(_next_client) % len(_clients)]
+
+
+async def index(request):
+    # index.html にはテンプレートの変数が無いので、そのまま返す
+    return FileResponse(BASE_DIR / "templates" / "index.html")
+
+
+async def read_json(request):
+    """要求の JSON（JSON でなければ None: Flask の get_json(silent=True) と同じ）。"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def read_text(request):
+    """入力の相談文（JSON のオブジェクトでなければ空として扱う）。"""
+    data = await read_json(request)
+    if not isinstance(data, dict):
+        data = {}
+    return (data.get("text") or "").strip()
+
+
+def busy_response():
+    return JSONResponse(
+        {"error": "混み合っています。少し待ってから再度お試しください"},
+        status_code=503,
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
+
+
+class _SlotStreamingResponse(StreamingResponse):
+    """
+    送り終わったとき（途中で切断されたときも）に上限の枠を返す StreamingResponse。
+    枠（slots 件）は作る側で先に _in_flight に足しておく。
+    """
+
+    def __init__(self, content, slots=1, **kwargs):
+        super().__init__(content, **kwargs)
+        self.slots = slots
+
+    async def __call__(self, scope, receive, send):
+        global _in_flight
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            _in_flight -= self.slots
+
+
+async def propose(request):
+    global _in_flight
+    text = await read_text(request)
+
+    if not text:
+        return JSONResponse({"error": "相談内容が空です"}, status_code=400)
+
+    # 同じ相談を覚えていれば、APIを呼ばずにそのまま返す
+    cache = server.cache
+    key = cache.key(text, model=MODEL, system_prompt=SYSTEM_PROMPT)
+    # 読み出しもメモリに無ければ SQLite を読み、put の commit 中は lock で待たされるので、別スレッドで行う
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        return JSONResponse(cached, headers={"X-Cache": "HIT"})
+
+    if not os.environ.get("OPENAI_API_KEY"):
+        return JSONResponse({"error": "OPENAI_API_KEY が未設定です"}, status_code=500)
+
+    # 上限いっぱいなら、並ばせずにすぐ断る
+    if _in_flight >= MAX_IN_FLIGHT:
+        return busy_response()
+
+    _in_flight += 1
+    try:
+        # 応答を待つ間、このイベントループは他のリクエストを処理できる
+        response = await get_client().responses.parse(
+            model=MODEL, input=build_input(text), text_format=TodoProposal
+        )
+    finally:
+        _in_flight -= 1
+
+    result = response.output_parsed.model_dump()
+    # ディスク側への書き込み（commit）でループを止めないよう、別スレッドで行う
+    await asyncio.to_thread(cache.put, key, result)
+    return JSONResponse(result, headers={"X-Cache": "MISS"})
+
+
+async def propose_stream(request):
+    """server.py の /api/propose/stream と同じ。ストリームを送っている間は上限に数える。"""
+    global _in_flight
+    text = await read_text(request)
+
+    if not text:
+        return JSONResponse({"error": "相談内容が空です"}, status_code=400)
+
+    cache = server.cache
+    key = cache.key(text, model=MODEL, system_prompt=SYSTEM_PROMPT)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        # 覚えていれば、完成品をそのまま1回で送る
+        return StreamingResponse(
+            iter([sse_event("done", cached)]),
+            media_type="text/event-stream",
+            headers={**SSE_HEADERS, "X-Cache": "HIT"},
+        )
+
+    if not os.environ.get("OPENAI_API_KEY"):
+        return JSONResponse({"error": "OPENAI_API_KEY が未設定です"}, status_code=500)
+
+    if _in_flight >= MAX_IN_FLIGHT:
+        return busy_response()
+
+    async def generate():
+        fields = PartialFields()
+        try:
+            async with get_client().responses.stream(
+                model=MODEL, input=build_input(text), text_format=TodoProposal
+            ) as stream:
+                async for event in stream:
+                    if event.type == "response.output_text.delta":
+                        changed = fields.feed(event.delta)
+                        if changed:
+                            yield sse_event("partial", changed)
+                result = (await stream.get_final_response()).output_parsed.model_dump()
+        except Exception as exc:
+            # ステータス（200）はもう送ってしまったので、失敗はイベントで伝える
+            yield sse_event("error", {"error": f"提案の作成に失敗しました: {exc}"})
+            return
+        await asyncio.to_thread(cache.put, key, result)
+        yield sse_event("done", result)
+
+    # 枠はここで取り、_SlotStreamingResponse が送り終わったときに返す
+    _in_flight += 1
+    return _SlotStreamingResponse(
+        generate(), media_type="text/event-stream", headers={**SSE_HEADERS, "X-Cache": "MISS"}
+    )
+
+
+async def propose_item(index, text):
+    """
+    server.py の propose_item と同じ（バッチの1件分。失敗はその行の error で返す）。
+    上限の枠はバッチ全体で先に取っているので、ここでは数えない。
+    """
+    if not isinstance(text, str):
+        return batch_line(index, text, error="相談内容は文字列で指定してください")
+    if not text.strip():
+        return batch_line(index, text, error="相談内容が空です")
+
+    cache = server.cache
+    # キャッシュの読み書きの失敗も、この1件の error にする（ストリーム全体は止めない）
+    try:
+        key = cache.key(text, model=MODEL, system_prompt=SYSTEM_PROMPT)
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return batch_line(index, text, cached, "HIT")
+
+        if not os.environ.get("OPENAI_API_KEY"):
+            return batch_line(index, text, error="OPENAI_API_KEY が未設定です")
+
+        response = await get_client().responses.parse(
+            model=MODEL, input=build_input(text.strip()), text_format=TodoProposal
+        )
+        result = response.output_parsed.model_dump()
+        await asyncio.to_thread(cache.put, key, result)
+    except Exception as exc:
+        return batch_line(index, text, error=f"提案の作成に失敗しました: {exc}")
+    return batch_line(index, text, result, "MISS")
+
+
+async def propose_batch(request):
+    """server.py の /api/propose/batch と同じ。同時に上流へ送るのは BATCH_CONCURRENCY 件まで。"""
+    global _in_flight
+    texts, error = read_batch(await read_json(request))
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+
+    # バッチを進められるだけの空きが無ければ、始めずに断る
+    if _in_flight + BATCH_CONCURRENCY > MAX_IN_FLIGHT:
+        return busy_response()
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(index, text):
+        async with semaphore:
+            return await propose_item(index, text)
+
+    async def generate():
+        tasks = [asyncio.create_task(run(i, text)) for i, text in enumerate(texts)]
+        try:
+            # 終わった順ではなく入力の順に返す（先頭が終われば、後ろを待たずに送っていく）
+            for task in tasks:
+                yield await task
+        finally:
+            # 途中で切断されたら、残りは上流に送らない（送っている最中のものも打ち切る）
+            for task in tasks:
+                task.cancel()
+
+    # 同時に上流へ送る分の枠をここでまとめて取り、_SlotStreamingResponse が送り終わったときに返す
+    # （チェックから足すまでの間に await が無いので、同時に来たバッチが同じ空きを取り合うことはない）
+    _in_flight += BATCH_CONCURRENCY
+    return _SlotStreamingResponse(
+        generate(),
+        slots=BATCH_CONCURRENCY,
+        media_type="application/x-ndjson",
+        headers=BATCH_HEADERS,
+    )
+
+
+async def cache_stats(request):
+    return JSONResponse(server.cache.stats())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # 終了時に接続プールを閉じる
+    for client in _clients:
+        await client.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/", index, methods=["GET"]),
+        Route("/api/propose", propose, methods=["POST"]),
+        Route("/api/propose/stream", propose_stream, methods=["POST"]),
+        Route("/api/propose/batch", propose_batch, methods=["POST"]),
+        Route("/api/cache/stats", cache_stats, methods=["GET"]),
+        Mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static"),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    # ローカル起動用
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=8000)
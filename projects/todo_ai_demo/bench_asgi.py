@@ -0,0 +1,245 @@
+﻿# -*- coding: utf-8 -*-
+# 遅い提案（上流の応答に数秒）を数百件同時に送り、Flask 版（server.py）と ASGI 版（asgi_server.py）を比べるベンチマークです。
+#
+# - 上流は fake_upstream.py（--latency 秒待ってから応答する）
+# - サーバは別プロセス（1プロセス）で起動し、そのプロセスのスレッド数と RSS（メモリ）の最大値を測る
+#   （Linux の /proc を読むので、他の OS では "-" になる）
+# - Flask 版はリクエストごとにスレッドを1本使う。ASGI 版は1スレッドのイベントループで待つ
+# - 上流への接続の上限は両方 --max-in-flight にそろえる。ASGI 版はそれを超えた分を 503 で断る
+#   まず --max-in-flight 件を送り、それが全部上流に届いてから残りを送る（残りは満杯のところに来る）
+# - 相談文は毎回変え、キャッシュはメモリだけにする（必ず上流まで行く）
+# - server_cpu_s はサーバプロセスが使った CPU 秒。1コアの環境ではベンチ側・疑似上流と CPU を取り合う
+#
+# 使い方:
+#   python bench_asgi.py --requests 300 --latency 2.0
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+import httpx
+
+from fake_upstream import FakeUpstream
+
+MODES = ("flask", "asgi")
+# ベンチ側で要求を送る httpx クライアントの数
+CLIENT_SHARDS = 16
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Flask 版 / ASGI 版の同時接続ベンチマーク")
+    parser.add_argument("--requests", type=int, default=300, help="同時に送る数")
+    parser.add_argument("--latency", type=float, default=2.0, help="疑似上流の応答秒数")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="上流への同時リクエストの上限")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    return parser
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(mode, port, base_url, max_in_flight):
+    """子プロセスの入口: 疑似上流に向けたサーバを起動する。"""
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = "bench"
+    import server
+    from proposal_cache import ProposalCache
+
+    server.cache = ProposalCache()
+    server.UPSTREAM_POOL_SIZE = max_in_flight
+    if mode == "flask":
+        from werkzeug.serving import make_server
+
+        # 1件ごとのアクセスログは出さない
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        make_server("127.0.0.1", port, server.app, threaded=True).serve_forever()
+    else:
+        import uvicorn
+
+        import asgi_server
+
+        asgi_server.MAX_IN_FLIGHT = max_in_flight
+        uvicorn.run(asgi_server.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def read_cpu_seconds(pid):
+    """プロセスが使った CPU 秒 (user + system)。/proc が無ければ None。"""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def read_proc_status(pid):
+    """(スレッド数, RSS の MB) を返す。/proc が無ければ None。"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    return int(fields["Threads"]), int(fields["VmRSS"].split()[0]) / 1024
+
+
+class ProcSampler:
+    """別スレッドで一定間隔にスレッド数と RSS を読み、最大値を覚えておく。"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = None
+        self.peak_rss_mb = None
+        self.cpu_seconds = None
+        self._started_cpu = read_cpu_seconds(pid)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        ended_cpu = read_cpu_seconds(self.pid)
+        if self._started_cpu is not None and ended_cpu is not None:
+            self.cpu_seconds = ended_cpu - self._started_cpu
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            status = read_proc_status(self.pid)
+            if status is None:
+                return
+            threads, rss_mb = status
+            self.peak_threads = max(self.peak_threads or 0, threads)
+            self.peak_rss_mb = max(self.peak_rss_mb or 0.0, rss_mb)
+            time.sleep(self.interval)
+
+
+async def wait_ready(url, process, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if not process.is_alive():
+                    raise RuntimeError(f"server exited with code {process.exitcode}") from None
+                if time.perf_counter() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def send_all(url, count, mode, upstream, first_batch):
+    """
+    count 件を送り、(全体の秒数, ステータスごとの件数, 200 の応答時間, 503 の応答時間) を返す。
+    先に first_batch 件を送り、それが全部上流に届いてから残りを送る。
+    """
+    # 1つの httpx クライアントに数百本の接続を持たせるとベンチ側が CPU を食うので、
+    # asgi_server.UPSTREAM_CLIENTS と同じく小さなクライアントに分ける
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    clients = [httpx.AsyncClient(limits=limits, timeout=300.0) for _ in range(CLIENT_SHARDS)]
+
+    async def send(i):
+        started = time.perf_counter()
+        try:
+            res = await clients[i % CLIENT_SHARDS].post(
+                f"{url}/api/propose", json={"text": f"ベンチ {mode} {i}"}
+            )
+        except httpx.TransportError as exc:
+            return type(exc).__name__, None
+        return res.status_code, time.perf_counter() - started
+
+    try:
+        started = time.perf_counter()
+        first = [asyncio.create_task(send(i)) for i in range(min(count, first_batch))]
+        # 上流に届いた数で「満杯になった」を判断する（届かないまま終わったものがあれば打ち切る）
+        while upstream.requests < len(first) and not all(task.done() for task in first):
+            await asyncio.sleep(0.01)
+        rest = [asyncio.create_task(send(i)) for i in range(len(first), count)]
+        results = await asyncio.gather(*first, *rest)
+        elapsed = time.perf_counter() - started
+    finally:
+        for client in clients:
+            await client.aclose()
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for status, latency in results if status == 200)
+    rejected = sorted(latency for status, latency in results if status == 503)
+    return elapsed, statuses, latencies, rejected
+
+
+def run_mode(mode, args, upstream):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(
+        target=serve, args=(mode, port, upstream.base_url, args.max_in_flight), daemon=True
+    )
+    process.start()
+    try:
+        asyncio.run(wait_ready(url, process))
+        upstream.reset_counts()
+        with ProcSampler(process.pid) as sampler:
+            elapsed, statuses, latencies, rejected = asyncio.run(
+                send_all(url, args.requests, mode, upstream, args.max_in_flight)
+            )
+    finally:
+        process.terminate()
+        process.join()
+    return elapsed, statuses, latencies, rejected, sampler
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    upstream = FakeUpstream(latency=args.latency).start()
+    print(
+        f"requests={args.requests} latency={args.latency}s max_in_flight={args.max_in_flight} "
+        f"cpu_count={os.cpu_count()}"
+    )
+    print(
+        f"{'mode':<6} {'wall_s':>7} {'ok':>5} {'503':>5} {'other':>6} {'p50_s':>6} {'p95_s':>6} "
+        f"{'503_p50_ms':>10} "
+        f"{'threads':>8} {'rss_MB':>7} {'server_cpu_s':>12} {'upstream_conns':>14}"
+    )
+    try:
+        for mode in args.modes:
+            elapsed, statuses, latencies, rejected, sampler = run_mode(mode, args, upstream)
+            other = sum(count for status, count in statuses.items() if status not in (200, 503))
+            p50 = f"{percentile(latencies, 0.50):.2f}" if latencies else "-"
+            p95 = f"{percentile(latencies, 0.95):.2f}" if latencies else "-"
+            # 503 は上流を待たずに返るので、ここが小さいほど「早く断れている」
+            reject_ms = f"{percentile(rejected, 0.50) * 1000:.0f}" if rejected else "-"
+            threads = sampler.peak_threads if sampler.peak_threads is not None else "-"
+            rss = f"{sampler.peak_rss_mb:.0f}" if sampler.peak_rss_mb is not None else "-"
+            cpu = f"{sampler.cpu_seconds:.2f}" if sampler.cpu_seconds is not None else "-"
+            print(
+                f"{mode:<6} {elapsed:>7.2f} {statuses[200]:>5} {statuses[503]:>5} {other:>6} "
+                f"{p50:>6} {p95:>6} {reject_ms:>10} {threads:>8} {rss:>7} {cpu:>12} {upstream.connections:>14}"
+            )
+            if other:
+                print(f"       other statuses: {dict(statuses)}")
+    finally:
+        upstream.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,126 @@
+﻿# -*- coding: utf-8 -*-
+# 提案を「まとめて返す」（/api/propose）か「SSE で少しずつ返す」（/api/propose/stream）かで、
+# 画面に何か出るまでの時間がどれだけ変わるかを測るベンチマークです。
+#
+# - 上流は fake_upstream.py（--latency 秒後に最初の token、あとは --token-interval 秒ごとに数文字）
+# - サーバは bench_asgi.py と同じく別プロセスで起動する（Flask 版 / ASGI 版）
+# - ttfb_ms: 応答の最初のバイトが届くまで
+#   first_field_ms: タイトルかメモの一部が読めるまで（まとめて返すときは本文を全部読み終わるまで）
+#   total_ms: 応答を全部読み終わるまで
+# - 相談文は毎回変え、キャッシュはメモリだけにする（必ず上流まで行く）
+#
+# 使い方:
+#   python bench_stream.py --requests 20 --latency 0.3 --token-interval 0.03
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import time
+
+import httpx
+
+from bench_asgi import MODES, free_port, serve, wait_ready
+from fake_upstream import FakeUpstream
+
+ENDPOINTS = ("buffered", "stream")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="まとめて返す / SSE で返す の体感速度ベンチマーク")
+    parser.add_argument("--requests", type=int, default=20, help="1つの組み合わせで送る数（1件ずつ順に）")
+    parser.add_argument("--latency", type=float, default=0.3, help="疑似上流の最初の token までの秒数")
+    parser.add_argument("--token-interval", type=float, default=0.03, help="疑似上流の token ごとの秒数")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    return parser
+
+
+async def measure_buffered(client, url, text):
+    started = time.perf_counter()
+    async with client.stream("POST", f"{url}/api/propose", json={"text": text}) as res:
+        chunks = res.aiter_bytes()
+        body = await anext(chunks)
+        ttfb = time.perf_counter() - started
+        async for chunk in chunks:
+            body += chunk
+    total = time.perf_counter() - started
+    if res.status_code != 200 or "title" not in json.loads(body):
+        raise RuntimeError(f"unexpected response: {res.status_code} {body[:200]!r}")
+    # まとめて返すときは、JSON を全部読むまでどの項目も表示できない
+    return ttfb, total, total
+
+
+async def measure_stream(client, url, text):
+    started = time.perf_counter()
+    ttfb = first_field = None
+    events = []
+    async with client.stream("POST", f"{url}/api/propose/stream", json={"text": text}) as res:
+        async for line in res.aiter_lines():
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            if line.startswith("event: "):
+                events.append(line[7:])
+                if first_field is None and events[-1] in ("partial", "done"):
+                    first_field = time.perf_counter() - started
+    total = time.perf_counter() - started
+    if res.status_code != 200 or events[-1:] != ["done"]:
+        raise RuntimeError(f"unexpected stream: {res.status_code} {events[-3:]}")
+    return ttfb, first_field, total
+
+
+async def run_endpoint(url, endpoint, mode, count):
+    """1件ずつ順に送り、(ttfb, first_field, total) の一覧を返す。"""
+    measure = measure_stream if endpoint == "stream" else measure_buffered
+    results = []
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        # 最初の1件は接続やクライアントの準備を含むので、数えない
+        await measure(client, url, f"ウォームアップ {mode} {endpoint}")
+        for i in range(count):
+            results.append(await measure(client, url, f"ベンチ {mode} {endpoint} {i}"))
+    return results
+
+
+def run_mode(mode, args, upstream):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    context = multiprocessing.get_context("spawn")
+    # 同時には送らないので、上流への上限は小さくてよい
+    process = context.Process(target=serve, args=(mode, port, upstream.base_url, 8), daemon=True)
+    process.start()
+    try:
+        asyncio.run(wait_ready(url, process))
+        return {
+            endpoint: asyncio.run(run_endpoint(url, endpoint, mode, args.requests))
+            for endpoint in ENDPOINTS
+        }
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    upstream = FakeUpstream(latency=args.latency, token_interval=args.token_interval).start()
+    print(
+        f"requests={args.requests} latency={args.latency}s token_interval={args.token_interval}s "
+        f"cpu_count={os.cpu_count()}"
+    )
+    print(f"{'mode':<6} {'endpoint':<9} {'ttfb_ms':>8} {'first_field_ms':>14} {'total_ms':>9}  (median)")
+    try:
+        for mode in args.modes:
+            for endpoint, results in run_mode(mode, args, upstream).items():
+                ttfb, first_field, total = (
+                    statistics.median(values) * 1000 for values in zip(*results)
+                )
+                print(f"{mode:<6} {endpoint:<9} {ttfb:>8.0f} {first_field:>14.0f} {total:>9.0f}")
+    finally:
+        upstream.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
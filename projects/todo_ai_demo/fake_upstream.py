@@ -0,0 +1,242 @@
+﻿# -*- coding: utf-8 -*-
+# OpenAI の Responses API（POST /v1/responses）の代わりをするローカルの疑似サーバです。
+# ロードテストや、APIキー無しで server.py を動かすときに使います。
+# 返すのは相談文から機械的に作った提案（タイトル/メモ）で、latency 秒待ってから応答します。
+# 要求に "stream": true があれば、本物と同じ形のイベント（SSE）で、token_interval 秒ごとに
+# 数文字ずつ送ります（ストリーミングしない要求も、全部を生成し終わるのと同じ時間だけ待ってから返す）。
+# 何本の TCP 接続が張られたか（connections）と、何件の要求が来たか（requests）を数えます。
+#
+# 実行例:
+#   python fake_upstream.py --port 9000 --latency 0.5 --token-interval 0.05
+#   （別のターミナルで）OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=dummy python server.py
+
+from __future__ import annotations
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ストリーミングのとき、1回に送る文字数（token の代わり）
+TOKEN_CHARS = 3
+
+
+def proposal_text(text):
+    """モデルが生成する文字列（title/memo の JSON）を、相談文から機械的に作る。"""
+    proposal = {
+        "title": text[:20],
+        "memo": (
+            f"「{text}」を進めるための手順を書き出す。"
+            "必要な道具と日程を決め、終わったら振り返りをメモに残す。"
+        ),
+    }
+    return json.dumps(proposal, ensure_ascii=False)
+
+
+def split_tokens(output):
+    return [output[i:i + TOKEN_CHARS] for i in range(0, len(output), TOKEN_CHARS)]
+
+
+def build_message(output, status="completed"):
+    content = []
+    if output is not None:
+        content.append({"type": "output_text", "text": output, "annotations": []})
+    return {
+        "id": "msg_fake",
+        "type": "message",
+        "status": status,
+        "role": "assistant",
+        "content": content,
+    }
+
+
+def build_response(output, status="completed"):
+    """Responses API の応答オブジェクト（output=None なら出力がまだ無い状態）。"""
+    return {
+        "id": "resp_fake",
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": status,
+        "model": "fake-upstream",
+        "output": [] if output is None else [build_message(output, status)],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": 0,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": 0,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": 0,
+        },
+    }
+
+
+def stream_events(output):
+    """ストリーミングのときに送るイベントを順に返す（delta の前後の形は本物と同じ）。"""
+    where = {"item_id": "msg_fake", "output_index": 0, "content_index": 0}
+    yield {"type": "response.created", "response": build_response(None, "in_progress")}
+    yield {
+        "type": "response.output_item.added",
+        "output_index": 0,
+        "item": build_message(None, "in_progress"),
+    }
+    yield {
+        "type": "response.content_part.added",
+        **where,
+        "part": {"type": "output_text", "text": "", "annotations": []},
+    }
+    for token in split_tokens(output):
+        yield {"type": "response.output_text.delta", **where, "delta": token, "logprobs": []}
+    yield {"type": "response.output_text.done", **where, "text": output, "logprobs": []}
+    yield {
+        "type": "response.content_part.done",
+        **where,
+        "part": {"type": "output_text", "text": output, "annotations": []},
+    }
+    yield {"type": "response.output_item.done", "output_index": 0, "item": build_message(output)}
+    yield {"type": "response.completed", "response": build_response(output)}
+
+
+def user_text(body):
+    """要求の input から、最後の user メッセージの本文を取り出す。"""
+    for message in reversed(body.get("input") or []):
+        if message.get("role") == "user":
+            return str(message.get("content") or "")
+    return ""
+
+
+class _Server(ThreadingHTTPServer):
+    # 数百の接続が同時に来ても取りこぼさないよう、listen の待ち行列を大きくする（既定は5）
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeUpstream:
+    """
+    別スレッドで動く疑似の上流サーバ。
+
+    - latency: 最初の token までに待つ秒数（モデルが考える時間の代わり）
+    - token_interval: token（TOKEN_CHARS 文字）ごとの生成時間。0 なら一度に全部
+    - base_url: OpenAI(base_url=...) / OPENAI_BASE_URL に渡す URL
+    - connections / requests: 受け付けた TCP 接続の数 / 要求の数
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.05, token_interval=0.0):
+        self.latency = latency
+        self.token_interval = token_interval
+        self.connections = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counts(self):
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _handler_class(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 にすると、1本の接続で続けて要求を受けられる（keep-alive）
+            protocol_version = "HTTP/1.1"
+            # ヘッダと本文を別々に書くので、Nagle を切らないと遅延 ACK と噛み合って毎回 ~40ms 待つ
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                # Handler は接続ごとに1つ作られる
+                super().setup()
+                upstream._count("connections")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.rstrip("/").endswith("/responses"):
+                    self._send(404, {"error": {"message": f"unknown path: {self.path}"}})
+                    return
+                upstream._count("requests")
+                output = proposal_text(user_text(body))
+                time.sleep(upstream.latency)
+                if body.get("stream"):
+                    self._stream(output)
+                    return
+                # ストリーミングしなくても、生成し終わるまでの時間は同じだけかかる
+                time.sleep(upstream.token_interval * (len(split_tokens(output)) - 1))
+                self._send(200, build_response(output))
+
+            def _send(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, output):
+                # 長さが決まらないので、送り終わったら接続を閉じて終わりを伝える
+                self.close_connection = True
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                first_token = True
+                for number, event in enumerate(stream_events(output)):
+                    if event["type"] == "response.output_text.delta":
+                        # 最初の token は latency の直後、あとは token_interval ごと
+                        if not first_token:
+                            time.sleep(upstream.token_interval)
+                        first_token = False
+                    event["sequence_number"] = number
+                    data = json.dumps(event, ensure_ascii=False)
+                    self.wfile.write(f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+            def log_message(self, format, *args):
+                # 1件ごとのアクセスログは出さない（ロードテストの邪魔になる）
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Responses API の疑似サーバ")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.5, help="最初の token までの秒数")
+    parser.add_argument("--token-interval", type=float, default=0.05, help="token ごとの秒数")
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(
+        port=args.port, latency=args.latency, token_interval=args.token_interval
+    ).start()
+    print(f"fake upstream: {upstream.base_url} (Ctrl+C で終了)")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"connections={upstream.connections} requests={upstream.requests}")
+    except KeyboardInterrupt:
+        upstream.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+﻿# -*- coding: utf-8 -*-
+# /api/propose に同時に要求を送り、上流（OpenAI API）への接続の使い回しで何が変わるかを見るロードテストです。
+#
+# - 上流は fake_upstream.py（ローカルの疑似サーバ）。APIキーも通信料も不要
+# - UPSTREAM_CLIENT_MODE を "per_request"（毎回クライアントを作る）と "shared"（使い回す）で比べる
+# - conn/req は「1件あたりに張った TCP 接続の数」。shared なら接続は最大でも UPSTREAM_POOL_SIZE 本
+# - 疑似上流は平文 HTTP なので、本物（TLS）なら接続ごとの手間はもっと大きい
+# - 相談文は毎回変え、キャッシュはメモリだけにする（キャッシュに当たらず必ず上流まで行く）
+#
+# 使い方:
+#   python load_test_upstream.py --requests 400 --concurrency 16 --latency 0.05
+
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_upstream import FakeUpstream
+
+MODES = ("per_request", "shared")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="/api/propose の上流接続ロードテスト")
+    parser.add_argument("--requests", type=int, default=400, help="モードごとの要求数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時に送る数")
+    parser.add_argument("--latency", type=float, default=0.05, help="疑似上流の応答秒数")
+    parser.add_argument("--pool-size", type=int, default=None, help="UPSTREAM_POOL_SIZE")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    return parser
+
+
+def run_mode(server, upstream, mode, args):
+    """1モードぶん送り、所要時間と1件ごとの応答時間を返す。"""
+    server.UPSTREAM_CLIENT_MODE = mode
+    server._client = None
+    upstream.reset_counts()
+    # test_client はスレッドごとに作る（リクエストの状態を共有しないように）
+    local = threading.local()
+
+    def send(i):
+        if not hasattr(local, "client"):
+            local.client = server.app.test_client()
+        started = time.perf_counter()
+        res = local.client.post("/api/propose", json={"text": f"ロードテスト {mode} {i}"})
+        elapsed = time.perf_counter() - started
+        if res.status_code != 200:
+            raise RuntimeError(f"status={res.status_code} body={res.get_data(as_text=True)}")
+        return elapsed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = sorted(pool.map(send, range(args.requests)))
+    return time.perf_counter() - started, latencies
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    upstream = FakeUpstream(latency=args.latency).start()
+    # server を import する前に接続先を疑似上流へ向ける
+    os.environ["OPENAI_BASE_URL"] = upstream.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "load-test")
+
+    import server
+    from proposal_cache import ProposalCache
+
+    server.cache = ProposalCache()
+    if args.pool_size is not None:
+        server.UPSTREAM_POOL_SIZE = args.pool_size
+
+    print(
+        f"requests={args.requests} concurrency={args.concurrency} latency={args.latency}s "
+        f"pool_size={server.UPSTREAM_POOL_SIZE}"
+    )
+    print(
+        f"{'mode':<12} {'req/s':>7} {'p50_ms':>7} {'p95_ms':>7} {'p99_ms':>7} "
+        f"{'overhead_ms':>11} {'conns':>6} {'conn/req':>8}"
+    )
+    try:
+        for mode in args.modes:
+            elapsed, latencies = run_mode(server, upstream, mode, args)
+            # overhead: 応答時間のうち上流の生成時間（latency）以外の部分
+            overhead = statistics.mean(latencies) - args.latency
+            print(
+                f"{mode:<12} {args.requests / elapsed:>7.0f} "
+                f"{percentile(latencies, 0.50) * 1000:>7.1f} "
+                f"{percentile(latencies, 0.95) * 1000:>7.1f} "
+                f"{percentile(latencies, 0.99) * 1000:>7.1f} "
+                f"{overhead * 1000:>11.1f} {upstream.connections:>6} "
+                f"{upstream.connections / upstream.requests:>8.2f}"
+            )
+    finally:
+        upstream.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,92 @@
+﻿# -*- coding: utf-8 -*-
+# AIの提案をストリーミング（SSE）で画面に送るための部品です。server.py と asgi_server.py から使います。
+#
+# Structured Outputs をストリーミングすると、モデルは {"title": "...", "memo": "..."} という JSON を
+# 数文字ずつ生成します。途中の JSON は json.loads できないので、PartialFields で
+# 「今まで届いた分から、title / memo の途中までの値」を取り出し、変わった項目だけを画面に送ります。
+#
+# 送るイベント（Server-Sent Events）:
+#   event: partial  data: {"title": "芋掘"}            <- 途中までの値（変わった項目だけ）
+#   event: done     data: {"title": "...", "memo": "..."}  <- 完成した提案（/api/propose と同じ形）
+#   event: error    data: {"error": "..."}             <- 途中で失敗したとき
+
+from __future__ import annotations
+
+import json
+
+# JSON の1文字エスケープ（\n など）を元の文字に戻す表
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class PartialFields:
+    """
+    生成途中の JSON オブジェクト（値は文字列だけ）から、項目ごとの途中までの値を取り出す。
+
+    feed(delta) で届いた文字を渡すと、この delta で値が伸びた項目の {名前: 今までの値} を返す。
+    1文字ずつ状態を進めるだけなので、全体を毎回読み直すより軽い（delta の長さに比例）。
+    """
+
+    def __init__(self):
+        self.values = {}
+        # "key_start": キーの " を待つ / "key": キーの中 / "colon": : と値の " を待つ / "value": 値の中
+        self._state = "key_start"
+        self._key = ""
+        # 読みかけのエスケープ（"\\" や "\\u12" など）。delta の境目で切れることがある
+        self._escape = ""
+        # サロゲートペア（絵文字など）の前半。後半の \\uXXXX が来るまで持っておく
+        self._high_surrogate = None
+
+    def feed(self, delta):
+        changed = set()
+        for char in delta:
+            if self._state == "key_start":
+                if char == '"':
+                    self._state, self._key = "key", ""
+            elif self._state == "colon":
+                if char == '"':
+                    self._state = "value"
+                    self.values.setdefault(self._key, "")
+                    changed.add(self._key)
+            elif self._escape or char == "\\":
+                self._read_escape(char, changed)
+            elif char == '"':
+                self._state = "colon" if self._state == "key" else "key_start"
+            else:
+                self._append(char, changed)
+        return {key: self.values[key] for key in changed}
+
+    def _read_escape(self, char, changed):
+        self._escape += char
+        if len(self._escape) < 2:
+            return
+        if self._escape[1] != "u":
+            decoded = _ESCAPES.get(self._escape[1], self._escape[1])
+        elif len(self._escape) < 6:
+            return
+        else:
+            code = int(self._escape[2:6], 16)
+            if 0xD800 <= code < 0xDC00:
+                self._high_surrogate, self._escape = code, ""
+                return
+            if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+                code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            decoded = chr(code)
+        self._escape = ""
+        self._append(decoded, changed)
+
+    def _append(self, text, changed):
+        if self._state == "key":
+            self._key += text
+        elif self._state == "value":
+            self.values[self._key] += text
+            changed.add(self._key)
+
+
+def sse_event(event, data):
+    """SSE の1イベント分の文字列（data は JSON にする）。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# ストリーミング応答に付けるヘッダ（途中のプロキシにためこまれないように）
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
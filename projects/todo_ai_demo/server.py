@@ -3,22 +3,151 @@
 # AIに相談文を送ると「タイトル」と「メモ」を返して画面に反映する最小デモです。
 # 目的：Reactでの画面反映フローと、OpenAI APIの連携を理解すること。
 # DBは使わず、保存は行いません（フォーム反映まで）。
+# 同じ相談への提案はキャッシュして、2回目からはAPIを呼ばずに返します（../todo_ai/proposal_cache.py）。
+# 同じ画面・API を非同期（ASGI）で動かす版は asgi_server.py です（同時に多くの相談を受けるとき用）。
+# /api/propose/stream は、生成中のタイトル/メモを SSE で少しずつ返します（proposal_stream.py）。
+# /api/propose/batch は、多くの相談をまとめて受け取り、入力の順に1行1件の JSON（JSONL）で返します。
 
 from __future__ import annotations
 
+import json
 import os
-from flask import Flask, jsonify, render_template, request
-from openai import OpenAI
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+from flask import Flask, Response, jsonify, render_template, request
+from openai import DefaultHttpxClient, OpenAI
 from pydantic import BaseModel
 
+from proposal_stream import SSE_HEADERS, PartialFields, sse_event
+
+# CLI版（../todo_ai）とキャッシュを共有する
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "todo_ai"))
+from proposal_cache import DEFAULT_PATH, ProposalCache  # noqa: E402
+
 app = Flask(__name__)
 
+MODEL = "gpt-4o-2024-08-06"
+SYSTEM_PROMPT = (
+    "あなたはTODO作成アシスタントです。\n"
+    "ユーザーの日本語入力から、短いタイトルと補足メモを作ってください。\n"
+    "タイトルは短く、メモは具体的に書きます。"
+)
+
+# 提案キャッシュの設定
+# キーは「正規化した相談文 + MODEL + SYSTEM_PROMPT」なので、どちらかを変えれば別のキャッシュになる
+CACHE_MAX_ENTRIES = 1000
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+CACHE_TTL_SECONDS = 24 * 3600
+# ディスク側のファイル（CLI版と同じファイル）。None ならメモリだけ（再起動で消える）
+CACHE_PATH = DEFAULT_PATH
+
+cache = ProposalCache(
+    max_entries=CACHE_MAX_ENTRIES,
+    max_bytes=CACHE_MAX_BYTES,
+    ttl_seconds=CACHE_TTL_SECONDS,
+    path=CACHE_PATH,
+)
+
+# 上流（OpenAI API）への接続の設定
+# "shared": クライアントを1つだけ作って全リクエストで使い回す（接続も keep-alive で使い回す）
+# "per_request": リクエストごとに作る（毎回 TCP/TLS の接続からやり直す。比較用）
+UPSTREAM_CLIENT_MODE = "shared"
+# 同時に張る接続の上限。Flask のスレッド数より少ないと、空くまで待つリクエストが出る
+UPSTREAM_POOL_SIZE = 20
+# 使っていない接続を残しておく秒数
+UPSTREAM_KEEPALIVE_SECONDS = 60.0
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = 5.0
+# 応答全体を待つ上限（生成に時間がかかるので長め）
+UPSTREAM_TIMEOUT_SECONDS = 60.0
+UPSTREAM_MAX_RETRIES = 2
+# 接続先は環境変数 OPENAI_BASE_URL で変えられる（fake_upstream.py など）
+
+# バッチ（/api/propose/batch）の設定
+# 1回の要求で受け付ける相談の上限
+BATCH_MAX_ITEMS = 1000
+# 1つのバッチで同時に上流へ送る数（UPSTREAM_POOL_SIZE 以下にする）
+BATCH_CONCURRENCY = 8
+# バッチの応答に付けるヘッダ（途中のプロキシにためこまれないように）
+BATCH_HEADERS = {"X-Accel-Buffering": "no"}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def create_client():
+    """設定値どおりの接続プール・タイムアウトを持つ OpenAI クライアントを作る。"""
+    return OpenAI(
+        timeout=httpx.Timeout(UPSTREAM_TIMEOUT_SECONDS, connect=UPSTREAM_CONNECT_TIMEOUT_SECONDS),
+        max_retries=UPSTREAM_MAX_RETRIES,
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_POOL_SIZE,
+                max_keepalive_connections=UPSTREAM_POOL_SIZE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_SECONDS,
+            ),
+        ),
+    )
+
+
+def get_client():
+    """
+    上流へのクライアントを返す。
+
+    "shared" では最初の1回だけ作り、あとは同じものを返す。
+    OpenAI クライアント（中の httpx.Client）は複数スレッドから同時に使ってよい。
+    作るのは APIキー確認のあと（キーが無いと作れない）なので、起動時ではなくここで作る。
+    """
+    global _client
+    if UPSTREAM_CLIENT_MODE == "per_request":
+        return create_client()
+    if _client is None:
+        # 同時に来た最初のリクエストが2つ作らないように lock を取る
+        with _client_lock:
+            if _client is None:
+                _client = create_client()
+    return _client
+
 
 # 返してほしい構造を定義（Structured Outputs）
 class TodoProposal(BaseModel):
     title: str
     memo: str
 
+
+def build_input(text):
+    """上流に送るメッセージ（システム側の設定 + ユーザーの相談文）。"""
+    return [
+        # システム側の設定
+        {"role": "system", "content": SYSTEM_PROMPT},
+        #ユーザー側で入力したのを送るほう
+        {"role": "user", "content": text},
+    ]
+
+
+def read_batch(data):
+    """バッチの入力 {"texts": [...]} を確かめ、(相談の一覧, エラーメッセージ) を返す。"""
+    texts = data.get("texts") if isinstance(data, dict) else None
+    if not isinstance(texts, list) or not texts:
+        return None, "texts（相談内容の配列）を指定してください"
+    if len(texts) > BATCH_MAX_ITEMS:
+        return None, f"1回に送れる相談は {BATCH_MAX_ITEMS} 件までです"
+    return texts, None
+
+
+def batch_line(index, text, result=None, cache_status=None, error=None):
+    """バッチの応答の1行（JSONL）。失敗した相談は error だけを持つ。"""
+    line = {"index": index, "text": text}
+    if error is not None:
+        line["error"] = error
+    else:
+        line.update(result, cache=cache_status)
+    return json.dumps(line, ensure_ascii=False) + "\n"
+
+
 #ブラウザで http://127.0.0.1:8000/ を開いた時に、index.html を返す
 @app.get("/")
 def index():
@@ -35,36 +164,137 @@ def propose():
     if not text:
         return jsonify({"error": "相談内容が空です"}), 400
 
+    # 同じ相談を覚えていれば、APIを呼ばずにそのまま返す
+    key = cache.key(text, model=MODEL, system_prompt=SYSTEM_PROMPT)
+    cached = cache.get(key)
+    if cached is not None:
+        resp = jsonify(cached)
+        resp.headers["X-Cache"] = "HIT"
+        return resp
+
     # APIキーは環境変数から取得
     if not os.environ.get("OPENAI_API_KEY"):
         return jsonify({"error": "OPENAI_API_KEY が未設定です"}), 500
 
 
-    # OpenAI APIを使うためのクライアント（接続口）
-    client = OpenAI()
+    # OpenAI APIを使うためのクライアント（接続口）。全リクエストで使い回す
+    client = get_client()
 
     response = client.responses.parse(
-        model="gpt-4o-2024-08-06",
-        input=[
-            # システム側の設定
-            {
-                "role": "system",
-                "content": (
-                    "あなたはTODO作成アシスタントです。\n"
-                    "ユーザーの日本語入力から、短いタイトルと補足メモを作ってください。\n"
-                    "タイトルは短く、メモは具体的に書きます。"
-                ),
-            },
-            #ユーザー側で入力したのを送るほう
-            {"role": "user", "content": text},
-        ],
+        model=MODEL,
+        input=build_input(text),
         text_format=TodoProposal,
     )
 
     # AIの返答は TodoProposal型（title/memo）
     proposal = response.output_parsed
     # ythonオブジェクト → 辞書（dict） に変換して返す
-    return jsonify(proposal.model_dump())
+    result = proposal.model_dump()
+    cache.put(key, result)
+    resp = jsonify(result)
+    resp.headers["X-Cache"] = "MISS"
+    return resp
+
+
+# ストリーミング版: 生成中の title / memo を、届いた分から SSE で返す
+# 入力エラーは /api/propose と同じ JSON（400/500）。ストリームが始まってからの失敗は error イベント
+@app.post("/api/propose/stream")
+def propose_stream():
+    data = request.get_json(silent=True) or {}
+    text = (data.get("text") or "").strip()
+
+    if not text:
+        return jsonify({"error": "相談内容が空です"}), 400
+
+    key = cache.key(text, model=MODEL, system_prompt=SYSTEM_PROMPT)
+    cached = cache.get(key)
+    if cached is None and not os.environ.get("OPENAI_API_KEY"):
+        return jsonify({"error": "OPENAI_API_KEY が未設定です"}), 500
+
+    def generate():
+        # 覚えていれば、完成品をそのまま1回で送る
+        if cached is not None:
+            yield sse_event("done", cached)
+            return
+
+        fields = PartialFields()
+        try:
+            with get_client().responses.stream(
+                model=MODEL, input=build_input(text), text_format=TodoProposal
+            ) as stream:
+                for event in stream:
+                    if event.type == "response.output_text.delta":
+                        changed = fields.feed(event.delta)
+                        if changed:
+                            yield sse_event("partial", changed)
+                result = stream.get_final_response().output_parsed.model_dump()
+        except Exception as exc:
+            # ステータス（200）はもう送ってしまったので、失敗はイベントで伝える
+            yield sse_event("error", {"error": f"提案の作成に失敗しました: {exc}"})
+            return
+        cache.put(key, result)
+        yield sse_event("done", result)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={**SSE_HEADERS, "X-Cache": "MISS" if cached is None else "HIT"},
+    )
+
+
+def propose_item(index, text):
+    """バッチの1件分。失敗してもバッチ全体は止めず、その行に error を入れて返す。"""
+    if not isinstance(text, str):
+        return batch_line(index, text, error="相談内容は文字列で指定してください")
+    if not text.strip():
+        return batch_line(index, text, error="相談内容が空です")
+
+    # キャッシュの読み書き（SQLite）の失敗も、この1件の error にする（ストリーム全体は止めない）
+    try:
+        key = cache.key(text, model=MODEL, system_prompt=SYSTEM_PROMPT)
+        cached = cache.get(key)
+        if cached is not None:
+            return batch_line(index, text, cached, "HIT")
+
+        if not os.environ.get("OPENAI_API_KEY"):
+            return batch_line(index, text, error="OPENAI_API_KEY が未設定です")
+
+        response = get_client().responses.parse(
+            model=MODEL, input=build_input(text.strip()), text_format=TodoProposal
+        )
+        result = response.output_parsed.model_dump()
+        cache.put(key, result)
+    except Exception as exc:
+        return batch_line(index, text, error=f"提案の作成に失敗しました: {exc}")
+    return batch_line(index, text, result, "MISS")
+
+
+# バッチ版: {"texts": [...]} を BATCH_CONCURRENCY 件ずつ同時に上流へ送り、入力の順に JSONL で返す
+# 入力の形が違うときだけ 400。1件ごとの失敗はその行の error で伝え、残りはそのまま続ける
+@app.post("/api/propose/batch")
+def propose_batch():
+    texts, error = read_batch(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+
+    def generate():
+        executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY)
+        try:
+            futures = [executor.submit(propose_item, i, text) for i, text in enumerate(texts)]
+            # 終わった順ではなく入力の順に返す（先頭が終われば、後ろを待たずに送っていく）
+            for future in futures:
+                yield future.result()
+        finally:
+            # 途中で切断されたら、まだ始まっていない分は上流に送らない
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return Response(generate(), mimetype="application/x-ndjson", headers=BATCH_HEADERS)
+
+
+# キャッシュの状況（ヒット率・保持しているバイト数など）
+@app.get("/api/cache/stats")
+def cache_stats():
+    return jsonify(cache.stats())
 
 
 if __name__ == "__main__":
@@ -22,20 +22,59 @@ function App() {
     setError("");
 
     try {
-      const res = await fetch("/api/propose", {
+      // ストリーミング版: 生成中のタイトル/メモを、届いた分から少しずつ表示する
+      const res = await fetch("/api/propose/stream", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({ text: aiText }),
       });
 
-      const data = await res.json();
+      // 入力エラーなどは、ストリームが始まる前に JSON で返ってくる
       if (!res.ok) {
+        const data = await res.json().catch(() => ({}));
         throw new Error(data.error || "エラーが発生しました");
       }
 
-      // 返ってきた内容をフォームに反映
-      setTitle(data.title || "");
-      setMemo(data.memo || "");
+      // SSE を読む（イベントは空行 "\n\n" 区切り。1回の read で途中までしか届かないこともある）
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let finished = false;
+      while (!finished) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let end;
+        while ((end = buffer.indexOf("\n\n")) !== -1) {
+          const block = buffer.slice(0, end);
+          buffer = buffer.slice(end + 2);
+
+          let event = "message";
+          let dataText = "";
+          for (const line of block.split("\n")) {
+            if (line.startsWith("event: ")) event = line.slice(7);
+            if (line.startsWith("data: ")) dataText += line.slice(6);
+          }
+          const data = dataText ? JSON.parse(dataText) : {};
+
+          if (event === "partial") {
+            // 途中までの値（変わった項目だけ届く）をフォームに反映
+            if (data.title !== undefined) setTitle(data.title);
+            if (data.memo !== undefined) setMemo(data.memo);
+          } else if (event === "done") {
+            // 完成した内容をフォームに反映
+            setTitle(data.title || "");
+            setMemo(data.memo || "");
+            finished = true;
+          } else if (event === "error") {
+            throw new Error(data.error || "エラーが発生しました");
+          }
+        }
+      }
+      if (!finished) {
+        throw new Error("応答が途中で切れました");
+      }
 
       // モーダルを閉じる
       setIsModalOpen(false);